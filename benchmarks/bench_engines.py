@@ -0,0 +1,258 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Compare the products and speed of all the ways to run simulate_pcr.
+
+Generates synthetic templates and primer panels, runs every execution path
+(serial, sharded, batched, via a scratch file, prefiltered, cached and the
+native engine) in a fresh process and checks that all of them find the same
+set of products as the serial ipcress run. Wall time, products/s and peak
+RSS (of the process and of its ipcress children) are written as JSON.
+
+Without exonerate installed, run with --fake-ipcress to search with
+benchmarks/fake_ipcress.py, which only verifies the plumbing around ipcress.
+
+Usage:
+    python benchmarks/bench_engines.py --templates 200 --length 50000 \\
+        --experiments 4 --mismatch 1 --degeneracy 2 --output engines.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from q2_exonerate._native import IUPAC_MASKS, _revcomp
+from q2_exonerate._sharding import _iter_fasta_records
+from q2_exonerate._stats import _peak_rss
+
+FAKE_IPCRESS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fake_ipcress.py"
+)
+BASES = "ACGT"
+DEGENERATE = [code for code, mask in IUPAC_MASKS.items() if bin(mask).count("1") > 1]
+
+# the simulate_pcr parameters of every execution path
+PATHS = {
+    "serial": {"pretty": True},
+    "compact": {"pretty": False},
+    "sharded": {"n_jobs": 4},
+    "sharded-split": {"n_jobs": 4, "split_templates": True},
+    "batched": {"experiment_batch_size": 1},
+    "scratch": {"scratch_dir": "{scratch}"},
+    "prefilter": {"prefilter": True},
+    "cached-cold": {"cache_dir": "{cache}"},
+    "cached-warm": {"cache_dir": "{cache}"},
+    "native": {"engine": "native"},
+}
+
+
+def _random(rng, n):
+    return "".join(rng.choices(BASES, k=n))
+
+
+def _resolve(primer, rng):
+    """Pick one of the sequences a degenerate primer stands for."""
+    return "".join(
+        rng.choice([b for b in BASES if IUPAC_MASKS[b] & IUPAC_MASKS[code]])
+        for code in primer
+    )
+
+
+def _mutate(seq, n, rng):
+    seq = list(seq)
+    for i in rng.sample(range(len(seq)), n):
+        seq[i] = rng.choice([b for b in BASES if b != seq[i]])
+    return "".join(seq)
+
+
+def generate_primers(n_experiments, length, degeneracy, rng):
+    """Generate primer pairs with `degeneracy` ambiguous positions each."""
+    experiments = []
+    for n in range(n_experiments):
+        pair = []
+        for _ in range(2):
+            primer = list(_random(rng, length))
+            for i in rng.sample(range(length - 3), degeneracy):
+                primer[i] = rng.choice(DEGENERATE)
+            pair.append("".join(primer))
+        experiments.append((f"EXP{n}", *pair))
+    return experiments
+
+
+def generate_templates(n_templates, length, experiments, mismatch, rng, rate=0.5):
+    """Generate random templates, some with products of the given experiments.
+
+    A product of a random experiment is planted on about `rate` of the
+    templates, in a random orientation and with up to `mismatch` mismatches
+    per primer; every fifth template is a copy of an earlier one.
+    """
+    templates = []
+    for n in range(n_templates):
+        if templates and n % 5 == 4:
+            templates.append((f"t{n} copy", templates[-1][1]))
+            continue
+        seq = _random(rng, length)
+        if rng.random() < rate:
+            _, fwd, rev = rng.choice(experiments)
+            product = (
+                _mutate(_resolve(fwd, rng), rng.randint(0, mismatch), rng)
+                + _random(rng, rng.randint(100, 1000))
+                + _revcomp(_mutate(_resolve(rev, rng), rng.randint(0, mismatch), rng))
+            )
+            if rng.random() < 0.5:
+                product = _revcomp(product)
+            start = rng.randint(0, max(length - len(product), 0))
+            seq = seq[:start] + product + seq[start + len(product) :]
+        templates.append((f"t{n} synthetic template {n}", seq))
+    return templates
+
+
+def _write_inputs(directory, templates, experiments):
+    templates_fp = os.path.join(directory, "templates.fasta")
+    with open(templates_fp, "w") as fh:
+        for header, seq in templates:
+            fh.write(f">{header}\n")
+            fh.writelines(seq[i : i + 80] + "\n" for i in range(0, len(seq), 80))
+    experiments_fp = os.path.join(directory, "experiments.ipcress")
+    with open(experiments_fp, "w") as fh:
+        for row in experiments:
+            fh.write(" ".join(row) + " 100 2000\n")
+    return templates_fp, experiments_fp
+
+
+def _run_path(templates_fp, experiments_fp, mismatch, params):
+    """Run simulate_pcr once; meant to be run in a fresh process."""
+    from q2_types.feature_data import DNAFASTAFormat
+
+    from q2_exonerate.ipcress import simulate_pcr
+    from q2_exonerate.types._format import IPCRessExperimentFormat
+
+    templates = DNAFASTAFormat(templates_fp, "r")
+    experiments = IPCRessExperimentFormat(experiments_fp, "r")
+    start = time.perf_counter()
+    try:
+        results, meta = simulate_pcr(
+            templates, experiments, mismatch=mismatch, **params
+        )
+    except ValueError:
+        # no hits were found
+        results, meta = None, None
+    seconds = time.perf_counter() - start
+
+    products = set()
+    if results is not None:
+        # the products are written in the same order as their metadata
+        records = _iter_fasta_records(str(results))
+        for (_, row), (_, seq) in zip(meta.iterrows(), records):
+            products.add(
+                (
+                    row["experiment"],
+                    row["target"],
+                    row["match_orientation"],
+                    row["matches_fwd"],
+                    row["matches_rev"],
+                    int(row["length"]),
+                    int(row["start_position"]),
+                    "".join(line.strip() for line in seq),
+                )
+            )
+    rss = {
+        who: _peak_rss(usage)
+        for who, usage in (
+            ("self", resource.RUSAGE_SELF),
+            ("children", resource.RUSAGE_CHILDREN),
+        )
+    }
+    return products, seconds, rss
+
+
+def _in_fresh_process(*args):
+    # spawn rather than fork, so that the peak RSS is that of this path only
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_run_path, *args).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--templates", type=int, default=100)
+    parser.add_argument("--length", type=int, default=20000)
+    parser.add_argument("--experiments", type=int, default=3)
+    parser.add_argument("--primer-length", type=int, default=20)
+    parser.add_argument("--mismatch", type=int, default=1)
+    parser.add_argument("--degeneracy", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--paths", nargs="+", choices=list(PATHS), default=list(PATHS))
+    parser.add_argument("--fake-ipcress", action="store_true")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    experiments = generate_primers(
+        args.experiments, args.primer_length, args.degeneracy, rng
+    )
+    templates = generate_templates(
+        args.templates, args.length, experiments, args.mismatch, rng
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.fake_ipcress:
+            os.symlink(FAKE_IPCRESS, os.path.join(tmp, "ipcress"))
+            os.environ["PATH"] = tmp + os.pathsep + os.environ["PATH"]
+        elif shutil.which("ipcress") is None:
+            sys.exit("ipcress was not found, use --fake-ipcress to run without it")
+
+        inputs = _write_inputs(tmp, templates, experiments)
+        cache = os.path.join(tmp, "cache")
+        expected, results = None, []
+        for name in args.paths:
+            params = {
+                k: v.format(cache=cache, scratch=tmp) if isinstance(v, str) else v
+                for k, v in PATHS[name].items()
+            }
+            products, seconds, rss = _in_fresh_process(*inputs, args.mismatch, params)
+            if expected is None:
+                expected = products
+            results.append(
+                {
+                    "path": name,
+                    "seconds": round(seconds, 4),
+                    "products": len(products),
+                    "products_per_s": round(len(products) / seconds, 1),
+                    "peak_rss_mb": round(rss["self"], 1),
+                    "peak_rss_children_mb": round(rss["children"], 1),
+                    "identical": products == expected,
+                    "missing": len(expected - products),
+                    "extra": len(products - expected),
+                }
+            )
+            print(
+                f"{name:>14}: {seconds:8.3f} s  {len(products):8d} products  "
+                f"{rss['self']:8.1f} MiB  "
+                f"{'ok' if products == expected else 'MISMATCH'}"
+            )
+
+    report = {
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    if not all(result["identical"] for result in results):
+        sys.exit("the execution paths disagree")
+
+
+if __name__ == "__main__":
+    main()
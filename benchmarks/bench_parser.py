@@ -0,0 +1,156 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Compare the ipcress output parser against the former split-based one.
+
+Usage:
+    python benchmarks/bench_parser.py --products 100000 --length 2000
+"""
+import argparse
+import io
+import random
+import time
+
+from q2_exonerate.ipcress import _parse_pcr_products
+from q2_exonerate.utils import STREAM_CHUNK_SIZE
+
+RESULT = """
+Ipcress result
+--------------
+ Experiment: {experiment}
+    Primers: A B
+     Target: {target}:filter(unmasked) Some organism chromosome 1
+    Matches: 17/17 19/19
+    Product: {length} bp (range 500-5000)
+Result type: forward
+
+...GTACACACCGCCCGTCG............................. # forward
+   |||||||||||||||||-->
+5'-GTACACACCGCCCGTCG-3' 3'-CTAGAACCWCCATCATYGT-5' # primers
+                        <--|||||||| ||||||| ||
+...........................CTAGAACCACCATCATCGT... # revcomp
+--
+ipcress: {target}:filter(unmasked) {experiment} {length} A {start} 0 B {end} 0 forward
+>{experiment}_product_{n} seq {target}:filter(unmasked) start {start} length {length}
+{sequence}"""
+
+
+# the output of ipcress without its pretty results (-p FALSE -P TRUE)
+COMPACT_RESULT = "\n" + RESULT.split("\n--\n", 1)[1]
+
+
+def write_output(fh, n_products: int, length: int, seed: int = 42, pretty: bool = True):
+    """Write ipcress output with `n_products` products of about `length` bp."""
+    rng = random.Random(seed)
+    template = RESULT if pretty else COMPACT_RESULT
+    for n in range(1, n_products + 1):
+        product_length = rng.randint(length // 2, length * 3 // 2)
+        sequence = "".join(rng.choices("ACGT", k=product_length))
+        start = rng.randint(1, 10**7)
+        fh.write(
+            template.format(
+                experiment=f"EXP{n % 7}",
+                target=f"NC_{n % 1000:06d}.1",
+                length=product_length,
+                start=start,
+                end=start + product_length,
+                n=n,
+                sequence="\n".join(
+                    sequence[i : i + 70] for i in range(0, product_length, 70)
+                ),
+            )
+        )
+    fh.write("\n-- completed ipcress analysis\n")
+
+
+def generate_output(
+    n_products: int, length: int, seed: int = 42, pretty: bool = True
+) -> bytes:
+    """Generate ipcress output in memory (see `write_output`)."""
+    out = io.StringIO()
+    write_output(out, n_products, length, seed, pretty)
+    return out.getvalue().encode()
+
+
+def _legacy_process_one_product(line):
+    product = {
+        "experiment": line[2].split(":")[-1].strip(),
+        "target": line[4].split("Target:")[-1].strip(),
+        "match_orientation": line[7].split(":")[-1].strip(),
+    }
+    matches = line[5].lstrip().split(" ")
+    if product["match_orientation"] == "revcomp":
+        product.update({"matches_fwd": matches[2], "matches_rev": matches[1]})
+    else:
+        product.update({"matches_fwd": matches[1], "matches_rev": matches[2]})
+    product_length = line[6].lstrip().split(" ")
+    ranges = product_length[4][:-1].split("-")
+    product.update(
+        {
+            "length": int(product_length[1]),
+            "range_min": int(ranges[0]),
+            "range_max": int(ranges[1]),
+            "start_position": int(line[16].split("start")[1].strip().split(" ")[0]),
+            "id": line[16].strip()[1:],
+            "sequence": "",
+        }
+    )
+    for l_ in line[17:]:
+        if not l_ or "completed ipcress analysis" in l_:
+            break
+        product["sequence"] += l_
+    return product
+
+
+def legacy_parser(output: bytes) -> list:
+    """The split-based parser used before the single-pass one."""
+    lines = output.decode().split("Ipcress result")
+    lines = [line.split("\n") for line in lines if "Experiment" in line]
+    return [_legacy_process_one_product(line) for line in lines]
+
+
+def current_parser(output: bytes) -> list:
+    # the output is consumed in chunks, as read from the ipcress pipe
+    stream = io.BytesIO(output)
+    chunks = iter(lambda: stream.read1(STREAM_CHUNK_SIZE), b"")
+    return list(_parse_pcr_products(chunks))
+
+
+def _time(fn, output, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        products = fn(output)
+        best = min(best, time.perf_counter() - start)
+    return best, products
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--length", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    output = generate_output(args.products, args.length)
+    print(f"{args.products} products, {len(output) / 2**20:.1f} MiB of output")
+
+    legacy, expected = _time(legacy_parser, output, args.repeat)
+    current, observed = _time(current_parser, output, args.repeat)
+    assert observed == expected, "the parsers disagree"
+
+    for name, seconds in (("split-based", legacy), ("single-pass", current)):
+        print(
+            f"{name:>12}: {seconds:8.3f} s  "
+            f"{args.products / seconds:12,.0f} products/s  "
+            f"{len(output) / seconds / 2**20:8.1f} MiB/s"
+        )
+    print(f"     speedup: {legacy / current:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Time every stage of turning ipcress output into the action's results.
+
+Generates ipcress outputs of the given numbers of products and times the
+parser (with and without the pretty results), the FASTA writer, the
+metadata extraction and the match fraction calculation separately, then
+measures the peak memory allocated by every stage in a second, traced run.
+The outputs are generated into temporary files, which the stages stream
+in chunks, and the results of every stage are discarded as they come, so
+that only the metadata built by extract_meta grows with the number of
+products. Stages which consume products are fed from the parser in
+batches; the time spent parsing them is not charged to the stage.
+
+The throughput of every stage is compared against a stored baseline and
+the script fails if it drops more than --tolerance below it. Baselines
+depend on the machine, so record one before optimising anything.
+
+Usage:
+    python benchmarks/bench_stages.py --sizes 1000 100000 --update-baseline
+    python benchmarks/bench_stages.py --sizes 1000 100000
+"""
+import argparse
+import collections
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+from bench_parser import write_output
+
+from q2_exonerate.ipcress import (
+    _calculate_match_frac,
+    _dump_seqs_to_file,
+    _extract_pcr_meta,
+    _parse_pcr_products,
+)
+from q2_exonerate.utils import STREAM_CHUNK_SIZE
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# the primer lengths and length range of the experiments in generated outputs
+PANEL = {f"EXP{n}": ({b"A": 17, b"B": 19}, 500, 5000) for n in range(7)}
+
+
+# number of products parsed at once for the stages which consume products
+INPUT_BATCH_SIZE = 2**12
+
+
+def _generate(directory: str, size: int, length: int, pretty: bool) -> str:
+    fp = os.path.join(directory, f"{size}_{'pretty' if pretty else 'compact'}.out")
+    with open(fp, "w", buffering=STREAM_CHUNK_SIZE) as fh:
+        write_output(fh, size, length, pretty=pretty)
+    return fp
+
+
+def _chunks(fp: str):
+    with open(fp, "rb") as fh:
+        yield from iter(lambda: fh.read(STREAM_CHUNK_SIZE), b"")
+
+
+def _drain(iterable):
+    collections.deque(iterable, maxlen=0)
+
+
+class _Input:
+    """The products parsed from an output file, prepared for a stage.
+
+    Products are parsed in batches, which `prepare` turns into the items
+    the stage consumes. The time spent parsing and preparing them is kept
+    in `seconds`, so that it can be left out of the time of the stage.
+    """
+
+    def __init__(self, fp: str, prepare=list):
+        self.fp = fp
+        self.prepare = prepare
+        self.seconds = 0.0
+
+    def __iter__(self):
+        self.seconds = 0.0
+        products = _parse_pcr_products(_chunks(self.fp))
+        while True:
+            start = time.perf_counter()
+            batch = list(itertools.islice(products, INPUT_BATCH_SIZE))
+            items = self.prepare(batch) if batch else []
+            self.seconds += time.perf_counter() - start
+            if not batch:
+                return
+            yield from items
+
+
+def _matches(batch: list) -> list:
+    return [pd.Series([product["matches_fwd"] for product in batch])]
+
+
+def _stages(pretty_fp: str, compact_fp: str) -> dict:
+    """Every stage as a function and its input, if it consumes products."""
+    return {
+        "parse_pretty": (
+            lambda _: _drain(_parse_pcr_products(_chunks(pretty_fp))),
+            None,
+        ),
+        "parse_compact": (
+            lambda _: _drain(_parse_pcr_products(_chunks(compact_fp), PANEL)),
+            None,
+        ),
+        "dump_seqs": (_dump_seqs_to_file, _Input(pretty_fp)),
+        "extract_meta": (_extract_pcr_meta, _Input(pretty_fp)),
+        "match_frac": (
+            lambda matches: _drain(map(_calculate_match_frac, matches)),
+            _Input(pretty_fp, _matches),
+        ),
+    }
+
+
+def _run(stage) -> float:
+    """Run a stage and return the time it took, without that of its input."""
+    fn, source = stage
+    start = time.perf_counter()
+    fn(source)
+    return time.perf_counter() - start - (0 if source is None else source.seconds)
+
+
+def _time(stage, repeat: int) -> float:
+    return min(_run(stage) for _ in range(repeat))
+
+
+def _peak_memory(stage) -> int:
+    tracemalloc.start()
+    try:
+        _run(stage)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _regressions(results: list, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for result in results:
+        expected = baseline.get(result["stage"], {}).get(str(result["products"]))
+        if expected is not None and result["products_per_s"] < expected * (
+            1 - tolerance
+        ):
+            regressions.append(
+                f"{result['stage']} ({result['products']} products): "
+                f"{result['products_per_s']:,.0f} products/s, "
+                f"baseline {expected:,.0f}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--length", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stages", nargs="+")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            pretty_fp = _generate(tmp, size, args.length, pretty=True)
+            compact_fp = _generate(tmp, size, args.length, pretty=False)
+            for name, stage in _stages(pretty_fp, compact_fp).items():
+                if args.stages and name not in args.stages:
+                    continue
+                seconds = _time(stage, args.repeat)
+                peak = None if args.no_memory else _peak_memory(stage) / 2**20
+                results.append(
+                    {
+                        "stage": name,
+                        "products": size,
+                        "seconds": round(seconds, 4),
+                        "products_per_s": round(size / seconds, 1),
+                        "peak_memory_mb": None if peak is None else round(peak, 1),
+                    }
+                )
+                print(
+                    f"{name:>14} {size:>9}: {seconds:8.3f} s  "
+                    f"{size / seconds:12,.0f} products/s"
+                    + ("" if peak is None else f"  {peak:8.1f} MiB")
+                )
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+    if args.update_baseline:
+        for result in results:
+            baseline.setdefault(result["stage"], {})[str(result["products"])] = result[
+                "products_per_s"
+            ]
+        with open(args.baseline, "w") as fh:
+            json.dump(baseline, fh, indent=2, sort_keys=True)
+        return
+
+    regressions = _regressions(results, baseline, args.tolerance)
+    if regressions:
+        sys.exit("Throughput regressed:\n  " + "\n  ".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""A stand-in for ipcress, for machines without exonerate installed.
+
+Accepts the arguments q2-exonerate runs ipcress with and prints the products
+found by the native engine in the ipcress output format, with or without the
+pretty results. Install it on the PATH under the name `ipcress`, e.g.:
+
+    ln -s $(pwd)/benchmarks/fake_ipcress.py ~/bin/ipcress
+
+Since the products come from the native engine, comparing the ipcress path
+against the native engine with this stand-in only verifies the plumbing
+around ipcress (sharding, batching, caching, prefiltering and parsing), not
+the native engine itself.
+"""
+import argparse
+import sys
+
+from q2_exonerate._native import _run_native
+from q2_exonerate._sharding import _iter_fasta_records
+
+VERSION = "ipcress from exonerate version 2.4.0 (fake)"
+LINE_WIDTH = 70
+
+PRETTY = """
+Ipcress result
+--------------
+ Experiment: {experiment}
+    Primers: {left} {right}
+     Target: {target}
+    Matches: {matches_left} {matches_right}
+    Product: {length} bp (range {range_min}-{range_max})
+Result type: {orientation}
+"""
+
+
+def _flag(value: str) -> bool:
+    return value.upper() not in ("FALSE", "F", "0", "NO")
+
+
+def _primers(product: dict) -> tuple:
+    """Order the primers and their matches as ipcress reports them."""
+    orientation = product["match_orientation"]
+    if orientation == "single_A":
+        return "A", "A", product["matches_fwd"], product["matches_rev"]
+    if orientation == "single_B":
+        return "B", "B", product["matches_fwd"], product["matches_rev"]
+    if orientation == "revcomp":
+        return "B", "A", product["matches_rev"], product["matches_fwd"]
+    return "A", "B", product["matches_fwd"], product["matches_rev"]
+
+
+def _mismatches(matches: str) -> int:
+    matched, length = matches.split("/")
+    return int(length) - int(matched)
+
+
+def _write_product(out, product: dict, descriptions: dict, pretty: bool):
+    left, right, matches_left, matches_right = _primers(product)
+    target = product["target"]
+    if pretty:
+        described = " ".join(filter(None, (target, descriptions.get(target))))
+        out.write(
+            PRETTY.format(
+                left=left,
+                right=right,
+                target=described,
+                matches_left=matches_left,
+                matches_right=matches_right,
+                orientation=product["match_orientation"],
+                **{
+                    k: product[k]
+                    for k in ("experiment", "length", "range_min", "range_max")
+                },
+            )
+        )
+    start, length = product["start_position"], product["length"]
+    end = start + length - int(matches_right.split("/")[1])
+    out.write(
+        f"ipcress: {target} {product['experiment']} {length} "
+        f"{left} {start} {_mismatches(matches_left)} "
+        f"{right} {end} {_mismatches(matches_right)} "
+        f"{product['match_orientation']}\n"
+        f">{product['id']}\n"
+    )
+    sequence = product["sequence"]
+    for i in range(0, len(sequence), LINE_WIDTH):
+        out.write(sequence[i : i + LINE_WIDTH] + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--version", action="store_true")
+    parser.add_argument("-i", "--input", dest="experiments")
+    parser.add_argument("-s", "--sequence", dest="templates")
+    parser.add_argument("-S", "--seed", type=int, default=12)
+    parser.add_argument("-M", "--memory", type=int, default=32)
+    parser.add_argument("-m", "--mismatch", type=int, default=0)
+    parser.add_argument("-p", "--pretty", nargs="?", const="TRUE", default="TRUE")
+    parser.add_argument("-P", "--products", nargs="?", const="TRUE", default="FALSE")
+    args = parser.parse_args(argv)
+
+    if args.version:
+        print(VERSION)
+        return
+    if args.experiments is None or args.templates is None:
+        parser.error("both an experiment file (-i) and templates (-s) are required")
+
+    descriptions = {}
+    for header, _ in _iter_fasta_records(args.templates):
+        fields = header[1:].split(None, 1)
+        if len(fields) == 2:
+            descriptions[f"{fields[0]}:filter(unmasked)"] = fields[1].strip()
+
+    out = sys.stdout
+    pretty = _flag(args.pretty)
+    for product in _run_native(args.templates, args.experiments, args.mismatch):
+        _write_product(out, product, descriptions, pretty)
+    out.write("-- completed ipcress analysis\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from q2_exonerate._sharding import _stream_fasta_records
+from q2_exonerate.utils import STREAM_CHUNK_SIZE
+
+LOCK_FILE = ".lock"
+TMP_PREFIX = ".tmp-"
+# age (s) beyond which a temporary entry is taken to be left by a store
+# which was interrupted, rather than one still being written
+STALE_TMP_AGE = 24 * 60 * 60
+
+
+def _hash_file(fp: str) -> str:
+    digest = hashlib.sha256()
+    with open(fp, "rb") as fh:
+        for chunk in iter(lambda: fh.read(STREAM_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _hash_records(templates_fp: str) -> List[Tuple[str, str, str]]:
+    """List the ID, description and sequence hash of every FASTA record.
+
+    Sequences are hashed line by line, without ever holding a whole record.
+    """
+    records = []
+    for header, seq in _stream_fasta_records(templates_fp):
+        fields = header[1:].split(None, 1)
+        digest = hashlib.sha256()
+        for line in seq:
+            digest.update(line.strip().encode())
+        description = fields[1].strip() if len(fields) == 2 else ""
+        records.append((fields[0], description, digest.hexdigest()))
+    return records
+
+
+def _cache_key(*parts) -> str:
+    """Hash any JSON-serialisable values into a cache key."""
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _ipcress_version() -> str:
+    out = subprocess.run(
+        ["ipcress", "--version"], check=True, stdout=subprocess.PIPE, text=True
+    )
+    return out.stdout.strip()
+
+
+class ResultCache:
+    """A directory of cache entries with a size cap and LRU eviction.
+
+    Every entry is a directory named after its key. Entries are written to
+    a temporary directory first and then renamed into place, so readers
+    never see partial entries. A lock file serialises the (rare) writers
+    and evictions against readers: entries are read under a shared lock
+    and stored/evicted under an exclusive one, which makes the cache safe
+    to share between concurrent processes. Entries are evicted in the
+    order they were last used once their total size exceeds `max_size` MB.
+    Temporary entries left behind by interrupted stores are removed once
+    they are older than `STALE_TMP_AGE`.
+    """
+
+    def __init__(self, directory: str, max_size: Optional[int] = None):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def _lock(self, exclusive: bool) -> Iterator[None]:
+        with open(os.path.join(self.directory, LOCK_FILE), "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    @contextmanager
+    def lookup(self, key: str) -> Iterator[Optional[str]]:
+        """Provide the directory of the entry `key`, or None if there is none.
+
+        The entry is guaranteed to exist until the context is left.
+        """
+        entry = os.path.join(self.directory, key)
+        with self._lock(exclusive=False):
+            if not os.path.isdir(entry):
+                yield None
+                return
+            os.utime(entry)
+            yield entry
+
+    def store(self, key: str, write: Callable[[str], None]):
+        """Create the entry `key` by calling `write` on an empty directory."""
+        tmp = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=self.directory)
+        try:
+            write(tmp)
+            with self._lock(exclusive=True):
+                entry = os.path.join(self.directory, key)
+                if os.path.isdir(entry):
+                    # replace an outdated entry or one stored concurrently
+                    shutil.rmtree(entry)
+                os.rename(tmp, entry)
+                self._sweep()
+                self._evict()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _sweep(self):
+        stale = time.time() - STALE_TMP_AGE
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.startswith(TMP_PREFIX):
+                continue
+            try:
+                if os.stat(path).st_mtime < stale:
+                    shutil.rmtree(path, ignore_errors=True)
+            except FileNotFoundError:
+                # stored or given up meanwhile, outside of the lock
+                pass
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            entries.append((os.stat(path).st_mtime, _dir_size(path), path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size * 2**20:
+                break
+            shutil.rmtree(path)
+            total -= size
+
+
+def _dir_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
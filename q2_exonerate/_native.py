@@ -0,0 +1,195 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from q2_exonerate._sharding import (
+    IUPAC_BASES,
+    _fasta_id,
+    _iter_fasta_records,
+    _read_experiments,
+)
+
+# bases as bitmasks of the nucleotides they stand for: A=1, C=2, G=4, T=8
+IUPAC_MASKS = {
+    code: sum(1 << "ACGT".index(base) for base in bases)
+    for code, bases in IUPAC_BASES.items()
+}
+BASE_MASKS = np.full(256, 15, dtype=np.uint8)
+for _base, _mask in IUPAC_MASKS.items():
+    BASE_MASKS[ord(_base)] = BASE_MASKS[ord(_base.lower())] = _mask
+
+IUPAC_COMPLEMENT = str.maketrans(
+    "ACGTURYSWKMBDHVNacgturyswkmbdhvn", "TGCAAYRSWMKVHDBNtgcaayrswmkvhdbn"
+)
+
+# the primers binding upstream and downstream of every kind of product
+PRODUCT_TYPES = (
+    ("forward", "A", "B"),
+    ("revcomp", "B", "A"),
+    ("single_A", "A", "A"),
+    ("single_B", "B", "B"),
+)
+
+
+def _revcomp(seq: str) -> str:
+    return seq.translate(IUPAC_COMPLEMENT)[::-1]
+
+
+def _encode(seq: bytes) -> np.ndarray:
+    return BASE_MASKS[np.frombuffer(seq, dtype=np.uint8)]
+
+
+def _count_mismatches(template: np.ndarray, primer: np.ndarray) -> np.ndarray:
+    """Count the mismatches of a primer at every position of a template.
+
+    The primer is compared to all template positions at once, one primer
+    base at a time; two bases match if they have any nucleotide in common.
+    Like ipcress, and like a Shift-Add matcher, only substitutions are
+    counted. Rather than packing the primer positions into a word and
+    stepping through the template, the counts of all template positions
+    make up the vector, so that the loop runs over the primer bases only.
+    """
+    n = len(template) - len(primer) + 1
+    mismatches = np.zeros(max(n, 0), dtype=np.uint8)
+    if n <= 0:
+        return mismatches
+    for i, base in enumerate(primer):
+        mismatches += (template[i : i + n] & base) == 0
+    return mismatches
+
+
+def _find_sites(
+    template: np.ndarray, primers: Iterable[str], mismatch: int
+) -> Dict[Tuple[str, bool], Tuple[np.ndarray, np.ndarray]]:
+    """Find the positions and mismatches of all primer sites on a template.
+
+    Sites are given by primer sequence and strand (True for the primer
+    binding as given, i.e. upstream of a product, False for its reverse
+    complement binding downstream); positions are 0-based template
+    coordinates. Every distinct primer is matched only once.
+    """
+    sites = {}
+    for primer in set(primers):
+        for upstream, seq in ((True, primer), (False, _revcomp(primer))):
+            mismatches = _count_mismatches(template, _encode(seq.encode()))
+            positions = np.flatnonzero(mismatches <= mismatch)
+            sites[primer, upstream] = positions, mismatches[positions]
+    return sites
+
+
+def _pair_sites(
+    upstream: Tuple[np.ndarray, np.ndarray],
+    downstream: Tuple[np.ndarray, np.ndarray],
+    downstream_length: int,
+    min_length: int,
+    max_length: int,
+) -> Iterator[Tuple[int, int, int, int]]:
+    """Pair up- and downstream sites into products of an acceptable length.
+
+    Yields (start, length, upstream mismatches, downstream mismatches) for
+    every pair, with the length spanning both primers.
+    """
+    ends = downstream[0] + downstream_length
+    first = np.searchsorted(ends, upstream[0] + max(min_length, 1), side="left")
+    last = np.searchsorted(ends, upstream[0] + max_length, side="right")
+    for i in np.flatnonzero(last > first):
+        start = int(upstream[0][i])
+        for j in range(first[i], last[i]):
+            yield (
+                start,
+                int(ends[j]) - start,
+                int(upstream[1][i]),
+                int(downstream[1][j]),
+            )
+
+
+def _format_matches(primer_length: int, mismatches: int) -> str:
+    return f"{primer_length - mismatches}/{primer_length}"
+
+
+def _template_products(
+    seq_id: str, sequence: str, experiments: List[List[str]], mismatch: int
+) -> Iterator[dict]:
+    """Find the products of all experiments on a single template.
+
+    Products are ordered by experiment and then by their start position.
+    """
+    template = _encode(sequence.encode())
+    target = f"{seq_id}:filter(unmasked)"
+    # primers shared by several experiments are matched once per template
+    sites = _find_sites(
+        template,
+        (primer.upper() for row in experiments for primer in row[1:3]),
+        mismatch,
+    )
+    for experiment, fwd, rev, min_length, max_length in experiments:
+        primers = {"A": fwd.upper(), "B": rev.upper()}
+        products = []
+        for orientation, left, right in PRODUCT_TYPES:
+            pairs = _pair_sites(
+                sites[primers[left], True],
+                sites[primers[right], False],
+                len(primers[right]),
+                int(min_length),
+                int(max_length),
+            )
+            for start, length, left_mm, right_mm in pairs:
+                match_fwd = _format_matches(len(primers[left]), left_mm)
+                match_rev = _format_matches(len(primers[right]), right_mm)
+                product_seq = sequence[start : start + length]
+                if orientation == "revcomp":
+                    match_fwd, match_rev = match_rev, match_fwd
+                    product_seq = _revcomp(product_seq)
+                products.append(
+                    {
+                        "experiment": experiment,
+                        "target": target,
+                        "match_orientation": orientation,
+                        "matches_fwd": match_fwd,
+                        "matches_rev": match_rev,
+                        "length": length,
+                        "range_min": int(min_length),
+                        "range_max": int(max_length),
+                        "start_position": start,
+                        "sequence": product_seq,
+                    }
+                )
+        products.sort(key=lambda product: product["start_position"])
+        yield from products
+
+
+def _run_native(
+    templates_fp: str, experiments_fp: str, mismatch: int
+) -> Iterator[dict]:
+    """Simulate PCR on all templates with NumPy instead of ipcress.
+
+    Every primer is matched against every position of both strands of a
+    template at once, counting mismatches between IUPAC bitmasks. Sites
+    with at most `mismatch` mismatches are paired like ipcress does: the
+    forward primer (A) upstream of the reverse primer (B) ("forward"), B
+    upstream of A ("revcomp", reported as the reverse complement) or one
+    primer on both ends ("single_A"/"single_B"). As in the compact ipcress
+    output, targets consist of the template ID only and products are
+    numbered consecutively within every experiment.
+    """
+    experiments = _read_experiments(experiments_fp)
+    counts = defaultdict(int)
+    for header, seq in _iter_fasta_records(templates_fp):
+        seq_id = _fasta_id(header)
+        sequence = "".join(line.strip() for line in seq)
+        for product in _template_products(seq_id, sequence, experiments, mismatch):
+            experiment = product["experiment"]
+            counts[experiment] += 1
+            product["id"] = (
+                f"{experiment}_product_{counts[experiment]} seq {product['target']} "
+                f"start {product['start_position']} length {product['length']}"
+            )
+            yield product
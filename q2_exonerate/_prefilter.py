@@ -0,0 +1,484 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from q2_exonerate._cache import _hash_records
+from q2_exonerate._sharding import (
+    IUPAC_BASES,
+    _fasta_id,
+    _read_experiments,
+    _sequence_blocks,
+    _stream_fasta_records,
+)
+from q2_exonerate.utils import STREAM_CHUNK_SIZE
+
+logger = logging.getLogger("q2_exonerate.prefilter")
+
+# k-mers are packed into int64 at 2 bits per base
+MAX_K = 31
+# shorter seeds match too much of any template to be worth scanning for
+MIN_K = 6
+# primers with more seed variants than this are not prefiltered
+MAX_SEED_VARIANTS = 2**16
+# number of template bases encoded at once
+SCAN_BLOCK_SIZE = 2**22
+
+# files of a template index
+INDEX_MANIFEST = "index.json"
+INDEX_RECORDS = "templates.tsv"
+INDEX_KMERS = "kmers.npy"
+INDEX_TEMPLATES = "templates.npy"
+INDEX_POSITIONS = "positions.npy"
+INDEX_AMBIGUOUS = "ambiguous.npy"
+# an index entry: a k-mer code, its template and its position on it
+INDEX_ENTRY = np.dtype(
+    [("kmer", np.int64), ("template", np.uint32), ("position", np.uint32)]
+)
+# number of k-mers sorted at once when building an index
+INDEX_BUCKET_SIZE = 2**22
+
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+BASE_CODES = np.full(256, -1, dtype=np.int8)
+for _code, _bases in enumerate(("Aa", "Cc", "Gg", "Tt")):
+    for _base in _bases:
+        BASE_CODES[ord(_base)] = _code
+
+
+def _seed_size(experiments: List[List[str]], mismatch: int) -> int:
+    """Length of the exact seeds every amplifiable primer site must contain.
+
+    A primer of length L matching with at most `mismatch` mismatches has
+    at least one of its `mismatch + 1` disjoint pieces matching exactly;
+    every piece is at least L // (mismatch + 1) bases long.
+    """
+    shortest = min(len(primer) for row in experiments for primer in row[1:3])
+    return min(MAX_K, shortest // (mismatch + 1))
+
+
+def _encode_kmer(kmer: str) -> int:
+    code = 0
+    for base in kmer:
+        code = (code << 2) | int(BASE_CODES[ord(base)])
+    return code
+
+
+def _primer_seeds(primer: str, mismatch: int, k: int) -> Optional[Tuple[Set, Set]]:
+    """Encode the seeds of a primer as found on the template's forward strand.
+
+    Returns the k-mers of the primer binding upstream of the product (as
+    given) and downstream of it (reverse-complemented), or None if the
+    primer's degeneracy makes for too many seeds.
+    """
+    piece = len(primer) // (mismatch + 1)
+    kmers = set()
+    for start in range(0, piece * (mismatch + 1), piece):
+        options = [IUPAC_BASES.get(base, "ACGT") for base in primer[start:][:k]]
+        if np.prod([len(bases) for bases in options]) > MAX_SEED_VARIANTS:
+            return None
+        kmers.update("".join(kmer) for kmer in itertools.product(*options))
+    return (
+        {_encode_kmer(kmer) for kmer in kmers},
+        {_encode_kmer(kmer.translate(COMPLEMENT)[::-1]) for kmer in kmers},
+    )
+
+
+def _build_seed_index(
+    experiments: List[List[str]], mismatch: int, k: int
+) -> Optional[Dict[int, List[Tuple[int, int]]]]:
+    """Map every seed to the (experiment, side) pairs it belongs to.
+
+    Side 0 are seeds of primers binding upstream of a product, side 1 of
+    primers binding downstream of it. As ipcress reports products primed
+    by any of the two primers on either side, each primer contributes to
+    both sides. Returns None if any primer cannot be prefiltered.
+    """
+    index = defaultdict(list)
+    for experiment, row in enumerate(experiments):
+        for primer in row[1:3]:
+            seeds = _primer_seeds(primer.upper(), mismatch, k)
+            if seeds is None:
+                return None
+            for side, kmers in enumerate(seeds):
+                for kmer in kmers:
+                    index[kmer].append((experiment, side))
+    return index
+
+
+def _kmer_codes(seq: bytes, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Encode all k-mers of a sequence and flag those with ambiguous bases."""
+    bases = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    n = len(bases) - k + 1
+    unknown = np.concatenate([[0], np.cumsum(bases < 0)])
+    ambiguous = unknown[k:] > unknown[:n]
+    bases = np.maximum(bases, 0).astype(np.int64)
+    codes = bases[:n].copy()
+    for j in range(1, k):
+        np.left_shift(codes, 2, out=codes)
+        np.bitwise_or(codes, bases[j : j + n], out=codes)
+    return codes, ambiguous
+
+
+def _ambiguous_runs(ambiguous: np.ndarray, offset: int = 0) -> np.ndarray:
+    """The runs of k-mers with ambiguous bases as [start, end) intervals."""
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], ambiguous, [0]]) != 0))
+    return edges.reshape(-1, 2).astype(np.int64) + offset
+
+
+def _merge_runs(runs: List[np.ndarray]) -> np.ndarray:
+    """Join sorted, disjoint runs, merging those which touch."""
+    runs = np.concatenate(runs) if runs else np.zeros((0, 2), dtype=np.int64)
+    if len(runs) < 2:
+        return runs
+    apart = runs[1:, 0] != runs[:-1, 1]
+    return np.stack(
+        [
+            runs[np.concatenate([[True], apart]), 0],
+            runs[np.concatenate([apart, [True]]), 1],
+        ],
+        axis=1,
+    )
+
+
+def _scan_template(
+    seq: Iterable[str],
+    k: int,
+    seeds: Dict[int, List[Tuple[int, int]]],
+    kmers: np.ndarray,
+) -> Tuple[Dict[Tuple[int, int], List[np.ndarray]], np.ndarray]:
+    """Find the positions of all seeds in a template, given as its lines.
+
+    Returns the arrays of seed positions per (experiment, side) and the
+    runs of k-mers with ambiguous bases (see `_ambiguous_runs`), which
+    could match any seed.
+    """
+    hits, runs = defaultdict(list), []
+    for offset, block in _sequence_blocks(seq, SCAN_BLOCK_SIZE, k - 1):
+        codes, ambiguous = _kmer_codes(block, k)
+        # kmers are sorted, which makes the lookup a binary search
+        found = kmers[np.minimum(np.searchsorted(kmers, codes), len(kmers) - 1)]
+        matched = np.flatnonzero((found == codes) & ~ambiguous)
+        for code in np.unique(codes[matched]).tolist():
+            positions = matched[codes[matched] == code] + offset
+            for key in seeds[code]:
+                hits[key].append(positions)
+        runs.append(_ambiguous_runs(ambiguous, offset))
+    return hits, _merge_runs(runs)
+
+
+def _build_template_index(templates_fp: str, k: int, out_dir: str):
+    """Index the positions of all k-mers of the templates.
+
+    The codes of all k-mers without ambiguous bases are stored sorted,
+    next to the template and the position of each, so that all occurrences
+    of a k-mer can be looked up by a binary search in the memory-mapped
+    arrays. The runs of k-mers with ambiguous bases are stored as
+    (template, start, end) rows in template order. The ID and sequence
+    hash of every template are stored to recognise the indexed templates
+    later on.
+
+    The index is sorted out of core: the k-mers are first partitioned on
+    disk by their leading bases into buckets of about `INDEX_BUCKET_SIZE`
+    k-mers each, which are then sorted one at a time into the index.
+    """
+    # the size of the file bounds the number of k-mers of the templates
+    n_buckets = -(-os.path.getsize(templates_fp) // INDEX_BUCKET_SIZE)
+    shift = 2 * k - min(max(n_buckets - 1, 0).bit_length(), 2 * k)
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp:
+        buffer, buffered, n_runs = [], 0, 0
+        runs_fp = os.path.join(tmp, "ambiguous.bin")
+        with open(os.path.join(out_dir, INDEX_RECORDS), "w") as fh, open(
+            runs_fp, "wb"
+        ) as runs_fh:
+            records = _stream_fasta_records(templates_fp)
+            for template, (header, seq) in enumerate(records):
+                digest, runs = hashlib.sha256(), []
+                for offset, block in _sequence_blocks(
+                    _hashed(seq, digest), SCAN_BLOCK_SIZE, k - 1
+                ):
+                    if offset + len(block) > np.iinfo(np.uint32).max:
+                        raise ValueError(
+                            f"Template {_fasta_id(header)} is too long to be indexed."
+                        )
+                    block, ambiguous = _kmer_codes(block, k)
+                    runs.append(_ambiguous_runs(ambiguous, offset))
+                    positions = np.flatnonzero(~ambiguous)
+                    entries = np.empty(len(positions), dtype=INDEX_ENTRY)
+                    entries["kmer"] = block[positions]
+                    entries["template"] = template
+                    entries["position"] = positions + offset
+                    buffer.append(entries)
+                    buffered += len(entries)
+                    if buffered >= SCAN_BLOCK_SIZE:
+                        _spill_kmers(np.concatenate(buffer), shift, tmp)
+                        buffer, buffered = [], 0
+                runs = _merge_runs(runs)
+                rows = np.empty((len(runs), 3), dtype=np.uint32)
+                rows[:, 0], rows[:, 1:] = template, runs
+                rows.tofile(runs_fh)
+                n_runs += len(rows)
+                fh.write(f"{_fasta_id(header)}\t{digest.hexdigest()}\n")
+        if buffer:
+            _spill_kmers(np.concatenate(buffer), shift, tmp)
+        _merge_buckets(tmp, out_dir)
+        with open(os.path.join(out_dir, INDEX_AMBIGUOUS), "wb") as fh:
+            _write_npy_header(fh, np.dtype(np.uint32), (n_runs, 3))
+            with open(runs_fp, "rb") as runs_fh:
+                shutil.copyfileobj(runs_fh, fh, STREAM_CHUNK_SIZE)
+    with open(os.path.join(out_dir, INDEX_MANIFEST), "w") as fh:
+        json.dump({"k": k}, fh)
+
+
+def _write_npy_header(fh, dtype: np.dtype, shape: tuple):
+    """Start a `.npy` file whose data is then written to `fh` as raw bytes."""
+    np.lib.format.write_array_header_1_0(
+        fh,
+        {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": False,
+            "shape": shape,
+        },
+    )
+
+
+def _bucket_fp(directory: str, bucket: int) -> str:
+    return os.path.join(directory, f"bucket_{bucket:08d}.bin")
+
+
+def _spill_kmers(entries: np.ndarray, shift: int, out_dir: str):
+    """Append index entries to the bucket files of their k-mers' prefixes."""
+    buckets = entries["kmer"] >> shift
+    # a stable sort keeps the entries of every bucket in template order
+    order = np.argsort(buckets, kind="stable")
+    entries, buckets = entries[order], buckets[order]
+    bounds = np.flatnonzero(np.diff(buckets)) + 1
+    for start, end in zip(
+        np.concatenate([[0], bounds]), np.concatenate([bounds, [len(entries)]])
+    ):
+        with open(_bucket_fp(out_dir, int(buckets[start])), "ab") as fh:
+            entries[start:end].tofile(fh)
+
+
+def _merge_buckets(buckets_dir: str, out_dir: str):
+    """Sort the bucket files one by one into the index arrays.
+
+    The arrays are appended to their `.npy` files bucket by bucket, so
+    only a single bucket is ever held in memory.
+    """
+    fps = sorted(
+        os.path.join(buckets_dir, name)
+        for name in os.listdir(buckets_dir)
+        if name.startswith("bucket_")
+    )
+    total = sum(os.path.getsize(fp) for fp in fps) // INDEX_ENTRY.itemsize
+    names = {
+        "kmer": INDEX_KMERS,
+        "template": INDEX_TEMPLATES,
+        "position": INDEX_POSITIONS,
+    }
+    handles = {
+        field: open(os.path.join(out_dir, name), "wb") for field, name in names.items()
+    }
+    try:
+        for field, fh in handles.items():
+            _write_npy_header(fh, INDEX_ENTRY[field], (total,))
+        for fp in fps:
+            entries = np.fromfile(fp, dtype=INDEX_ENTRY)
+            os.remove(fp)
+            # entries are in template order, which a stable sort keeps per k-mer
+            order = np.argsort(entries["kmer"], kind="stable")
+            for field, fh in handles.items():
+                entries[field][order].tofile(fh)
+    finally:
+        for fh in handles.values():
+            fh.close()
+
+
+def _hashed(lines: Iterable[str], digest) -> Iterator[str]:
+    """Pass sequence lines through, adding them to the hash `digest`."""
+    for line in lines:
+        digest.update(line.strip().encode())
+        yield line
+
+
+def _index_size(index_dir: str) -> int:
+    with open(os.path.join(index_dir, INDEX_MANIFEST)) as fh:
+        return json.load(fh)["k"]
+
+
+def _lookup_template_index(
+    index_dir: str, seeds: Dict[int, List[Tuple[int, int]]], kmers: np.ndarray
+) -> Dict[Tuple[str, str], tuple]:
+    """Look up the positions of all seeds in a template index.
+
+    Returns the same as `_scan_template` for every indexed template, by the
+    template's ID and sequence hash. The positions are slices of the
+    memory-mapped index, taken per template and seed.
+    """
+    with open(os.path.join(index_dir, INDEX_RECORDS)) as fh:
+        records = [tuple(line.rstrip("\n").split("\t")) for line in fh]
+    hits = defaultdict(lambda: defaultdict(list))
+
+    codes = np.load(os.path.join(index_dir, INDEX_KMERS), mmap_mode="r")
+    templates = np.load(os.path.join(index_dir, INDEX_TEMPLATES), mmap_mode="r")
+    positions = np.load(os.path.join(index_dir, INDEX_POSITIONS), mmap_mode="r")
+    starts = np.searchsorted(codes, kmers, side="left")
+    ends = np.searchsorted(codes, kmers, side="right")
+    for code, start, end in zip(kmers.tolist(), starts.tolist(), ends.tolist()):
+        # the occurrences of a k-mer are in template order
+        for template, found in _group_rows(templates[start:end], positions[start:end]):
+            for key in seeds[code]:
+                hits[template][key].append(found)
+
+    ambiguous = np.load(os.path.join(index_dir, INDEX_AMBIGUOUS), mmap_mode="r")
+    runs = dict(_group_rows(ambiguous[:, 0], ambiguous[:, 1:]))
+    empty = np.zeros((0, 2), dtype=np.int64)
+    return {
+        record: (hits.get(i, {}), runs.get(i, empty))
+        for i, record in enumerate(records)
+    }
+
+
+def _group_rows(
+    keys: np.ndarray, values: np.ndarray
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """Split `values` by their sorted `keys` into (key, slice) pairs."""
+    unique, first = np.unique(keys, return_index=True)
+    bounds = np.append(first, len(keys)).tolist()
+    for i, key in enumerate(unique.tolist()):
+        yield key, values[bounds[i] : bounds[i + 1]].astype(np.int64)
+
+
+def _positions(hits: Dict[Tuple[int, int], List[np.ndarray]], key) -> np.ndarray:
+    return np.sort(np.concatenate(hits.get(key, []) + [np.zeros(0, dtype=np.int64)]))
+
+
+def _any_in_range(positions: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> bool:
+    """Whether any of the sorted `positions` is within any [lo, hi]."""
+    first = np.searchsorted(positions, lo)
+    in_range = first < len(positions)
+    return bool(np.any(positions[first[in_range]] <= hi[in_range]))
+
+
+def _any_run_in_range(runs: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> bool:
+    """Whether any of the sorted, disjoint `runs` overlaps any [lo, hi]."""
+    first = np.searchsorted(runs[:, 1], lo, side="right")
+    in_range = first < len(runs)
+    return bool(np.any(runs[first[in_range], 0] <= hi[in_range]))
+
+
+def _can_amplify(
+    hits: Dict[Tuple[int, int], List[np.ndarray]],
+    runs: np.ndarray,
+    experiments: List[List[str]],
+    slack: int,
+) -> bool:
+    """Whether any experiment has an upstream and a downstream seed in range.
+
+    A downstream seed is in range of an upstream seed at `u` if it lies
+    within [u - slack, u + maximum product length + slack]. A run of
+    ambiguous k-mers may stand in for the seed of either side, but not for
+    both: two runs only make a pair if they are different runs.
+    """
+    for experiment, row in enumerate(experiments):
+        reach = int(row[4]) + slack
+        upstream = _positions(hits, (experiment, 0))
+        downstream = _positions(hits, (experiment, 1))
+        if (
+            _any_in_range(downstream, upstream - slack, upstream + reach)
+            or _any_run_in_range(runs, upstream - slack, upstream + reach)
+            or _any_run_in_range(runs, downstream - reach, downstream + slack)
+            # the gap between neighbouring runs is the shortest between any
+            or np.any(runs[1:, 0] - (runs[:-1, 1] - 1) <= reach)
+        ):
+            return True
+    return False
+
+
+def _prefilter_templates(
+    templates_fp: str,
+    experiments_fp: str,
+    mismatch: int,
+    out_fp: str,
+    template_index: Optional[str] = None,
+) -> Optional[int]:
+    """Copy the templates which any experiment could possibly amplify.
+
+    Every site a primer matches with at most `mismatch` mismatches contains
+    an exact seed of the primer (see `_seed_size`). A template is kept if
+    it has, for any experiment, a seed binding upstream and one binding
+    downstream of a product no further apart than the experiment's maximum
+    product length (plus the length of the longest primer, as seeds can lie
+    anywhere within their primers). Ambiguous template bases are assumed to
+    match any seed, so no template which ipcress could amplify is dropped;
+    a single run of them only stands in for one side of a product though
+    (see `_can_amplify`).
+
+    The seeds of templates found in `template_index` (by ID and sequence)
+    are looked up in the index instead of scanning the templates, provided
+    that the index' k-mers are not longer than the seeds.
+
+    Returns the number of templates which were kept, or None if the primers
+    are too short or too degenerate for the prefilter to be of any use - in
+    that case no file is written.
+    """
+    experiments = _read_experiments(experiments_fp)
+    k = _seed_size(experiments, mismatch)
+    if template_index is not None and _index_size(template_index) > k:
+        logger.warning(
+            "The template index of %d-mers is not used: with %d mismatches, "
+            "the primers only contain exact seeds of %d bases, so an index "
+            "with k <= %d is needed%s.",
+            _index_size(template_index),
+            mismatch,
+            k,
+            k,
+            "" if k >= MIN_K else f" (but at least {MIN_K} to prefilter at all)",
+        )
+        template_index = None
+    elif template_index is not None:
+        k = _index_size(template_index)
+    if k < MIN_K:
+        return None
+    seeds = _build_seed_index(experiments, mismatch, k)
+    if seeds is None:
+        return None
+    kmers = np.sort(np.fromiter(seeds, dtype=np.int64, count=len(seeds)))
+    slack = max(len(primer) for row in experiments for primer in row[1:3])
+    indexed = {}
+    if template_index is not None:
+        indexed = _lookup_template_index(template_index, seeds, kmers)
+
+    # templates are streamed rather than held in memory: they are hashed
+    # (to be found in the index) and scanned first and then copied
+    records = _hash_records(templates_fp) if indexed else None
+    keep = []
+    for i, (header, seq) in enumerate(_stream_fasta_records(templates_fp)):
+        found = None
+        if indexed:
+            found = indexed.get((records[i][0], records[i][2]))
+        if found is None:
+            found = _scan_template(seq, k, seeds, kmers)
+        keep.append(_can_amplify(*found, experiments, slack))
+
+    with open(out_fp, "w") as fh:
+        for kept, (header, seq) in zip(keep, _stream_fasta_records(templates_fp)):
+            if kept:
+                fh.write(header)
+                fh.writelines(seq)
+    return sum(keep)
@@ -0,0 +1,222 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import math
+import signal
+import subprocess
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from q2_exonerate._sharding import (
+    IUPAC_BASES,
+    _read_experiments,
+    _stream_fasta_records,
+)
+
+# memory (MB) used by an ipcress process on top of its FSM and the sequence
+IPCRESS_BASE_MEMORY = 16
+# rough size of a single FSM state in bytes
+FSM_STATE_SIZE = 64
+
+IUPAC_DEGENERACY = {code: len(bases) for code, bases in IUPAC_BASES.items()}
+
+
+def _estimate_fsm_memory(experiments_fp: str, seed: int, mismatch: int) -> int:
+    """Estimate the memory (MB) ipcress needs to hold the FSM of a panel.
+
+    Every primer contributes one word per variant of its seed, i.e. per
+    combination of degenerate bases and of up to `mismatch` substitutions,
+    on both strands. The estimate is deliberately rough: it is only used
+    to avoid reserving more memory than a panel can possibly use.
+    """
+    states = 0
+    for row in _read_experiments(experiments_fp):
+        for primer in row[1:3]:
+            length = len(primer) if seed == 0 else min(seed, len(primer))
+            degeneracy = math.prod(
+                IUPAC_DEGENERACY.get(base, 4) for base in primer[-length:].upper()
+            )
+            variants = sum(
+                math.comb(length, k) * 3**k for k in range(min(mismatch, length) + 1)
+            )
+            states += 2 * degeneracy * variants * length
+    return max(1, math.ceil(states * FSM_STATE_SIZE / 2**20))
+
+
+def _longest_template(templates_fp: str) -> int:
+    return max(
+        (
+            sum(len(line.rstrip()) for line in seq)
+            for _, seq in _stream_fasta_records(templates_fp)
+        ),
+        default=0,
+    )
+
+
+def _plan_memory(
+    budget: int, n_jobs: int, memory: int, fsm_memory: int, overhead: int
+) -> Tuple[int, int]:
+    """Work out the number of workers and the `-M` of every worker.
+
+    Each worker needs `overhead` MB plus its FSM memory. The FSM limit
+    never exceeds `memory` nor what the panel is estimated to need; as
+    many workers (up to `n_jobs`) as fit into `budget` are started, and
+    if not even one worker fits with the full FSM, a single worker gets
+    what is left - ipcress then builds its FSM in several passes.
+    """
+    per_worker = min(memory, fsm_memory)
+    if budget < overhead + 1:
+        raise ValueError(
+            f"The memory budget of {budget} MB is too small to run ipcress, "
+            f"which is expected to need at least {overhead + 1} MB."
+        )
+    workers = max(1, min(n_jobs, budget // (overhead + per_worker)))
+    return workers, max(1, min(per_worker, budget // workers - overhead))
+
+
+def _is_oom_kill(error: BaseException) -> bool:
+    """Whether a worker seems to have been killed for running out of memory."""
+    if isinstance(error, BrokenProcessPool):
+        return True
+    return isinstance(error, subprocess.CalledProcessError) and error.returncode in (
+        -signal.SIGKILL,
+        128 + signal.SIGKILL,
+    )
+
+
+class _Task(NamedTuple):
+    """A unit of work, or a part of one after it was split by a retry."""
+
+    unit: int
+    part: Tuple[int, ...]
+    kwargs: dict
+    memory: Optional[int]
+    retries: int
+
+
+def _retry_task(
+    task: _Task, error: Exception, memory: int, split: Optional[Callable]
+) -> List[_Task]:
+    """The tasks to run instead of a failed `task`, or raise `error`.
+
+    A task which timed out is split in halves. Any other failure is first
+    retried with half the FSM memory limit; once that is down to 1 MB the
+    task is split as well. Every retry uses up one of the task's retries.
+    """
+    if task.retries == 0:
+        raise error
+    memory = _task_memory(task, memory)
+    if not isinstance(error, subprocess.TimeoutExpired) and memory > 1:
+        return [task._replace(memory=memory // 2, retries=task.retries - 1)]
+    halves = split(task.kwargs) if split is not None else None
+    if not halves:
+        raise error
+    return [
+        _Task(task.unit, task.part + (i,), half, task.memory, task.retries - 1)
+        for i, half in enumerate(halves)
+    ]
+
+
+def _task_memory(task: _Task, memory: int) -> int:
+    return memory if task.memory is None else min(task.memory, memory)
+
+
+def _run_scheduled(
+    fn: Callable,
+    units: List[dict],
+    n_jobs: int,
+    memory: int,
+    on_done: Optional[Callable] = None,
+    retries: int = 0,
+    split: Optional[Callable] = None,
+) -> list:
+    """Run `fn(**unit, memory=memory)` for every unit on up to `n_jobs` workers.
+
+    When a worker is killed for running out of memory, no new units are
+    started until the running ones finish; the number of concurrent
+    workers is then halved and the failed units are run again. Once only
+    a single worker is left, the unit is retried like any other failure.
+
+    Any other failure of a unit, e.g. a timeout or a crash, is retried up
+    to `retries` times (see `_retry_task`) while the other units carry on;
+    `split(unit)` cuts a unit in halves, or returns None if it cannot.
+
+    Returns the results of all units in their original order, where a unit
+    which was split contributes the results of its parts in their order.
+    `on_done` is called with the index of every unit and the list of the
+    results of its parts once all of them are finished.
+    """
+    parts = [{} for _ in units]
+    remaining = [1] * len(units)
+    pending = [_Task(i, (), unit, None, retries) for i, unit in enumerate(units)]
+    workers = min(n_jobs, len(units))
+
+    def _finish(task: _Task, result):
+        parts[task.unit][task.part] = result
+        remaining[task.unit] -= 1
+        if remaining[task.unit] == 0 and on_done is not None:
+            on_done(task.unit, _in_order(parts[task.unit]))
+
+    def _retry(task: _Task, error: Exception, memory: int):
+        tasks = _retry_task(task, error, memory, split)
+        remaining[task.unit] += len(tasks) - 1
+        pending[:0] = tasks
+
+    if n_jobs == 1:
+        while pending:
+            task = pending.pop(0)
+            try:
+                result = fn(**task.kwargs, memory=_task_memory(task, memory))
+            except Exception as e:
+                _retry(task, e, memory)
+                continue
+            _finish(task, result)
+        return [result for unit in parts for result in _in_order(unit)]
+
+    while pending:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        running = {}
+        oom = False
+        try:
+            while pending or running:
+                while pending and len(running) < workers and not oom:
+                    task = pending.pop(0)
+                    future = executor.submit(
+                        fn, **task.kwargs, memory=_task_memory(task, memory)
+                    )
+                    running[future] = task
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        if _is_oom_kill(e) and workers > 1:
+                            pending.insert(0, task)
+                            oom = True
+                        else:
+                            _retry(task, e, memory)
+                        continue
+                    _finish(task, result)
+                if oom and not running:
+                    break
+        finally:
+            # shutdown(cancel_futures=True) is only available from Python 3.9
+            for future in running:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        if oom:
+            workers = max(1, workers // 2)
+    return [result for unit in parts for result in _in_order(unit)]
+
+
+def _in_order(parts: dict) -> list:
+    return [parts[part] for part in sorted(parts)]
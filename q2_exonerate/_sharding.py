@@ -0,0 +1,267 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import heapq
+import itertools
+import os
+import tempfile
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from q2_exonerate.utils import STREAM_CHUNK_SIZE
+
+# the nucleotides every IUPAC code in a primer stands for
+IUPAC_BASES = {
+    "A": "A",
+    "C": "C",
+    "G": "G",
+    "T": "T",
+    "U": "T",
+    "R": "AG",
+    "Y": "CT",
+    "S": "CG",
+    "W": "AT",
+    "K": "GT",
+    "M": "AC",
+    "B": "CGT",
+    "D": "AGT",
+    "H": "ACT",
+    "V": "ACG",
+    "N": "ACGT",
+}
+
+
+def _fasta_id(header: str) -> str:
+    return header[1:].split(None, 1)[0]
+
+
+def _iter_fasta_records(fp: str) -> Iterator[Tuple[str, List[str]]]:
+    """Yield (header, sequence lines) for every record of a FASTA file.
+
+    Lines are returned verbatim (including line endings) so that records
+    can be copied to another file without re-formatting.
+    """
+    header, seq = None, []
+    with open(fp) as fh:
+        for line in fh:
+            if not line.endswith("\n"):
+                line += "\n"
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, seq
+                header, seq = line, []
+            elif header is not None:
+                seq.append(line)
+    if header is not None:
+        yield header, seq
+
+
+def _stream_fasta_records(fp: str) -> Iterator[Tuple[str, Iterator[str]]]:
+    """Like `_iter_fasta_records`, but yield the sequence lines lazily.
+
+    The lines of a record are read from the file as they are consumed, so
+    that not even a chromosome-sized template is ever held in memory. They
+    must be consumed before the next record is requested; any lines left
+    over are skipped.
+    """
+    records = 0
+
+    def _record(line: str) -> int:
+        nonlocal records
+        records += line.startswith(">")
+        return records
+
+    with open(fp) as fh:
+        for record, lines in itertools.groupby(fh, _record):
+            if record:
+                yield _terminated(next(lines)), map(_terminated, lines)
+
+
+def _terminated(line: str) -> str:
+    return line if line.endswith("\n") else line + "\n"
+
+
+def _sequence_blocks(
+    lines: Iterable[str], size: int, overlap: int = 0
+) -> Iterator[Tuple[int, bytes]]:
+    """Join sequence lines into blocks of `size` bases at a time.
+
+    Every block is extended by the first `overlap` bases of the next one,
+    so that all k-mers (with `overlap` = k - 1) lie within a block; blocks
+    which would only consist of such an overlap are left out. Yields every
+    block with its offset in the sequence.
+    """
+    buffer, offset = bytearray(), 0
+    for line in lines:
+        buffer += line.strip().encode()
+        while len(buffer) >= size + overlap:
+            yield offset, bytes(buffer[: size + overlap])
+            del buffer[:size]
+            offset += size
+    if len(buffer) > overlap:
+        yield offset, bytes(buffer)
+
+
+def _read_experiments(experiments_fp: str) -> List[List[str]]:
+    """Read the rows of an ipcress experiment file."""
+    with open(experiments_fp) as fh:
+        return [line.split() for line in fh if line.strip()]
+
+
+def _max_product_length(experiments_fp: str) -> int:
+    return max(int(row[4]) for row in _read_experiments(experiments_fp))
+
+
+def _batch_experiments(experiments_fp: str, batch_size: int, out_dir: str) -> List[str]:
+    """Split an ipcress experiment file into files of `batch_size` rows."""
+    rows = _read_experiments(experiments_fp)
+    paths = []
+    for i in range(0, len(rows), batch_size):
+        fp = os.path.join(out_dir, f"experiments_{len(paths)}.ipcress")
+        _write_experiments(rows[i : i + batch_size], fp)
+        paths.append(fp)
+    return paths
+
+
+def _write_experiments(rows: List[List[str]], experiments_fp: str):
+    with open(experiments_fp, "w") as fh:
+        fh.writelines(" ".join(row) + "\n" for row in rows)
+
+
+def _template_ranks(templates_fp: str) -> Dict[str, int]:
+    """Map every template ID to its position in a FASTA file."""
+    ranks = {}
+    with open(templates_fp) as fh:
+        for line in fh:
+            if line.startswith(">"):
+                ranks[_fasta_id(line)] = len(ranks)
+    return ranks
+
+
+def _template_descriptions(templates_fp: str) -> Dict[str, str]:
+    """Map every template ID with a description in a FASTA file to the latter."""
+    descriptions = {}
+    with open(templates_fp) as fh:
+        for line in fh:
+            if line.startswith(">"):
+                fields = line[1:].split(None, 1)
+                if len(fields) == 2:
+                    descriptions[fields[0]] = fields[1].strip()
+    return descriptions
+
+
+def _pack_shards(sizes: List[int], n_shards: int) -> List[int]:
+    """Assign items to shards using longest-processing-time-first packing.
+
+    Items are placed from the largest to the smallest, each one on the
+    currently least loaded shard. Returns the shard index of every item.
+    """
+    loads = [(0, i) for i in range(n_shards)]
+    assignment = [0] * len(sizes)
+    for item in sorted(range(len(sizes)), key=lambda i: (-sizes[i], i)):
+        load, shard = heapq.heappop(loads)
+        assignment[item] = shard
+        heapq.heappush(loads, (load + sizes[item], shard))
+    return assignment
+
+
+def _window_starts(length: int, window: int, overlap: int) -> List[int]:
+    """Start offsets of windows of size `window` overlapping by `overlap`."""
+    return list(range(0, max(length - overlap, 1), window - overlap))
+
+
+def _shard_templates(
+    templates_fp: str,
+    n_shards: int,
+    out_dir: str,
+    overlap: Optional[int] = None,
+    max_shard_size: Optional[int] = None,
+) -> Tuple[List[str], Dict[str, int], Dict[str, Tuple[str, int]]]:
+    """Split a FASTA file into at most `n_shards` files of similar size.
+
+    Templates are distributed over the shards by their length in base
+    pairs using longest-processing-time-first bin packing, which keeps a
+    few very long templates from turning a single shard into a straggler.
+
+    If `overlap` is given, templates longer than the ideal shard size are
+    additionally cut into windows which overlap by `overlap` bases - this
+    should be the largest product length, so that every product is fully
+    contained in at least one window.
+
+    If `max_shard_size` (bp) is given, as many more shards are made as are
+    needed to keep the shards below that size, as far as the templates (or
+    windows) allow.
+
+    Returns the paths of the non-empty shards, a mapping of every template
+    (and window) ID to the position of its template in the original file
+    and a mapping of every window ID to its template ID and offset.
+    """
+    ids, sizes = [], []
+    for header, seq in _stream_fasta_records(templates_fp):
+        ids.append(_fasta_id(header))
+        sizes.append(sum(len(line.rstrip()) for line in seq))
+    ranks = {_id: i for i, _id in enumerate(ids)}
+    if max_shard_size is not None:
+        n_shards = max(n_shards, -(-sum(sizes) // max_shard_size))
+
+    window = None
+    if overlap is not None and ids:
+        window = max(-(-sum(sizes) // n_shards), 2 * overlap, 1)
+
+    # every unit of work is a template or a window: (record, start, end)
+    units = []
+    for i, size in enumerate(sizes):
+        if window is not None and size > window:
+            units.extend(
+                (i, start, start + window)
+                for start in _window_starts(size, window, overlap)
+            )
+        else:
+            units.append((i, 0, None))
+    assignment = _pack_shards(
+        [(end or sizes[i]) - start for i, start, end in units], n_shards
+    )
+
+    paths = [os.path.join(out_dir, f"shard_{i}.fasta") for i in range(n_shards)]
+    handles = [open(fp, "w") for fp in paths]
+    windows = {}
+    try:
+        unit = 0
+        for i, (header, seq) in enumerate(_stream_fasta_records(templates_fp)):
+            if units[unit][2] is None:
+                fh = handles[assignment[unit]]
+                fh.write(header)
+                fh.writelines(seq)
+                unit += 1
+                continue
+
+            description = header[1:].split(None, 1)[1:]
+            # the windows are cut from a copy of the sequence on disk
+            with tempfile.TemporaryFile(dir=out_dir) as spool:
+                length = 0
+                for line in seq:
+                    length += spool.write(line.rstrip().encode())
+                while unit < len(units) and units[unit][0] == i:
+                    _, start, end = units[unit]
+                    window_id = f"{ids[i]}:window:{start}"
+                    windows[window_id] = (ids[i], start)
+                    ranks[window_id] = i
+                    fh = handles[assignment[unit]]
+                    fh.write(" ".join([f">{window_id}", *description]).rstrip() + "\n")
+                    spool.seek(start)
+                    remaining = min(end, length) - start
+                    while remaining > 0:
+                        chunk = spool.read(min(remaining, STREAM_CHUNK_SIZE))
+                        fh.write(chunk.decode())
+                        remaining -= len(chunk)
+                    fh.write("\n")
+                    unit += 1
+    finally:
+        for fh in handles:
+            fh.close()
+
+    used = sorted(set(assignment))
+    return [paths[i] for i in used], ranks, windows
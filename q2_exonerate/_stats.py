@@ -0,0 +1,223 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Iterable, Iterator, Optional
+
+logger = logging.getLogger("q2_exonerate.stats")
+progress_logger = logging.getLogger("q2_exonerate.progress")
+
+# ru_maxrss is given in bytes on macOS and in kilobytes everywhere else
+RSS_UNIT = 2**20 if sys.platform == "darwin" else 2**10
+
+
+def _peak_rss(who: int = resource.RUSAGE_SELF) -> float:
+    return resource.getrusage(who).ru_maxrss * RSS_UNIT / 2**20
+
+
+def _cpu_time(who: int) -> float:
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+class RunStats:
+    """Wall time and CPU time of every stage of a run, and its peak RSS.
+
+    Stages are nested: time is always charged to the innermost stage which
+    is running, so that the stages of a streaming pipeline, which take
+    turns producing every item, are timed separately. Pipeline stages are
+    timed by wrapping their iterators (`iterate`), all others with `stage`;
+    time outside of any stage is charged to "other". The peak RSS is only
+    reported for the whole run: the process' high-water mark cannot be
+    told apart by stage when stages take turns on every item. Child
+    processes (ipcress) are accounted for as a whole, once they have
+    been waited for: their CPU time is that of the run, but their peak RSS
+    is that of the largest child this process has ever waited for, which
+    may belong to an earlier run (hence "lifetime_peak_rss_mb").
+
+    While a run is in progress (`progress`), its counters, the stage it is
+    in and any watched values (`watch`) are logged at regular intervals.
+    """
+
+    def __init__(self, **info):
+        self.info = info
+        self.stages = defaultdict(lambda: defaultdict(float))
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self._stack = ["other"]
+        self._start = self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._children_cpu = _cpu_time(resource.RUSAGE_CHILDREN)
+
+    def _switch(self):
+        """Charge the time since the last switch to the running stage."""
+        wall, cpu = time.perf_counter(), time.process_time()
+        stage = self.stages[self._stack[-1]]
+        stage["wall_s"] += wall - self._wall
+        stage["cpu_s"] += cpu - self._cpu
+        self._wall, self._cpu = wall, cpu
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        self._switch()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._switch()
+            self._stack.pop()
+
+    def count(self, counter: str, n: int = 1):
+        self.counters[counter] += n
+
+    def iterate(
+        self,
+        name: str,
+        iterable: Iterable,
+        counter: Optional[str] = None,
+        weigh: Optional[Callable] = None,
+    ) -> Iterator:
+        """Time the production of every item of `iterable` as stage `name`.
+
+        Items are also counted by `counter`, one each or by their `weigh`.
+        """
+        iterator, stack = iter(iterable), self._stack
+        while True:
+            self._switch()
+            stack.append(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._switch()
+                stack.pop()
+            if counter is not None:
+                self.counters[counter] += weigh(item) if weigh else 1
+            yield item
+
+    @contextmanager
+    def watch(self, name: str, gauge: Callable[[], float]) -> Iterator[None]:
+        """Report the value of `gauge()` as `name` with the progress meanwhile."""
+        self.gauges[name] = gauge
+        try:
+            yield
+        finally:
+            del self.gauges[name]
+
+    def snapshot(self) -> dict:
+        """The progress of the run so far; safe to call from any thread."""
+        gauges = {}
+        for name, gauge in list(self.gauges.items()):
+            try:
+                gauges[name] = gauge()
+            except OSError:
+                pass
+        return {
+            "elapsed_s": round(time.perf_counter() - self._start, 3),
+            "stage": self._stack[-1],
+            **self.counters.copy(),
+            **gauges,
+        }
+
+    @contextmanager
+    def progress(self, interval: Optional[float]) -> Iterator[None]:
+        """Log a snapshot every `interval` seconds until the block is left."""
+        if interval is None:
+            yield
+            return
+        stopped = threading.Event()
+
+        def report():
+            while not stopped.wait(interval):
+                progress_logger.info(json.dumps(self.snapshot()))
+
+        reporter = threading.Thread(target=report, name="progress", daemon=True)
+        reporter.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            reporter.join()
+
+    def summary(self) -> dict:
+        self._switch()
+        wall = time.perf_counter() - self._start
+        products = self.counters.get("products", 0)
+        return {
+            **self.info,
+            "wall_s": round(wall, 6),
+            "cpu_s": round(sum(s["cpu_s"] for s in self.stages.values()), 6),
+            "peak_rss_mb": round(_peak_rss(), 1),
+            **self.counters,
+            "products_per_s": round(products / wall, 1) if wall else None,
+            "stages": {
+                name: {field: round(value, 6) for field, value in stage.items()}
+                for name, stage in self.stages.items()
+            },
+            "children": {
+                "cpu_s": round(
+                    _cpu_time(resource.RUSAGE_CHILDREN) - self._children_cpu, 6
+                ),
+                "lifetime_peak_rss_mb": round(_peak_rss(resource.RUSAGE_CHILDREN), 1),
+            },
+        }
+
+    def log(self, fp: Optional[str] = None):
+        """Log the summary as JSON and append it to the JSON lines file `fp`."""
+        line = json.dumps(self.summary())
+        logger.info(line)
+        if fp is not None:
+            with open(fp, "a") as fh:
+                fh.write(line + "\n")
+
+
+class _NoStats(RunStats):
+    """Collects nothing, so that stats cost nothing unless they are used."""
+
+    def __init__(self):
+        pass
+
+    def stage(self, name: str):
+        return nullcontext()
+
+    def count(self, counter, n=1):
+        pass
+
+    def iterate(self, name, iterable, counter=None, weigh=None):
+        return iterable
+
+    def watch(self, name, gauge):
+        return nullcontext()
+
+    def progress(self, interval):
+        return nullcontext()
+
+    def log(self, fp=None):
+        pass
+
+
+NO_STATS = _NoStats()
+
+
+def _run_stats(
+    fp: Optional[str], progress_interval: Optional[float] = None, **info
+) -> RunStats:
+    """Collect stats if they are written to `fp` or logged, or the progress is."""
+    reported = progress_interval is not None and progress_logger.isEnabledFor(
+        logging.INFO
+    )
+    if fp is None and not logger.isEnabledFor(logging.INFO) and not reported:
+        return NO_STATS
+    return RunStats(**info)
@@ -0,0 +1,83 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import pickle
+import tempfile
+from typing import Iterable, Iterator, List, Optional
+
+from q2_exonerate.utils import STREAM_CHUNK_SIZE
+
+# approximate size of a product without its ID and sequence, in bytes
+PRODUCT_OVERHEAD = 1024
+
+
+def _product_size(product: dict) -> int:
+    return PRODUCT_OVERHEAD + len(product["id"]) + len(product["sequence"])
+
+
+def _to_columns(products: List[dict]) -> dict:
+    return {field: [product[field] for product in products] for field in products[0]}
+
+
+def _from_columns(columns: dict) -> Iterator[dict]:
+    fields = list(columns)
+    for values in zip(*columns.values()):
+        yield dict(zip(fields, values))
+
+
+class ProductStore:
+    """A sequence of products which spills to disk beyond a memory limit.
+
+    Products are kept in memory until their (approximate) size exceeds
+    `max_memory` bytes; they are then appended to a temporary file in
+    `directory` as a batch of columns, i.e. one list per product field.
+    Iterating over the store reads the batches back one at a time, so
+    consuming it takes no more memory than filling it. Stores can be
+    pickled, e.g. to be returned by a worker process, as long as the
+    directory is kept.
+    """
+
+    def __init__(self, directory: str, max_memory: Optional[int] = None):
+        self.directory = directory
+        self.max_memory = max_memory
+        self.spill_fp = None
+        self.batches = 0
+        self._products, self._size, self._length = [], 0, 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def extend(self, products: Iterable[dict]) -> "ProductStore":
+        for product in products:
+            self._products.append(product)
+            self._length += 1
+            if self.max_memory is not None:
+                self._size += _product_size(product)
+                if self._size > self.max_memory:
+                    self._spill()
+        return self
+
+    def _spill(self):
+        if self.spill_fp is None:
+            fd, self.spill_fp = tempfile.mkstemp(
+                prefix="products-", suffix=".pkl", dir=self.directory
+            )
+            os.close(fd)
+        with open(self.spill_fp, "ab") as fh:
+            pickle.dump(
+                _to_columns(self._products), fh, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        self.batches += 1
+        self._products, self._size = [], 0
+
+    def __iter__(self) -> Iterator[dict]:
+        if self.spill_fp is not None:
+            with open(self.spill_fp, "rb", buffering=STREAM_CHUNK_SIZE) as fh:
+                for _ in range(self.batches):
+                    yield from _from_columns(pickle.load(fh))
+        yield from self._products
@@ -0,0 +1,71 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import hashlib
+from collections import defaultdict
+
+import biom
+import pandas as pd
+from q2_types.feature_data import DNAFASTAFormat
+from scipy.sparse import coo_matrix
+
+from q2_exonerate._sharding import _fasta_id, _iter_fasta_records
+from q2_exonerate.ipcress import _template_id
+from q2_exonerate.utils import STREAM_CHUNK_SIZE
+
+MISSING_PRODUCTS_ERROR = (
+    "{} products could not be found in the product metadata, e.g.: {}. Make "
+    "sure that the products and their metadata come from the same run."
+)
+
+
+def _product_groups(product_metadata: pd.DataFrame, group_by: str) -> dict:
+    """Map the FASTA IDs of products (up to their filter) to their group."""
+    if group_by == "template":
+        groups = [_template_id(target) for target in product_metadata["target"]]
+    else:
+        groups = product_metadata[group_by].astype(str).tolist()
+    ids = product_metadata.index.str.replace(" ", "_", regex=False)
+    return dict(zip(ids, groups))
+
+
+def dereplicate_products(
+    products: DNAFASTAFormat,
+    product_metadata: pd.DataFrame,
+    group_by: str = "template",
+) -> (DNAFASTAFormat, biom.Table):
+    groups = _product_groups(product_metadata, group_by)
+
+    amplicons = DNAFASTAFormat()
+    counts, missing = defaultdict(int), []
+    features, samples = {}, {}
+    with open(str(amplicons), "w", buffering=STREAM_CHUNK_SIZE) as fh:
+        for header, seq in _iter_fasta_records(str(products)):
+            product_id = _fasta_id(header)
+            group = groups.get(product_id.split(":filter", 1)[0])
+            if group is None:
+                missing.append(product_id)
+                continue
+            sequence = "".join(line.strip() for line in seq)
+            feature = hashlib.md5(sequence.encode()).hexdigest()
+            if feature not in features:
+                features[feature] = len(features)
+                fh.write(f">{feature}\n{sequence}\n")
+            sample = samples.setdefault(group, len(samples))
+            counts[features[feature], sample] += 1
+
+    if missing:
+        raise ValueError(
+            MISSING_PRODUCTS_ERROR.format(len(missing), ", ".join(missing[:3]))
+        )
+
+    rows, cols = zip(*counts) if counts else ((), ())
+    data = coo_matrix(
+        (list(counts.values()), (rows, cols)), shape=(len(features), len(samples))
+    )
+    table = biom.Table(data, observation_ids=list(features), sample_ids=list(samples))
+    return amplicons, table
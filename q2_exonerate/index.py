@@ -0,0 +1,19 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+from q2_types.feature_data import DNAFASTAFormat
+
+from q2_exonerate._prefilter import _build_template_index
+from q2_exonerate.types._format import IPCRessTemplateIndexDirFmt
+
+
+def build_template_index(
+    templates: DNAFASTAFormat, k: int = 12
+) -> IPCRessTemplateIndexDirFmt:
+    index = IPCRessTemplateIndexDirFmt()
+    _build_template_index(str(templates), k, str(index))
+    return index
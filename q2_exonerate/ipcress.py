@@ -5,112 +5,1306 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
-from typing import List
+import functools
+import heapq
+import itertools
+import math
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+from collections import defaultdict
+from typing import (
+    BinaryIO,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
+import numpy as np
 import pandas as pd
-import skbio
+from pandas.api.types import union_categoricals
 from q2_types.feature_data import DNAFASTAFormat
-from skbio import DNA
 
-from q2_exonerate.types._format import IPCRessExperimentFormat
-from q2_exonerate.utils import run_command
+from q2_exonerate import __version__
+from q2_exonerate._cache import (
+    ResultCache,
+    _cache_key,
+    _hash_file,
+    _hash_records,
+    _ipcress_version,
+)
+from q2_exonerate._native import _format_matches, _run_native
+from q2_exonerate._prefilter import _prefilter_templates
+from q2_exonerate._scheduling import (
+    IPCRESS_BASE_MEMORY,
+    _estimate_fsm_memory,
+    _longest_template,
+    _plan_memory,
+    _run_scheduled,
+)
+from q2_exonerate._sharding import (
+    _batch_experiments,
+    _max_product_length,
+    _read_experiments,
+    _shard_templates,
+    _stream_fasta_records,
+    _template_descriptions,
+    _template_ranks,
+    _write_experiments,
+)
+from q2_exonerate._stats import NO_STATS, RunStats, _run_stats
+from q2_exonerate._store import ProductStore, _from_columns, _to_columns
+from q2_exonerate.types._format import (
+    IPCRessExperimentFormat,
+    IPCRessTemplateIndexDirFmt,
+)
+from q2_exonerate.utils import (
+    STREAM_CHUNK_SIZE,
+    run_command_to_file,
+    stream_command,
+)
 
+CACHED_PRODUCTS = "products.fasta"
+CACHED_METADATA = "metadata.pkl"
+CACHED_EXPERIMENT = "products.pkl"
+CACHED_EXPERIMENT_INDEX = "templates.pkl"
+CHECKPOINT_PRODUCTS = "products.pkl"
+CHECKPOINT_BATCH_SIZE = 2**16
+# largest number of bases searched by a single checkpointed process
+CHECKPOINT_SHARD_SIZE = 2**25
 
-def _dump_seqs_to_file(products: List[dict]) -> DNAFASTAFormat:
+NO_HITS_ERROR = (
+    "No hits were found. Check your inputs, primer sequences, "
+    "and consider adjusting the mismatch tolerance."
+)
+
+
+def _dump_seqs_to_file(
+    products: Iterable[dict], line_width: Optional[int] = None
+) -> DNAFASTAFormat:
     results = DNAFASTAFormat()
-    with open(str(results), "a") as fin:
-        for product in products:
-            seq = DNA(sequence=product["sequence"], metadata={"id": product["id"]})
-            skbio.io.write(seq, format="fasta", into=fin)
+    with open(str(results), "w", buffering=STREAM_CHUNK_SIZE) as fh:
+        for _ in _write_products(products, fh, line_width):
+            pass
     return results
 
 
-def _extract_pcr_meta(products: List[dict]) -> pd.DataFrame:
-    meta = pd.DataFrame.from_records(products)
-    meta["id"] = meta["id"].apply(lambda x: x.split(":filter")[0])
-    meta["matches_fwd_frac"] = meta["matches_fwd"].apply(_calculate_match_frac)
-    meta["matches_rev_frac"] = meta["matches_rev"].apply(_calculate_match_frac)
-    meta.drop("sequence", axis=1, inplace=True)
-    meta.set_index("id", drop=True, inplace=True)
-    return meta
+def _write_products(
+    products: Iterable[dict], fh, line_width: Optional[int] = None
+) -> Iterator[dict]:
+    """Write products to a FASTA file while passing them through.
 
+    Every product is written as soon as it is received and is then yielded
+    without its sequence, so that the products can be written and their
+    metadata collected in a single pass without keeping the sequences in
+    memory. Whitespace in the IDs is replaced with underscores and the
+    sequences are wrapped at `line_width` characters, if given.
+    """
+    for product in products:
+        product = dict(product)
+        sequence = product.pop("sequence")
+        if line_width:
+            sequence = "\n".join(
+                sequence[i : i + line_width]
+                for i in range(0, len(sequence), line_width)
+            )
+        fh.write(f">{'_'.join(product['id'].split(' '))}\n{sequence}\n")
+        yield product
 
-def _calculate_match_frac(match: str) -> float:
-    match_split = match.split("/")
-    return float(match_split[0]) / float(match_split[1])
 
+_META_COLUMNS = (
+    "experiment",
+    "target",
+    "match_orientation",
+    "matches_fwd",
+    "matches_rev",
+    "length",
+    "range_min",
+    "range_max",
+    "start_position",
+)
+# number of products whose metadata is converted at once
+META_BATCH_SIZE = 2**16
+_CATEGORICAL_COLUMNS = ("experiment", "target", "match_orientation")
+_INTEGER_COLUMNS = ("length", "range_min", "range_max", "start_position")
 
-def _process_one_product(line: List[str]) -> dict:
-    product = {
-        "experiment": line[2].split(":")[-1].strip(),
-        "target": line[4].split("Target:")[-1].strip(),
-        "match_orientation": line[7].split(":")[-1].strip(),
-    }
 
-    matches = line[5].lstrip().split(" ")
-    if product["match_orientation"] == "revcomp":
-        product.update({"matches_fwd": matches[2], "matches_rev": matches[1]})
-    else:
-        product.update({"matches_fwd": matches[1], "matches_rev": matches[2]})
+def _extract_pcr_meta(products: Iterable[dict]) -> pd.DataFrame:
+    """Build the product metadata column by column.
 
-    product_length = line[6].lstrip().split(" ")
-    ranges = product_length[4][:-1].split("-")
-    product.update(
+    The fields of every batch of `META_BATCH_SIZE` products are collected
+    into one list per column and converted with vectorised operations:
+    experiments, targets and orientations become categoricals and lengths
+    and positions integer arrays. Only a single batch of products is held
+    as Python objects at a time. The batches are then concatenated, with
+    lengths and positions as int32 (int64 if they do not fit) and the match
+    fractions as float32.
+    """
+    products = iter(products)
+    batches = []
+    while True:
+        batch = list(itertools.islice(products, META_BATCH_SIZE))
+        if not batch and batches:
+            break
+        batches.append(_meta_batch(batch))
+
+    meta = pd.DataFrame(
         {
-            "length": int(product_length[1]),
-            "range_min": int(ranges[0]),
-            "range_max": int(ranges[1]),
-            "start_position": int(line[16].split("start")[1].strip().split(" ")[0]),
-            "id": line[16].strip()[1:],
-            "sequence": "",
-        }
+            column: _concat_column(column, [batch[column] for batch in batches])
+            for column in _META_COLUMNS
+        },
+        index=pd.Index(np.concatenate([batch["id"] for batch in batches]), name="id"),
     )
+    meta["matches_fwd_frac"] = _calculate_match_frac(meta["matches_fwd"])
+    meta["matches_rev_frac"] = _calculate_match_frac(meta["matches_rev"])
+    return meta
+
+
+def _meta_batch(products: List[dict]) -> Dict[str, object]:
+    ids = pd.Index([product["id"] for product in products], dtype=object)
+    batch = {"id": ids.str.split(":filter", n=1).str[0].to_numpy(dtype=object)}
+    for column in _META_COLUMNS:
+        values = [product[column] for product in products]
+        if column in _CATEGORICAL_COLUMNS:
+            batch[column] = pd.Categorical(values)
+        elif column in _INTEGER_COLUMNS:
+            batch[column] = np.array(values, dtype=np.int64)
+        else:
+            batch[column] = np.array(values, dtype=object)
+    return batch
+
+
+def _concat_column(column: str, batches: list):
+    if column in _CATEGORICAL_COLUMNS:
+        return union_categoricals(batches, sort_categories=True)
+    values = np.concatenate(batches)
+    if column in _INTEGER_COLUMNS and (
+        values.size == 0
+        or (
+            values.min() >= np.iinfo(np.int32).min
+            and values.max() <= np.iinfo(np.int32).max
+        )
+    ):
+        return values.astype(np.int32)
+    return values
+
+
+def _calculate_match_frac(matches: pd.Series) -> pd.Series:
+    """Convert matches given as "<matched>/<total>" into float32 fractions."""
+    parts = matches.str.split("/", n=1, expand=True).astype(np.float32)
+    return (parts[0] / parts[1]).astype(np.float32)
+
+
+# starts of the lines which can follow the sequence of a product
+_SEQUENCE_END = (b"\n\n", b"\nIpcress result", b"\nipcress:", b"\n-- completed")
+
+
+def _parse_pcr_products(
+    chunks: Iterable[bytes], panel: Optional[Dict[str, tuple]] = None
+) -> Iterator[dict]:
+    """Parse ipcress output in a single pass, yielding one product at a time.
+
+    The output can be passed in chunks of any size, e.g. as read from a
+    pipe. Every result is anchored on its machine-readable `ipcress:` line,
+    which provides the experiment, product length and orientation, and on
+    the `>` header of the product directly below it, which provides its ID
+    and start position; the product sequence is made of all the following
+    sequence lines. The target, primer matches and expected length range
+    are taken from the `Target:`, `Matches:` and `Product:` lines of the
+    pretty result. The output is only searched for these anchors and only
+    the fields which are used are decoded.
+
+    Without the pretty output, the primer matches and length range are
+    derived from the summary line and the experiments' `panel` (see
+    `_read_panel`) instead, and the target only consists of the template
+    ID, without its description (see `_describe_targets`).
+    """
+    buffer = b"\n"
+    for chunk in chunks:
+        buffer += chunk
+        consumed = yield from _parse_buffer(buffer, False, panel)
+        # keep the newline preceding the first unparsed line
+        buffer = buffer[consumed:]
+    yield from _parse_buffer(buffer + b"\n", True, panel)
+
+
+def _parse_mapped(
+    output_fp: str, panel: Optional[Dict[str, tuple]] = None
+) -> Iterator[dict]:
+    """Parse ipcress output from a file, like `_parse_pcr_products`.
 
-    for l_ in line[17:]:
-        if not l_ or "completed ipcress analysis" in l_:
+    The file is memory-mapped and searched in place, so only the fields
+    which are used are ever copied out of it. It must start with a newline.
+    """
+    if os.path.getsize(output_fp) == 0:
+        return
+    with open(output_fp, "rb") as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield from _parse_buffer(buffer, True, panel)
+
+
+def _parse_buffer(
+    buffer: bytes, final: bool, panel: Optional[Dict[str, tuple]] = None
+) -> Generator[dict, None, int]:
+    """Parse all complete results in `buffer`, yielding their products.
+
+    Returns the offset up to which the buffer has been consumed, i.e. the
+    newline ending the last complete result. `buffer` can be any object
+    with the `find` method and slicing of bytes, e.g. a memory map.
+    """
+    consumed = 0
+    summary = buffer.find(b"\nipcress:")
+    while summary != -1:
+        header = buffer.find(b"\n", summary + 1)
+        sequence = buffer.find(b"\n", header + 1) if header != -1 else -1
+        if sequence == -1:
             break
-        product["sequence"] += l_
+        fields = buffer[summary + 1 : header].split()
+        end = _find_sequence_end(buffer, sequence, int(fields[3]), final)
+        if end == -1:
+            break
+        yield _make_product(
+            fields,
+            buffer[header + 1 : sequence],
+            buffer[sequence:end],
+            _find_pretty(buffer, consumed, summary),
+            panel,
+        )
+        consumed, summary = end, buffer.find(b"\nipcress:", end)
+    return consumed
 
-    return product
 
+def _find_sequence_end(buffer: bytes, start: int, length: int, final: bool) -> int:
+    """Find the newline ending a product sequence which starts after `start`.
 
-def _process_pcr_products(lines: List[str]) -> list:
-    lines = [line.split("\n") for line in lines if "Experiment" in line]
-    products = [_process_one_product(line) for line in lines]
-    if len(products) == 0:
-        raise ValueError('No hits were found. Check your inputs, primer sequences, '
-                         'and consider adjusting the mismatch tolerance.')
-    return products
+    The sequence is wrapped into lines of equal width, so its end can be
+    computed from the width of its first line and the product length; this
+    is verified against the following line and the sequence is only
+    scanned for its end if this fails (e.g. for an unexpected layout).
+    Returns -1 if the sequence may continue beyond the buffer.
+    """
+    width = buffer.find(b"\n", start + 1) - start - 1
+    if width > 0:
+        end = start + length + -(-length // width)
+        following = buffer[end : end + 2]
+        if following in (b"\n\n", b"\nI", b"\ni", b"\n-"):
+            return end
+        if following == b"\n" and final:
+            return end
 
+    end = -1
+    for terminator in _SEQUENCE_END:
+        pos = buffer.find(terminator, start, end if end != -1 else len(buffer))
+        if pos != -1:
+            end = pos
+    if end == -1 and final:
+        end = len(buffer) - 1
+    return end
 
-def simulate_pcr(
-    templates: DNAFASTAFormat,
-    experiments: IPCRessExperimentFormat,
-    seed: int = 12,
-    memory: int = 32,
-    mismatch: int = 0,
-) -> (DNAFASTAFormat, pd.DataFrame):
-    cmd = [
+
+def _find_pretty(buffer: bytes, start: int, end: int) -> Optional[dict]:
+    """Extract the fields of the pretty result in `buffer[start:end]`, if any."""
+    target = buffer.find(b"Target:", start, end)
+    if target == -1:
+        return None
+    matches = buffer.find(b"Matches:", target, end)
+    length = buffer.find(b"Product:", matches, end)
+    range_start = buffer.find(b"(range ", length, end) + 7
+    return {
+        "target": buffer[target + 7 : buffer.find(b"\n", target, end)].strip(),
+        "matches": buffer[matches + 8 : buffer.find(b"\n", matches, end)].split(),
+        "range": buffer[range_start : buffer.find(b")", range_start, end)].split(b"-"),
+    }
+
+
+def _make_product(
+    summary: List[bytes],
+    header: bytes,
+    sequence: bytes,
+    pretty: Optional[dict],
+    panel: Optional[Dict[str, tuple]] = None,
+) -> dict:
+    # ipcress: <seq> <experiment> <length> <primer> <pos> <mism> <primer> <pos>
+    #          <mism> <orientation>
+    experiment = summary[2].decode()
+    orientation = summary[10].decode()
+    if pretty is not None:
+        target = pretty["target"].decode()
+        match_fwd, match_rev = (match.decode() for match in pretty["matches"])
+        range_min, range_max = (int(x) for x in pretty["range"])
+    else:
+        target = summary[1].decode()
+        primer_lengths, range_min, range_max = panel[experiment]
+        match_fwd, match_rev = (
+            _format_matches(primer_lengths[primer], int(mismatches))
+            for primer, mismatches in (
+                (summary[4], summary[6]),
+                (summary[7], summary[9]),
+            )
+        )
+    if orientation == "revcomp":
+        match_fwd, match_rev = match_rev, match_fwd
+    header = header.rstrip()
+    return {
+        "experiment": experiment,
+        "target": target,
+        "match_orientation": orientation,
+        "matches_fwd": match_fwd,
+        "matches_rev": match_rev,
+        "length": int(summary[3]),
+        "range_min": range_min,
+        "range_max": range_max,
+        "start_position": int(header[header.rfind(b" start ") + 7 :].split()[0]),
+        "id": header[1:].decode(),
+        "sequence": sequence.replace(b"\n", b"").decode(),
+    }
+
+
+def _read_panel(experiments_fp: str) -> Dict[str, tuple]:
+    """Collect what is needed to describe products without the pretty output.
+
+    Maps every experiment ID to the lengths of its primers (by their ipcress
+    names, A and B) and to its minimum and maximum product length.
+    """
+    return {
+        row[0]: ({b"A": len(row[1]), b"B": len(row[2])}, int(row[3]), int(row[4]))
+        for row in _read_experiments(experiments_fp)
+    }
+
+
+def _describe_targets(
+    products: Iterable[dict], descriptions: Dict[str, str]
+) -> Iterator[dict]:
+    """Append the template descriptions to targets which consist of an ID only."""
+    for product in products:
+        target = product["target"]
+        if " " not in target:
+            description = descriptions.get(_template_id(target))
+            if description:
+                product["target"] = f"{target} {description}"
+        yield product
+
+
+def _template_id(target: str) -> str:
+    """Extract the template sequence ID from a product's target field."""
+    seq_id = target.split(" ", 1)[0]
+    return seq_id.rsplit(":filter(", 1)[0] if ":filter(" in seq_id else seq_id
+
+
+def _renumber_products(products: Iterable[dict]) -> Iterator[dict]:
+    """Re-assign the per-experiment product counters in the product IDs.
+
+    ipcress numbers products of every experiment consecutively within a
+    single run; products merged from several runs are renumbered so that
+    their IDs are identical to those a single run would produce.
+    """
+    counts = defaultdict(int)
+    for product in products:
+        counts[product["experiment"]] += 1
+        suffix = product["id"][product["id"].index(" seq ") :]
+        product["id"] = (
+            f"{product['experiment']}_product_{counts[product['experiment']]}"
+            f"{suffix}"
+        )
+        yield product
+
+
+def _unwindow_products(
+    products: Iterable[dict],
+    windows: Dict[str, Tuple[str, int]],
+    experiments: Sequence[str] = (),
+) -> Iterator[dict]:
+    """Map products found on template windows back onto their templates.
+
+    Positions and IDs are translated to template coordinates. Products
+    lying in the overlap of two neighbouring windows are reported twice by
+    ipcress - only the first copy is kept. The products of every windowed
+    template are then put in the order a search of the whole template
+    reports them in: by experiment (in the order of `experiments`) and
+    start position, as a product starting in an overlap may only be found
+    in the later window.
+    """
+    order = {experiment: i for i, experiment in enumerate(experiments)}
+
+    def _sorted(template_products: List[dict]) -> List[dict]:
+        return sorted(
+            template_products,
+            key=lambda product: (
+                order.get(product["experiment"], len(order)),
+                product["start_position"],
+            ),
+        )
+
+    seen, current, buffered = set(), None, []
+    for product in products:
+        window_id = _template_id(product["target"])
+        if window_id not in windows:
+            yield from _sorted(buffered)
+            seen, current, buffered = set(), None, []
+            yield product
+            continue
+
+        template_id, offset = windows[window_id]
+        if template_id != current:
+            yield from _sorted(buffered)
+            seen, current, buffered = set(), template_id, []
+        start = product["start_position"] + offset
+        key = (
+            product["experiment"],
+            start,
+            product["length"],
+            product["match_orientation"],
+        )
+        if key in seen:
+            continue
+        seen.add(key)
+
+        product["target"] = template_id + product["target"][len(window_id) :]
+        product["id"] = (
+            product["id"]
+            .replace(f" seq {window_id}:", f" seq {template_id}:")
+            .replace(f" start {product['start_position']} ", f" start {start} ")
+        )
+        product["start_position"] = start
+        buffered.append(product)
+    yield from _sorted(buffered)
+
+
+def _merge_shard_products(
+    shards: List[Iterable[dict]],
+    ranks: Dict[str, int],
+    windows: Optional[Dict[str, Tuple[str, int]]] = None,
+    experiments: Sequence[str] = (),
+) -> Iterator[dict]:
+    """Merge per-shard products in the order of the original templates.
+
+    `experiments` gives the order of the experiments (see
+    `_unwindow_products`).
+    """
+    windows = windows or {}
+
+    def _order(product):
+        seq_id = _template_id(product["target"])
+        return ranks[seq_id], windows.get(seq_id, (None, 0))[1]
+
+    merged = heapq.merge(*shards, key=_order)
+    return _renumber_products(_unwindow_products(merged, windows, experiments))
+
+
+def _ipcress_cmd(
+    templates_fp: str,
+    experiments_fp: str,
+    seed: int,
+    memory: int,
+    mismatch: int,
+    pretty: bool = True,
+) -> List[str]:
+    # without the pretty output ipcress only prints its summary lines
+    output = ["-p", "-P"] if pretty else ["-p", "FALSE", "-P", "TRUE"]
+    return [
         "ipcress",
         "-i",
-        str(experiments),
+        experiments_fp,
         "-s",
-        str(templates),
+        templates_fp,
         "-S",
         str(seed),
         "-M",
         str(memory),
         "-m",
         str(mismatch),
-        "-p",
-        "-P",
+        *output,
+    ]
+
+
+def _run_ipcress(
+    templates_fp: str,
+    experiments_fp: str,
+    seed: int,
+    memory: int,
+    mismatch: int,
+    pretty: bool = True,
+    scratch_dir: Optional[str] = None,
+    stats: RunStats = NO_STATS,
+    limits: Optional[dict] = None,
+) -> Iterator[dict]:
+    """Run ipcress and parse its products as they are written.
+
+    `limits` (a timeout and resource limits) are passed on to the command.
+    """
+    cmd = _ipcress_cmd(templates_fp, experiments_fp, seed, memory, mismatch, pretty)
+    panel = None if pretty else _read_panel(experiments_fp)
+    limits = limits or {}
+    if scratch_dir is not None:
+        return _run_ipcress_to_file(cmd, panel, scratch_dir, stats, limits)
+    chunks = stats.iterate(
+        "ipcress",
+        stream_command(cmd, verbose=True, **limits),
+        "ipcress_output_bytes",
+        len,
+    )
+    return stats.iterate("parse", _parse_pcr_products(chunks, panel), "products_found")
+
+
+def _run_ipcress_to_file(
+    cmd: List[str],
+    panel: Optional[Dict[str, tuple]],
+    scratch_dir: str,
+    stats: RunStats = NO_STATS,
+    limits: Optional[dict] = None,
+) -> Iterator[dict]:
+    """Run ipcress with its output going to a file in `scratch_dir`.
+
+    The output is parsed from the memory-mapped file once ipcress is done.
+    """
+    with tempfile.NamedTemporaryFile(
+        dir=scratch_dir, prefix="ipcress-", suffix=".out"
+    ) as out:
+        # the parser anchors the first result on a preceding newline
+        out.write(b"\n")
+        output_bytes = functools.partial(os.path.getsize, out.name)
+        with stats.stage("ipcress"), stats.watch("ipcress_output_bytes", output_bytes):
+            run_command_to_file(cmd, out, verbose=True, **(limits or {}))
+        stats.count("ipcress_output_bytes", output_bytes() - 1)
+        yield from stats.iterate(
+            "parse", _parse_mapped(out.name, panel), "products_found"
+        )
+
+
+def _run_ipcress_unit(
+    templates_fp: str,
+    experiments_fp: str,
+    seed: int,
+    memory: int,
+    mismatch: int,
+    pretty: bool = True,
+    spill_dir: Optional[str] = None,
+    max_product_memory: Optional[int] = None,
+    scratch_dir: Optional[str] = None,
+    limits: Optional[dict] = None,
+    checkpoint_dir: Optional[str] = None,
+) -> Iterable[dict]:
+    """Run ipcress and collect its products, to be returned from a worker.
+
+    With a `max_product_memory` (MB), the products beyond it are spilled to
+    a file in `spill_dir` rather than kept in memory.
+
+    With a `checkpoint_dir`, the products are also stored there as soon as
+    the search is finished, keyed on the contents of the templates and
+    experiments and the search parameters. A unit which has already been
+    searched, e.g. before the run was interrupted, is read back from its
+    checkpoint instead of being searched again.
+    """
+
+    def _collect(products: Iterable[dict]) -> Iterable[dict]:
+        if max_product_memory is None:
+            return list(products)
+        return ProductStore(spill_dir, max_product_memory * 2**20).extend(products)
+
+    search = functools.partial(
+        _run_ipcress,
+        templates_fp,
+        experiments_fp,
+        seed,
+        memory,
+        mismatch,
+        pretty,
+        scratch_dir,
+        limits=limits,
+    )
+    if checkpoint_dir is None:
+        return _collect(search())
+
+    # the FSM memory limit does not change the products
+    checkpoints = ResultCache(checkpoint_dir)
+    key = _cache_key(
+        "unit",
+        _hash_file(templates_fp),
+        _hash_file(experiments_fp),
+        seed,
+        mismatch,
+        pretty,
+        _ipcress_version(),
+    )
+    with checkpoints.lookup(key) as entry:
+        if entry is not None:
+            return _collect(_load_checkpoint(entry))
+    products = _collect(search())
+    checkpoints.store(key, functools.partial(_save_checkpoint, products))
+    return products
+
+
+def _save_checkpoint(products: Iterable[dict], entry: str):
+    with open(os.path.join(entry, CHECKPOINT_PRODUCTS), "wb") as fh:
+        products = iter(products)
+        batches = iter(
+            lambda: list(itertools.islice(products, CHECKPOINT_BATCH_SIZE)), []
+        )
+        for batch in batches:
+            pickle.dump(_to_columns(batch), fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load_checkpoint(entry: str) -> Iterator[dict]:
+    with open(os.path.join(entry, CHECKPOINT_PRODUCTS), "rb") as fh:
+        while True:
+            try:
+                columns = pickle.load(fh)
+            except EOFError:
+                return
+            yield from _from_columns(columns)
+
+
+def _split_unit(unit: dict) -> Optional[List[dict]]:
+    """Split the templates of a unit of work in halves, to be retried.
+
+    The halves keep the templates in their order, so that their products
+    can take the place of the unit's products in the merge. Returns None
+    for a single template, which cannot be split.
+    """
+    count = sum(1 for _ in _stream_fasta_records(unit["templates_fp"]))
+    if count < 2:
+        return None
+    halves = []
+    for _ in range(2):
+        fd, fp = tempfile.mkstemp(
+            prefix="retry-", suffix=".fasta", dir=unit["spill_dir"]
+        )
+        halves.append((os.fdopen(fd, "w"), fp))
+    try:
+        records = _stream_fasta_records(unit["templates_fp"])
+        for i, (header, seq) in enumerate(records):
+            fh = halves[i >= count // 2][0]
+            fh.write(header)
+            fh.writelines(seq)
+    finally:
+        for fh, _ in halves:
+            fh.close()
+    return [{**unit, "templates_fp": fp} for _, fp in halves]
+
+
+def _run_ipcress_split(
+    templates_fp: str,
+    experiments_fp: str,
+    seed: int,
+    memory: int,
+    mismatch: int,
+    n_jobs: int = 1,
+    split_templates: bool = False,
+    experiment_batch_size: Optional[int] = None,
+    memory_budget: Optional[int] = None,
+    pretty: bool = True,
+    max_product_memory: Optional[int] = None,
+    scratch_dir: Optional[str] = None,
+    stats: RunStats = NO_STATS,
+    retries: int = 0,
+    limits: Optional[dict] = None,
+    checkpoint_dir: Optional[str] = None,
+) -> Iterator[dict]:
+    """Run ipcress on template shards and/or batches of experiments.
+
+    With n_jobs > 1 the templates are split into shards and every
+    combination of a template shard and an experiment batch is searched
+    by its own ipcress process from a process pool; otherwise the
+    experiment batches are searched one after another.
+
+    With a `memory_budget` (MB), the number of concurrent processes and
+    the FSM memory limit of each of them are chosen such that all of them
+    together stay within the budget.
+
+    With a `max_product_memory` (MB), every process keeps at most this
+    many products in memory and spills the rest to disk (see
+    `ProductStore`), from where they are merged.
+
+    A process which fails, e.g. because it hit its `limits` (see
+    `_Command`), is retried up to `retries` times with a smaller FSM memory
+    limit or on halves of its templates (see `_run_scheduled`); the work
+    of all other processes is kept meanwhile. With a `checkpoint_dir`, the
+    products of every process are kept there beyond the run, and those
+    kept by an earlier run are reused (see `_run_ipcress_unit`); the
+    templates are then always split into shards of at most
+    `CHECKPOINT_SHARD_SIZE` bases, so that an interrupted run only loses
+    the work on the shards which did not finish.
+
+    The shards, templates and products done so far are counted in `stats`
+    as every shard is finished by all experiment batches.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        if n_jobs > 1 or checkpoint_dir is not None:
+            overlap = _max_product_length(experiments_fp) if split_templates else None
+            max_size = CHECKPOINT_SHARD_SIZE if checkpoint_dir is not None else None
+            shards, ranks, windows = _shard_templates(
+                templates_fp, n_jobs, tmp, overlap=overlap, max_shard_size=max_size
+            )
+        else:
+            shards, ranks, windows = [templates_fp], _template_ranks(templates_fp), {}
+
+        if experiment_batch_size:
+            batches = _batch_experiments(experiments_fp, experiment_batch_size, tmp)
+        else:
+            batches = [experiments_fp]
+
+        # products of one template found by several experiment batches are
+        # merged in the order of the batches, i.e. of the experiment file
+        units = [
+            dict(
+                templates_fp=shard,
+                experiments_fp=batch,
+                seed=seed,
+                mismatch=mismatch,
+                pretty=pretty,
+                spill_dir=tmp,
+                max_product_memory=max_product_memory,
+                scratch_dir=scratch_dir,
+                limits=limits,
+                checkpoint_dir=checkpoint_dir,
+            )
+            for shard in shards
+            for batch in batches
+        ]
+
+        # without any templates (or experiments) there is nothing to plan
+        if memory_budget is not None and units:
+            overhead = IPCRESS_BASE_MEMORY + math.ceil(
+                max(_longest_template(shard) for shard in shards) / 2**20
+            )
+            fsm_memory = max(
+                _estimate_fsm_memory(batch, seed, mismatch) for batch in batches
+            )
+            n_jobs, memory = _plan_memory(
+                memory_budget, min(n_jobs, len(units)), memory, fsm_memory, overhead
+            )
+
+        stats.count("shards", len(shards))
+        remaining = [len(batches)] * len(shards)
+
+        def _count_done(unit: int, parts: List[Iterable[dict]]):
+            stats.count("products_found", sum(len(products) for products in parts))
+            shard = unit // len(batches)
+            remaining[shard] -= 1
+            if remaining[shard] == 0:
+                stats.count("shards_done")
+                # windows of templates cut by the sharding count separately
+                stats.count(
+                    "templates_done",
+                    sum(1 for _ in _stream_fasta_records(shards[shard])),
+                )
+
+        results = _run_scheduled(
+            _run_ipcress_unit,
+            units,
+            n_jobs,
+            memory,
+            None if stats is NO_STATS else _count_done,
+            retries,
+            _split_unit,
+        )
+        experiments = [row[0] for row in _read_experiments(experiments_fp)]
+        yield from _merge_shard_products(results, ranks, windows, experiments)
+
+
+def _find_products(
+    templates_fp: str,
+    experiments_fp: str,
+    seed: int,
+    memory: int,
+    mismatch: int,
+    n_jobs: int,
+    split_templates: bool,
+    experiment_batch_size: Optional[int],
+    memory_budget: Optional[int],
+    pretty: bool,
+    prefilter: bool = False,
+    template_index: Optional[str] = None,
+    engine: str = "ipcress",
+    stats: RunStats = NO_STATS,
+    max_product_memory: Optional[int] = None,
+    scratch_dir: Optional[str] = None,
+    retries: int = 0,
+    limits: Optional[dict] = None,
+    checkpoint_dir: Optional[str] = None,
+) -> Iterator[dict]:
+    with tempfile.TemporaryDirectory() as tmp:
+        if prefilter or template_index is not None:
+            candidates_fp = os.path.join(tmp, "candidates.fasta")
+            with stats.stage("prefilter"):
+                kept = _prefilter_templates(
+                    templates_fp,
+                    experiments_fp,
+                    mismatch,
+                    candidates_fp,
+                    template_index,
+                )
+            if kept == 0:
+                return
+            if kept is not None:
+                templates_fp = candidates_fp
+
+        if engine == "native":
+            products = stats.iterate(
+                "native",
+                _run_native(templates_fp, experiments_fp, mismatch),
+                "products_found",
+            )
+        elif (
+            n_jobs > 1
+            or experiment_batch_size
+            or memory_budget
+            or retries
+            or checkpoint_dir is not None
+        ):
+            products = _run_ipcress_split(
+                templates_fp,
+                experiments_fp,
+                seed,
+                memory,
+                mismatch,
+                n_jobs,
+                split_templates,
+                experiment_batch_size,
+                memory_budget,
+                pretty,
+                max_product_memory,
+                scratch_dir,
+                stats,
+                retries,
+                limits,
+                checkpoint_dir,
+            )
+            # the output is parsed by the workers, as part of this stage
+            products = stats.iterate("ipcress", products)
+        else:
+            products = _run_ipcress(
+                templates_fp,
+                experiments_fp,
+                seed,
+                memory,
+                mismatch,
+                pretty,
+                scratch_dir,
+                stats,
+                limits,
+            )
+        if engine == "native" or not pretty:
+            products = _describe_targets(products, _template_descriptions(templates_fp))
+        yield from products
+
+
+def _engine_version(engine: str) -> str:
+    """Identify the implementation of an engine to key cached results on."""
+    if engine == "native":
+        return f"native {__version__}"
+    return _ipcress_version()
+
+
+def _find_products_cached(
+    cache: ResultCache,
+    templates_fp: str,
+    experiments_fp: str,
+    seed: int,
+    memory: int,
+    mismatch: int,
+    *args,
+    engine: str = "ipcress",
+    **kwargs,
+) -> Iterator[dict]:
+    """Find products, reusing the cached products of experiments and templates.
+
+    The products of every experiment row are cached separately, keyed on
+    the row itself and the search parameters, and grouped by the hash of
+    the sequence of the template they were found on. ipcress is only run
+    for the rows which miss some of the current template sequences, and
+    only on those templates; the entries of these rows are then stored
+    with the products of the current template sequences only. Cached
+    products are read back one template at a time as they are assigned to
+    the current templates by their sequence, which drops the products of
+    removed templates, and all rows are merged as if they had been
+    searched in separate batches. Any further `args` and `kwargs` are
+    passed on to `_find_products`.
+    """
+    version = _engine_version(engine)
+    records = _hash_records(templates_fp)
+    hashes = {seq_hash for _, _, seq_hash in records}
+    rows = _read_experiments(experiments_fp)
+    keys = [
+        _cache_key("experiment", row, seed, memory, mismatch, version) for row in rows
     ]
 
-    out = run_command(cmd, verbose=True)
-    lines = out.decode().split("Ipcress result")
+    # the files of the entries are kept open, so that they can be read even
+    # if the entries are replaced or evicted meanwhile
+    found = []
+    for key in keys:
+        with cache.lookup(key) as entry:
+            found.append(_open_products(entry) if entry is not None else ({}, None))
+
+    missing = [i for i, (ranges, _) in enumerate(found) if not hashes <= ranges.keys()]
+    if missing:
+        missing_hashes = set().union(*(hashes - found[i][0].keys() for i in missing))
+        with tempfile.TemporaryDirectory() as tmp:
+            searched_fp = os.path.join(tmp, "products.pkl")
+            with open(searched_fp, "w+b") as searched_fh:
+                searched = _search_templates(
+                    templates_fp,
+                    records,
+                    [rows[i] for i in missing],
+                    missing_hashes,
+                    searched_fh,
+                    seed,
+                    memory,
+                    mismatch,
+                    *args,
+                    engine=engine,
+                    **kwargs,
+                )
+                for i in missing:
+                    sources = [found[i], (searched[rows[i][0]], searched_fh)]
+                    stored = []
+                    cache.store(
+                        keys[i],
+                        lambda entry: stored.append(
+                            _save_products(entry, sources, hashes)
+                        ),
+                    )
+                    if found[i][1] is not None:
+                        found[i][1].close()
+                    found[i] = stored[0]
+
+    ranks = {seq_id: rank for rank, (seq_id, _, _) in enumerate(records)}
+    return _merge_shard_products(
+        [_read_products(cached, records) for cached in found], ranks
+    )
+
+
+def _search_templates(
+    templates_fp: str,
+    records: List[Tuple[str, str, str]],
+    rows: List[List[str]],
+    hashes: Set[str],
+    out,
+    *args,
+    **kwargs,
+) -> Dict[str, Dict[str, List[Tuple[int, int]]]]:
+    """Search one template per sequence hash in `hashes` for the given rows.
+
+    The products are written to the binary file `out` as they are found,
+    in batches of the products of one experiment on one template (see
+    `_write_batch`). Returns the (offset, length) of the batches of every
+    experiment by the hash of the sequence they were found on.
+    """
+    ranges = defaultdict(lambda: defaultdict(list))
+    with tempfile.TemporaryDirectory() as tmp:
+        sub_templates_fp = os.path.join(tmp, "templates.fasta")
+        sub_experiments_fp = os.path.join(tmp, "experiments.ipcress")
+        searched = _write_unique_templates(
+            templates_fp, records, sub_templates_fp, hashes
+        )
+        _write_experiments(rows, sub_experiments_fp)
+
+        products = _find_products(sub_templates_fp, sub_experiments_fp, *args, **kwargs)
+        # products come grouped by template and experiment
+        for (experiment, seq_id), batch in itertools.groupby(
+            products,
+            lambda product: (product["experiment"], _template_id(product["target"])),
+        ):
+            ranges[experiment][searched[seq_id]].append(_write_batch(out, list(batch)))
+    return ranges
+
+
+def _write_unique_templates(
+    templates_fp: str,
+    records: List[Tuple[str, str, str]],
+    out_fp: str,
+    hashes: Optional[Set[str]] = None,
+) -> Dict[str, str]:
+    """Copy the first template of every sequence (with a hash in `hashes`).
+
+    Returns the hashes of the copied templates by their IDs.
+    """
+    if hashes is None:
+        hashes = {seq_hash for _, _, seq_hash in records}
+    written, remaining = {}, set(hashes)
+    with open(out_fp, "w") as fh:
+        for (header, seq), (seq_id, _, seq_hash) in zip(
+            _stream_fasta_records(templates_fp), records
+        ):
+            if seq_hash not in remaining:
+                continue
+            remaining.discard(seq_hash)
+            written[seq_id] = seq_hash
+            fh.write(header)
+            fh.writelines(seq)
+    return written
+
+
+def _find_products_unique(
+    templates_fp: str, experiments_fp: str, *args, **kwargs
+) -> Iterator[dict]:
+    """Find products, searching every distinct template sequence only once.
+
+    Templates with identical sequences are only searched under the ID of
+    the first of them; their products are then copied to all the others,
+    in the order of the original templates. Any further `args` and `kwargs`
+    are passed on to `_find_products`.
+    """
+    records = _hash_records(templates_fp)
+    if len({seq_hash for _, _, seq_hash in records}) == len(records):
+        yield from _find_products(templates_fp, experiments_fp, *args, **kwargs)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        unique_fp = os.path.join(tmp, "templates.fasta")
+        _write_unique_templates(templates_fp, records, unique_fp)
+        products = _find_products(unique_fp, experiments_fp, *args, **kwargs)
+        yield from _renumber_products(_fan_out_products(products, records))
+
+
+def _fan_out_products(
+    products: Iterable[dict], records: List[Tuple[str, str, str]]
+) -> Iterator[dict]:
+    """Copy the products of unique templates to all templates with their sequence.
+
+    `products` must be found on the first template of every sequence and
+    ordered by template. Only the products of duplicated sequences are
+    kept until all of their copies are made.
+    """
+    first, duplicated, seen = {}, set(), set()
+    for index, (seq_id, _, seq_hash) in enumerate(records):
+        if seq_hash in seen:
+            duplicated.add(seq_hash)
+        else:
+            seen.add(seq_hash)
+            first[seq_id] = index
+
+    def _copies(start, end):
+        for seq_id, description, seq_hash in records[start:end]:
+            if seq_id not in first:
+                for product in stored[seq_hash]:
+                    yield _retarget_product(product, seq_id, description)
+
+    stored, position = defaultdict(list), 0
+    for product in products:
+        seq_id = _template_id(product["target"])
+        if first[seq_id] > position:
+            yield from _copies(position, first[seq_id])
+            position = first[seq_id]
+        if records[first[seq_id]][2] in duplicated:
+            stored[records[first[seq_id]][2]].append(product)
+        yield product
+    yield from _copies(position, len(records))
+
+
+def _read_products(
+    cached: Tuple[Dict[str, List[Tuple[int, int]]], Optional[BinaryIO]],
+    records: List[Tuple[str, str, str]],
+) -> Iterator[dict]:
+    """Copy products to every template with the sequence they were found on.
+
+    `cached` are the (offset, length) of the batches of products of every
+    sequence hash in the open file they were stored in (see
+    `_save_products`); the batches are read one at a time.
+    """
+    ranges, fh = cached
+    if fh is None:
+        return
+    with fh:
+        for seq_id, description, seq_hash in records:
+            for batch in ranges.get(seq_hash, ()):
+                for product in _read_batch(fh, batch):
+                    yield _retarget_product(product, seq_id, description)
+
+
+def _retarget_product(product: dict, seq_id: str, description: str) -> dict:
+    """Copy a product found on another template with the same sequence."""
+    old_id = _template_id(product["target"])
+    target = seq_id + product["target"].split(" ", 1)[0][len(old_id) :]
+    return {
+        **product,
+        "target": f"{target} {description}" if description else target,
+        "id": product["id"].replace(f" seq {old_id}", f" seq {seq_id}", 1),
+    }
+
+
+def _write_batch(fh: BinaryIO, products: List[dict]) -> Tuple[int, int]:
+    """Append a batch of products to `fh` and return its (offset, length)."""
+    offset = fh.seek(0, os.SEEK_END)
+    pickle.dump(_to_columns(products), fh, protocol=pickle.HIGHEST_PROTOCOL)
+    return offset, fh.tell() - offset
+
+
+def _read_batch(fh: BinaryIO, batch: Tuple[int, int]) -> Iterator[dict]:
+    offset, length = batch
+    fh.seek(offset)
+    return _from_columns(pickle.loads(fh.read(length)))
+
+
+def _save_products(
+    entry: str,
+    sources: List[Tuple[Dict[str, List[Tuple[int, int]]], Optional[BinaryIO]]],
+    hashes: Set[str],
+) -> Tuple[Dict[str, List[Tuple[int, int]]], BinaryIO]:
+    """Store the batches of products of the sequence hashes in `hashes`.
+
+    The batches are copied from the open files of `sources`, given with
+    the (offset, length) of their batches by sequence hash, which together
+    must cover all of `hashes`; the batches of all other hashes are
+    dropped. Returns the same for the entry, with its products file open
+    for reading.
+    """
+    ranges = {seq_hash: [] for seq_hash in hashes}
+    products_fp = os.path.join(entry, CACHED_EXPERIMENT)
+    with open(products_fp, "wb") as out:
+        for source, fh in sources:
+            for seq_hash in hashes & source.keys():
+                for offset, length in source[seq_hash]:
+                    fh.seek(offset)
+                    ranges[seq_hash].append((out.tell(), length))
+                    out.write(fh.read(length))
+    with open(os.path.join(entry, CACHED_EXPERIMENT_INDEX), "wb") as fh:
+        pickle.dump(ranges, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    return ranges, open(products_fp, "rb")
+
+
+def _open_products(
+    entry: str,
+) -> Tuple[Dict[str, List[Tuple[int, int]]], Optional[BinaryIO]]:
+    """Open the products of a cache entry written by `_save_products`."""
+    index_fp = os.path.join(entry, CACHED_EXPERIMENT_INDEX)
+    if not os.path.exists(index_fp):
+        # written by an earlier version
+        return {}, None
+    with open(index_fp, "rb") as fh:
+        ranges = pickle.load(fh)
+    return ranges, open(os.path.join(entry, CACHED_EXPERIMENT), "rb")
+
+
+def _write_results(
+    products: Iterator[dict],
+    line_width: Optional[int],
+    stats: RunStats = NO_STATS,
+) -> Tuple[DNAFASTAFormat, pd.DataFrame]:
+    first = next(products, None)
+    if first is None:
+        raise ValueError(NO_HITS_ERROR)
+    results = DNAFASTAFormat()
+    with open(str(results), "w", buffering=STREAM_CHUNK_SIZE) as fh:
+        products = _write_products(itertools.chain([first], products), fh, line_width)
+        with stats.stage("metadata"):
+            meta = _extract_pcr_meta(stats.iterate("write", products, "products"))
+
+    return results, meta
+
+
+def _save_result(entry: str, results: DNAFASTAFormat, meta: pd.DataFrame):
+    shutil.copyfile(str(results), os.path.join(entry, CACHED_PRODUCTS))
+    meta.to_pickle(os.path.join(entry, CACHED_METADATA))
+
+
+def _load_result(entry: str) -> Tuple[DNAFASTAFormat, pd.DataFrame]:
+    results = DNAFASTAFormat()
+    shutil.copyfile(os.path.join(entry, CACHED_PRODUCTS), str(results))
+    return results, pd.read_pickle(os.path.join(entry, CACHED_METADATA))
+
+
+def simulate_pcr(
+    templates: DNAFASTAFormat,
+    experiments: IPCRessExperimentFormat,
+    seed: int = 12,
+    memory: int = 32,
+    mismatch: int = 0,
+    n_jobs: int = 1,
+    split_templates: bool = False,
+    experiment_batch_size: int = None,
+    memory_budget: int = None,
+    pretty: bool = False,
+    line_width: int = None,
+    cache_dir: str = None,
+    cache_max_size: int = None,
+    prefilter: bool = False,
+    template_index: IPCRessTemplateIndexDirFmt = None,
+    engine: str = "ipcress",
+    stats_log: str = None,
+    max_product_memory: int = None,
+    scratch_dir: str = None,
+    progress_interval: int = None,
+    timeout: int = None,
+    max_process_memory: int = None,
+    max_cpu_time: int = None,
+    retries: int = 0,
+    checkpoint_dir: str = None,
+) -> (DNAFASTAFormat, pd.DataFrame):
+    args = (
+        str(templates),
+        str(experiments),
+        seed,
+        memory,
+        mismatch,
+        n_jobs,
+        split_templates,
+        experiment_batch_size,
+        memory_budget,
+        pretty,
+        prefilter,
+        str(template_index) if template_index is not None else None,
+    )
+    stats = _run_stats(
+        stats_log,
+        progress_interval,
+        action="simulate_pcr",
+        engine=engine,
+        n_jobs=n_jobs,
+    )
+    options = dict(
+        engine=engine,
+        stats=stats,
+        max_product_memory=max_product_memory,
+        scratch_dir=scratch_dir,
+        retries=retries,
+        checkpoint_dir=checkpoint_dir,
+        limits=dict(
+            timeout=timeout, max_memory=max_process_memory, max_cpu_time=max_cpu_time
+        ),
+    )
+    if cache_dir is None:
+        with stats.progress(progress_interval):
+            products = _find_products_unique(*args, **options)
+            results, meta = _write_results(products, line_width, stats)
+        stats.log(stats_log)
+        return results, meta
 
-    products = _process_pcr_products(lines)
-    results = _dump_seqs_to_file(products)
-    meta = _extract_pcr_meta(products)
+    # only the parameters which change the results are part of the key
+    cache = ResultCache(cache_dir, cache_max_size)
+    with stats.stage("cache"):
+        key = _cache_key(
+            "simulate_pcr",
+            _hash_file(str(templates)),
+            _hash_file(str(experiments)),
+            seed,
+            memory,
+            mismatch,
+            line_width,
+            _engine_version(engine),
+            # windows are merged like a whole template is searched, but
+            # results found either way are not mixed in case ipcress differs
+            split_templates,
+        )
+        with cache.lookup(key) as entry:
+            cached = _load_result(entry) if entry is not None else None
+    if cached is not None:
+        stats.count("products", len(cached[1]))
+        stats.log(stats_log)
+        return cached
 
+    with stats.progress(progress_interval):
+        products = _find_products_cached(cache, *args, **options)
+        results, meta = _write_results(products, line_width, stats)
+    with stats.stage("cache"):
+        cache.store(key, lambda entry: _save_result(entry, results, meta))
+    stats.log(stats_log)
     return results, meta
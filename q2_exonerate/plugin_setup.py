@@ -8,18 +8,30 @@
 import importlib
 
 from q2_types.feature_data import FeatureData, Sequence
-from qiime2.core.type import Int, Range
+from q2_types.feature_table import FeatureTable, Frequency
+from qiime2.core.type import Bool, Choices, Int, Range, Str
 from qiime2.plugin import Citations, Plugin
 
 from q2_exonerate import __version__
+from q2_exonerate._prefilter import MAX_K, MIN_K
+from q2_exonerate.dereplicate import dereplicate_products
+from q2_exonerate.index import build_template_index
 from q2_exonerate.ipcress import simulate_pcr
 from q2_exonerate.types._format import (
-    IPCRessExperimentFormat,
     IPCRessExperimentDirFmt,
-    PCRProductMetadataFormat,
+    IPCRessExperimentFormat,
+    IPCRessTemplateIndexDirFmt,
+    NumPyArrayFormat,
     PCRProductMetadataDirFmt,
+    PCRProductMetadataFormat,
+    TemplateIndexManifestFormat,
+    TemplateIndexRecordsFormat,
+)
+from q2_exonerate.types._type import (
+    IPCRessExperiments,
+    IPCRessTemplateIndex,
+    PCRProductMetadata,
 )
-from q2_exonerate.types._type import IPCRessExperiments, PCRProductMetadata
 
 citations = Citations.load("citations.bib", package="q2_exonerate")
 
@@ -37,11 +49,31 @@ plugin.methods.register_function(
     inputs={
         "templates": FeatureData[Sequence],
         "experiments": IPCRessExperiments,
+        "template_index": IPCRessTemplateIndex,
     },
     parameters={
         "seed": Int % Range(0, None),
         "memory": Int % Range(1, None),
         "mismatch": Int % Range(0, None),
+        "n_jobs": Int % Range(1, None),
+        "split_templates": Bool,
+        "experiment_batch_size": Int % Range(1, None),
+        "memory_budget": Int % Range(1, None),
+        "pretty": Bool,
+        "line_width": Int % Range(1, None),
+        "cache_dir": Str,
+        "cache_max_size": Int % Range(1, None),
+        "prefilter": Bool,
+        "engine": Str % Choices(["ipcress", "native"]),
+        "stats_log": Str,
+        "max_product_memory": Int % Range(1, None),
+        "scratch_dir": Str,
+        "progress_interval": Int % Range(1, None),
+        "timeout": Int % Range(1, None),
+        "max_process_memory": Int % Range(1, None),
+        "max_cpu_time": Int % Range(1, None),
+        "retries": Int % Range(0, None),
+        "checkpoint_dir": Str,
     },
     outputs=[
         ("products", FeatureData[Sequence]),
@@ -50,11 +82,100 @@ plugin.methods.register_function(
     input_descriptions={
         "templates": "The templates to simulate PCR on.",
         "experiments": "The ipcress experimental details.",
+        "template_index": "A k-mer index of the templates. If provided, the "
+        "templates are prefiltered (see prefilter) by looking up the primer "
+        "seeds in the index instead of scanning the templates. Templates which "
+        "are not part of the index are scanned as usual.",
     },
     parameter_descriptions={
         "seed": "Seed length (use zero for full length).",
-        "memory": "Memory limit for FSM data.",
+        "memory": "Memory limit for FSM data (in MB) of every ipcress process.",
         "mismatch": "Number of mismatches allowed per primer.",
+        "n_jobs": "Number of ipcress processes to run in parallel. The "
+        "templates are distributed over this many shards of similar total "
+        "length which are searched independently; the results are merged in "
+        "the original template order.",
+        "split_templates": "Cut templates longer than the ideal shard size into "
+        "windows overlapping by the largest product length, so that they can be "
+        "searched in parallel. Products found in two overlapping windows are "
+        "reported once. Only used if n_jobs is larger than 1.",
+        "experiment_batch_size": "Split the experiments into batches of this "
+        "many rows and search every batch with its own ipcress process. This "
+        "limits the size of the primer state machine of a single process for "
+        "large primer panels. Batches are run in parallel if n_jobs is larger "
+        "than 1, otherwise one after another.",
+        "memory_budget": "Total memory (in MB) available to all ipcress "
+        "processes together. If set, the number of parallel processes (up to "
+        "n_jobs) and the FSM memory limit of each of them (up to memory) are "
+        "derived from the budget and the size of the primer panel. Whenever a "
+        "process is killed for running out of memory, fewer processes are run "
+        "at a time and the failed work is repeated.",
+        "pretty": "Let ipcress render the pretty alignment of every product. "
+        "This is considerably slower for many products; by default only the "
+        "compact summary is requested and the primer matches, length range "
+        "and template description are filled in from the inputs instead.",
+        "line_width": "Wrap the sequences of the products at this many "
+        "characters. By default every sequence is written on a single line.",
+        "cache_dir": "Directory in which to cache results. A run with the same "
+        "templates, experiments, seed, memory, mismatch, line_width and "
+        "ipcress version returns the cached products and metadata without "
+        "running ipcress. The products of every experiment are also cached "
+        "separately for every template sequence, so that only new or changed "
+        "experiments and templates are searched when a panel or a template "
+        "database is extended. The directory can be shared by concurrent runs.",
+        "cache_max_size": "Maximum size (in MB) of the cache. The least "
+        "recently used results are removed once it is exceeded. Unlimited by "
+        "default.",
+        "prefilter": "Scan the templates for exact seeds of the primers before "
+        "running ipcress and only search templates with seeds of both sides of "
+        "a product within the maximum product length. The seeds are chosen "
+        "such that no template which ipcress could amplify is dropped; the "
+        "prefilter is skipped if the primers are too short or degenerate for "
+        "the number of allowed mismatches.",
+        "engine": "The implementation to simulate PCR with: ipcress, or a native "
+        "NumPy implementation which runs in-process and reports the same products "
+        "and metadata. The native engine ignores the ipcress-specific seed, "
+        "memory and sharding parameters.",
+        "stats_log": "Append the wall time and CPU time of every stage of the "
+        "run (ipcress, parsing, writing the products, building the metadata, "
+        "...), the peak memory of the run, the CPU time of the ipcress processes "
+        "and the peak memory of the largest ipcress process run so far by the "
+        "same Python process, "
+        "the size of their output and the number of products found per second "
+        "to this file, as one JSON object per run. The same statistics are "
+        "logged to the 'q2_exonerate.stats' logger if it is enabled for INFO.",
+        "max_product_memory": "Maximum memory (in MB) for the products found by "
+        "every parallel ipcress process (see n_jobs and experiment_batch_size); "
+        "products beyond it are spilled to temporary files and merged from "
+        "there. Unlimited by default.",
+        "scratch_dir": "Write the output of ipcress to a temporary file in this "
+        "directory (e.g. on local NVMe or tmpfs) and parse it from the "
+        "memory-mapped file once ipcress is done, instead of streaming it "
+        "through a pipe.",
+        "progress_interval": "Every this many seconds, log the progress of the "
+        "run (elapsed time, current stage, bytes of ipcress output, products "
+        "found and, with several shards, the shards and templates done so far) "
+        "to the 'q2_exonerate.progress' logger at INFO level. The stderr of "
+        "ipcress is logged line by line to the 'q2_exonerate.command' logger.",
+        "timeout": "Kill any ipcress process which runs for longer than this "
+        "many seconds. Unlimited by default.",
+        "max_process_memory": "Limit the address space of every ipcress process "
+        "to this many MB, so that a runaway process fails instead of exhausting "
+        "the machine's memory. Unlimited by default.",
+        "max_cpu_time": "Limit the CPU time of every ipcress process to this many "
+        "seconds. Unlimited by default.",
+        "retries": "Retry an ipcress process which failed (e.g. by hitting one of "
+        "the limits above, or by being killed for running out of memory while "
+        "it runs alone) up to this many times: a process which timed out is "
+        "re-run on each half of its templates, any other with half the FSM "
+        "memory (see memory) and, once that is down to 1 MB, on halves of its "
+        "templates. The products of all other processes are kept meanwhile.",
+        "checkpoint_dir": "Store the products of every ipcress process (i.e. of "
+        "every template shard and experiment batch) in this directory as soon as "
+        "it finishes. When the action is run again with the same inputs and "
+        "parameters, e.g. after it was interrupted, the stored products are "
+        "reused and only the remaining shards are searched. The directory is "
+        "kept and can be removed once the run has succeeded.",
     },
     output_descriptions={
         "products": "The simulated PCR products.",
@@ -68,13 +189,74 @@ plugin.methods.register_function(
     citations=[citations["slater2005"]],
 )
 
+plugin.methods.register_function(
+    function=dereplicate_products,
+    inputs={
+        "products": FeatureData[Sequence],
+        "product_metadata": PCRProductMetadata,
+    },
+    parameters={"group_by": Str % Choices(["template", "experiment"])},
+    outputs=[
+        ("amplicons", FeatureData[Sequence]),
+        ("table", FeatureTable[Frequency]),
+    ],
+    input_descriptions={
+        "products": "The simulated PCR products.",
+        "product_metadata": "The metadata of the simulated PCR products.",
+    },
+    parameter_descriptions={
+        "group_by": "Count the products of every unique amplicon per template "
+        "or per experiment.",
+    },
+    output_descriptions={
+        "amplicons": "The unique amplicon sequences, identified by the MD5 hash "
+        "of their sequence.",
+        "table": "The number of products of every unique amplicon found on "
+        "every template or by every experiment.",
+    },
+    name="Dereplicate simulated PCR products.",
+    description=(
+        "Collapse identical PCR products into unique amplicons and count how "
+        "often every amplicon was found per template or experiment."
+    ),
+)
+
+plugin.methods.register_function(
+    function=build_template_index,
+    inputs={"templates": FeatureData[Sequence]},
+    parameters={"k": Int % Range(MIN_K, MAX_K, inclusive_end=True)},
+    outputs=[("template_index", IPCRessTemplateIndex)],
+    input_descriptions={"templates": "The templates to index."},
+    parameter_descriptions={
+        "k": "Length of the indexed k-mers. The index can only be used for "
+        "primer panels whose primers contain exact seeds of at least this "
+        "length, i.e. with primers at least k * (mismatch + 1) bases long "
+        "(e.g. k = 8 for 17 nt primers and 1 mismatch); otherwise it is skipped "
+        "with a warning and the templates are scanned instead.",
+    },
+    output_descriptions={
+        "template_index": "The positions of all k-mers in the templates.",
+    },
+    name="Index templates for in-silico PCR.",
+    description=(
+        "Build a memory-mapped k-mer index of the templates, which speeds up "
+        "the prefiltering of the templates for any number of primer panels."
+    ),
+)
+
 plugin.register_formats(
     IPCRessExperimentFormat,
     IPCRessExperimentDirFmt,
     PCRProductMetadataFormat,
     PCRProductMetadataDirFmt,
+    TemplateIndexManifestFormat,
+    TemplateIndexRecordsFormat,
+    NumPyArrayFormat,
+    IPCRessTemplateIndexDirFmt,
+)
+plugin.register_semantic_types(
+    IPCRessExperiments, PCRProductMetadata, IPCRessTemplateIndex
 )
-plugin.register_semantic_types(IPCRessExperiments, PCRProductMetadata)
 plugin.register_semantic_type_to_format(
     IPCRessExperiments, artifact_format=IPCRessExperimentDirFmt
 )
@@ -82,4 +264,8 @@ plugin.register_semantic_type_to_format(
     PCRProductMetadata, artifact_format=PCRProductMetadataDirFmt
 )
 
+plugin.register_semantic_type_to_format(
+    IPCRessTemplateIndex, artifact_format=IPCRessTemplateIndexDirFmt
+)
+
 importlib.import_module("q2_exonerate.types._transformer")
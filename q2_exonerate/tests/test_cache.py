@@ -0,0 +1,130 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import hashlib
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_exonerate._cache import (
+    TMP_PREFIX,
+    ResultCache,
+    _cache_key,
+    _hash_file,
+    _hash_records,
+)
+
+
+def _write(size):
+    def write(entry):
+        with open(os.path.join(entry, "data"), "wb") as fh:
+            fh.write(b"x" * size)
+
+    return write
+
+
+class TestResultCache(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = os.path.join(self.temp_dir.name, "cache")
+
+    def test_cache_key(self):
+        self.assertEqual(_cache_key("a", 1, None), _cache_key("a", 1, None))
+        self.assertNotEqual(_cache_key("a", 1), _cache_key("a", 2))
+
+    def test_hash_file(self):
+        fp = self.get_data_path("templates.fasta")
+        self.assertEqual(_hash_file(fp), _hash_file(fp))
+        self.assertNotEqual(
+            _hash_file(fp), _hash_file(self.get_data_path("experiments.ipcress"))
+        )
+
+    def test_hash_records(self):
+        obs = _hash_records(self.get_data_path("templates.fasta"))
+
+        self.assertListEqual(
+            [(seq_id, desc) for seq_id, desc, _ in obs],
+            [
+                ("seq1", "first template"),
+                ("seq2", ""),
+                ("seq3", "third template"),
+                ("seq4", ""),
+            ],
+        )
+        # sequences are hashed independently of their line breaks
+        self.assertEqual(obs[3][2], hashlib.sha256(b"G" * 22).hexdigest())
+
+    def test_lookup_miss(self):
+        cache = ResultCache(self.cache_dir)
+        with cache.lookup("abc") as entry:
+            self.assertIsNone(entry)
+
+    def test_store_lookup(self):
+        cache = ResultCache(self.cache_dir)
+        cache.store("abc", _write(3))
+
+        with cache.lookup("abc") as entry:
+            with open(os.path.join(entry, "data"), "rb") as fh:
+                self.assertEqual(fh.read(), b"xxx")
+        self.assertListEqual(sorted(os.listdir(self.cache_dir)), [".lock", "abc"])
+
+    def test_store_failed_write(self):
+        cache = ResultCache(self.cache_dir)
+
+        def write(entry):
+            raise OSError("disk full")
+
+        with self.assertRaisesRegex(OSError, "disk full"):
+            cache.store("abc", write)
+        with cache.lookup("abc") as entry:
+            self.assertIsNone(entry)
+        self.assertListEqual(os.listdir(self.cache_dir), [".lock"])
+
+    def test_evict_least_recently_used(self):
+        cache = ResultCache(self.cache_dir, max_size=1)
+        cache.store("a", _write(2**19))
+        cache.store("b", _write(2**19))
+        os.utime(os.path.join(self.cache_dir, "a"), (1, 1))
+        os.utime(os.path.join(self.cache_dir, "b"), (2, 2))
+        # using "a" makes "b" the least recently used entry
+        with cache.lookup("a"):
+            pass
+
+        cache.store("c", _write(2**19))
+
+        self.assertListEqual(sorted(os.listdir(self.cache_dir)), [".lock", "a", "c"])
+
+    def test_store_removes_stale_tmp(self):
+        cache = ResultCache(self.cache_dir)
+        stale = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=self.cache_dir)
+        fresh = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=self.cache_dir)
+        os.utime(stale, (1, 1))
+
+        cache.store("a", _write(10))
+
+        self.assertListEqual(
+            sorted(os.listdir(self.cache_dir)),
+            sorted([".lock", "a", os.path.basename(fresh)]),
+        )
+
+    def test_store_concurrently(self):
+        cache = ResultCache(self.cache_dir)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda _: cache.store("abc", _write(10)), range(8)))
+
+        self.assertListEqual(sorted(os.listdir(self.cache_dir)), [".lock", "abc"])
+        with cache.lookup("abc") as entry:
+            self.assertEqual(os.listdir(entry), ["data"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import hashlib
+import unittest
+
+from q2_types.feature_data import DNAFASTAFormat
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_exonerate.dereplicate import dereplicate_products
+from q2_exonerate.ipcress import _dump_seqs_to_file, _extract_pcr_meta
+
+
+class TestDereplicate(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def _product(self, experiment, n, template, sequence):
+        return {
+            "experiment": experiment,
+            "target": f"{template}:filter(unmasked) some description",
+            "match_orientation": "forward",
+            "matches_fwd": "4/4",
+            "matches_rev": "4/4",
+            "length": len(sequence),
+            "range_min": 1,
+            "range_max": 100,
+            "start_position": 1,
+            "id": f"{experiment}_product_{n} seq {template}:filter(unmasked) "
+            f"start 1 length {len(sequence)}",
+            "sequence": sequence,
+        }
+
+    def setUp(self):
+        super().setUp()
+        products = [
+            self._product("A", 1, "s1", "ACGTACGT"),
+            self._product("B", 1, "s1", "ACGTACGT"),
+            self._product("A", 2, "s2", "ACGTACGT"),
+            self._product("A", 3, "s3", "GGGGCCCC"),
+        ]
+        self.products = _dump_seqs_to_file(products, line_width=5)
+        self.meta = _extract_pcr_meta(products)
+        self.h1 = hashlib.md5(b"ACGTACGT").hexdigest()
+        self.h2 = hashlib.md5(b"GGGGCCCC").hexdigest()
+
+    def _read(self, fmt):
+        with open(str(fmt)) as fh:
+            return fh.read()
+
+    def test_dereplicate_products_by_template(self):
+        obs_seqs, obs_table = dereplicate_products(self.products, self.meta)
+
+        self.assertIsInstance(obs_seqs, DNAFASTAFormat)
+        self.assertEqual(
+            self._read(obs_seqs), f">{self.h1}\nACGTACGT\n>{self.h2}\nGGGGCCCC\n"
+        )
+        self.assertListEqual(list(obs_table.ids()), ["s1", "s2", "s3"])
+        self.assertListEqual(
+            list(obs_table.ids(axis="observation")), [self.h1, self.h2]
+        )
+        self.assertListEqual(
+            obs_table.matrix_data.toarray().tolist(), [[2, 1, 0], [0, 0, 1]]
+        )
+
+    def test_dereplicate_products_by_experiment(self):
+        _, obs_table = dereplicate_products(self.products, self.meta, "experiment")
+
+        self.assertListEqual(list(obs_table.ids()), ["A", "B"])
+        self.assertListEqual(obs_table.matrix_data.toarray().tolist(), [[2, 1], [1, 0]])
+
+    def test_dereplicate_products_missing_metadata(self):
+        with self.assertRaisesRegex(ValueError, "1 products.*A_product_3_seq_s3"):
+            dereplicate_products(self.products, self.meta.iloc[:3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import os
+import unittest
+
+import numpy as np
+from q2_types.feature_data import DNAFASTAFormat
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_exonerate._prefilter import _encode_kmer
+from q2_exonerate.index import build_template_index
+from q2_exonerate.types._format import IPCRessTemplateIndexDirFmt
+
+
+class TestIndex(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def _load(self, index, name):
+        return np.load(os.path.join(str(index), name))
+
+    def test_build_template_index(self):
+        templates = DNAFASTAFormat()
+        with open(str(templates), "w") as fh:
+            fh.write(">s1 desc\nACGTAC\n>s2\nGGNGG\n")
+
+        obs = build_template_index(templates, k=4)
+
+        self.assertIsInstance(obs, IPCRessTemplateIndexDirFmt)
+        with open(os.path.join(str(obs), "index.json")) as fh:
+            self.assertDictEqual(json.load(fh), {"k": 4})
+        with open(os.path.join(str(obs), "templates.tsv")) as fh:
+            self.assertListEqual([line.split("\t")[0] for line in fh], ["s1", "s2"])
+
+        kmers = ["ACGT", "CGTA", "GTAC"]
+        self.assertListEqual(
+            self._load(obs, "kmers.npy").tolist(),
+            sorted(_encode_kmer(kmer) for kmer in kmers),
+        )
+        order = np.argsort([_encode_kmer(kmer) for kmer in kmers])
+        self.assertListEqual(self._load(obs, "templates.npy").tolist(), [0, 0, 0])
+        self.assertListEqual(self._load(obs, "positions.npy").tolist(), order.tolist())
+        # the k-mers with the N are indexed as a run of ambiguous k-mers
+        self.assertListEqual(self._load(obs, "ambiguous.npy").tolist(), [[1, 0, 2]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,20 +5,39 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import copy
+import io
+import json
+import os
+import pickle
 import subprocess
+import threading
 import unittest
-from unittest.mock import patch, MagicMock
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import ANY, MagicMock, patch
 
 import pandas as pd
 from q2_types.feature_data import DNAFASTAFormat, DNAIterator
 from qiime2.plugin.testing import TestPluginBase
 
+from q2_exonerate._cache import _hash_records
+from q2_exonerate._sharding import _template_descriptions
 from q2_exonerate.ipcress import (
+    CACHED_EXPERIMENT_INDEX,
     _calculate_match_frac,
-    _process_one_product,
-    _process_pcr_products,
-    _extract_pcr_meta,
+    _describe_targets,
     _dump_seqs_to_file,
+    _extract_pcr_meta,
+    _merge_shard_products,
+    _parse_mapped,
+    _parse_pcr_products,
+    _read_panel,
+    _renumber_products,
+    _run_ipcress,
+    _split_unit,
+    _template_id,
+    _unwindow_products,
+    _write_products,
     simulate_pcr,
 )
 from q2_exonerate.types._format import IPCRessExperimentFormat
@@ -31,7 +50,6 @@ class TestIPCRess(TestPluginBase):
         super().setUp()
         with open(self.get_data_path("ipcress_out.txt"), "r") as f:
             self.ipcress_out = f.read()
-        self.ipcress_lines = self.ipcress_out.split("Ipcress result")
         self.products = [
             {
                 "experiment": "ITS9mun",
@@ -68,35 +86,154 @@ class TestIPCRess(TestPluginBase):
         ]
         self.pcr_prod_df = pd.read_csv(
             self.get_data_path("pcr_prod_meta.tsv"), sep="\t", index_col=0, header=0
+        ).astype(
+            {
+                "experiment": "category",
+                "target": "category",
+                "match_orientation": "category",
+                "length": "int32",
+                "range_min": "int32",
+                "range_max": "int32",
+                "start_position": "int32",
+                "matches_fwd_frac": "float32",
+                "matches_rev_frac": "float32",
+            }
         )
-        self.empty_products = ['-- completed ipcress analysis\n']
 
     def test_calculate_match_frac(self):
-        obs = _calculate_match_frac("18/20")
-        self.assertEqual(obs, 0.9)
+        obs = _calculate_match_frac(pd.Series(["18/20", "17/17"]))
+        pd.testing.assert_series_equal(
+            obs, pd.Series([0.9, 1.0], dtype="float32"), check_names=False
+        )
+
+    def _output_lines(self):
+        return self.ipcress_out.encode().splitlines(True)
+
+    def test_parse_pcr_products(self):
+        obs = list(_parse_pcr_products(self._output_lines()))
+        self.assertListEqual(obs, self.products)
+
+    def test_parse_pcr_products_compact(self):
+        with open(self.get_data_path("ipcress_out_compact.txt"), "rb") as fh:
+            output = fh.read()
+        panel = _read_panel(self.get_data_path("experiments.ipcress"))
+        descriptions = _template_descriptions(
+            self.get_data_path("templates_described.fasta")
+        )
+
+        obs = list(
+            _describe_targets(_parse_pcr_products([output], panel), descriptions)
+        )
+
+        self.assertListEqual(obs, self.products)
+
+    def test_describe_targets_keeps_described(self):
+        products = [{"target": "s1:filter(unmasked) desc"}, {"target": "s2"}]
+
+        obs = list(_describe_targets(products, {"s1": "other", "s2": "second"}))
+
+        self.assertListEqual(
+            [p["target"] for p in obs], ["s1:filter(unmasked) desc", "s2 second"]
+        )
+
+    def test_parse_pcr_products_multiline_sequence(self):
+        obs = list(_parse_pcr_products(self._output_lines()[:24]))
+        self.assertEqual(len(obs), 1)
+        self.assertEqual(obs[0]["sequence"], self.products[0]["sequence"])
+
+    def test_parse_pcr_products_chunked(self):
+        output = self.ipcress_out.encode()
+        for size in (1, 7, 64, 1000):
+            chunks = [output[i : i + size] for i in range(0, len(output), size)]
+            obs = list(_parse_pcr_products(chunks))
+            self.assertListEqual(obs, self.products)
+
+    def test_parse_pcr_products_consistent_lengths(self):
+        # the sequences in the test data are shortened, so the product length
+        # does not match; here they are made to match
+        output, exp = self.ipcress_out, copy.deepcopy(self.products)
+        for product, old, new in zip(exp, ("2072", "2040"), ("74", "68")):
+            output = output.replace(f" {old} ", f" {new} ")
+            output = output.replace(f"length {old}", f"length {new}")
+            product["length"] = int(new)
+            product["id"] = product["id"].replace(old, new)
+        output = output.encode()
+
+        for size in (3, len(output)):
+            chunks = [output[i : i + size] for i in range(0, len(output), size)]
+            obs = list(_parse_pcr_products(chunks))
+            self.assertListEqual(obs, exp)
+
+    def test_parse_pcr_products_is_lazy(self):
+        lines = iter(self._output_lines())
+        obs = _parse_pcr_products(lines)
+        self.assertDictEqual(next(obs), self.products[0])
+        # the second product has not been read from the input yet
+        self.assertIn(b">ITS9mun_product_2", b"".join(lines))
 
-    def test_process_one_product_forward(self):
-        line = self.ipcress_lines[1].split("\n")
-        obs = _process_one_product(line)
-        self.assertDictEqual(obs, self.products[0])
+    def test_parse_pcr_products_no_hits(self):
+        obs = list(_parse_pcr_products([b"-- completed ipcress analysis\n"]))
+        self.assertListEqual(obs, [])
 
-    def test_process_one_product_reverse(self):
-        line = self.ipcress_lines[2].split("\n")
-        obs = _process_one_product(line)
-        self.assertDictEqual(obs, self.products[1])
+    def test_parse_mapped(self):
+        output_fp = os.path.join(self.temp_dir.name, "ipcress.out")
+        with open(output_fp, "wb") as fh:
+            fh.write(b"\n" + self.ipcress_out.encode())
+
+        obs = list(_parse_mapped(output_fp))
 
-    def test_process_pcr_products(self):
-        obs = _process_pcr_products(self.ipcress_lines[:3])
         self.assertListEqual(obs, self.products)
 
-    def test_process_pcr_products_no_hits(self):
-        with self.assertRaises(ValueError):
-            _process_pcr_products(self.empty_products)
+    def test_parse_mapped_empty(self):
+        output_fp = os.path.join(self.temp_dir.name, "ipcress.out")
+        open(output_fp, "wb").close()
+        self.assertListEqual(list(_parse_mapped(output_fp)), [])
+
+    @patch("q2_exonerate.ipcress.run_command_to_file")
+    def test_run_ipcress_scratch_dir(self, p1):
+        scratch_dir = os.path.join(self.temp_dir.name, "scratch")
+        os.mkdir(scratch_dir)
+
+        def fake_ipcress(cmd, out, verbose):
+            self.assertEqual(os.path.dirname(out.name), scratch_dir)
+            out.write(self.ipcress_out.encode())
+            out.flush()
+
+        p1.side_effect = fake_ipcress
+        obs = list(_run_ipcress("t.fasta", "e.ipcress", 12, 32, 0, True, scratch_dir))
+
+        self.assertListEqual(obs, self.products)
+        # the output file is removed once it has been parsed
+        self.assertListEqual(os.listdir(scratch_dir), [])
 
     def test_extract_pcr_meta(self):
         obs = _extract_pcr_meta(self.products)
         pd.testing.assert_frame_equal(obs, self.pcr_prod_df)
 
+    def test_extract_pcr_meta_large_positions(self):
+        products = copy.deepcopy(self.products)
+        products[0]["start_position"] = 2**31
+
+        obs = _extract_pcr_meta(iter(products))
+
+        self.assertEqual(obs["start_position"].dtype, "int64")
+        self.assertEqual(obs["start_position"].iloc[0], 2**31)
+        self.assertEqual(obs["length"].dtype, "int32")
+
+    def test_extract_pcr_meta_batches(self):
+        products = copy.deepcopy(self.products) * 2
+        products[-1]["start_position"] = 2**31
+
+        with patch("q2_exonerate.ipcress.META_BATCH_SIZE", 3):
+            obs = _extract_pcr_meta(products)
+
+        pd.testing.assert_frame_equal(obs, _extract_pcr_meta(products))
+        self.assertEqual(obs["start_position"].dtype, "int64")
+        self.assertListEqual(
+            obs["experiment"].cat.categories.tolist(),
+            sorted({p["experiment"] for p in products}),
+        )
+
     def test_dump_seqs_to_file(self):
         obs = _dump_seqs_to_file(self.products)
         self.assertIsInstance(obs, DNAFASTAFormat)
@@ -108,13 +245,168 @@ class TestIPCRess(TestPluginBase):
             )
             self.assertEqual(str(seq), self.products[i]["sequence"])
 
-    @patch("subprocess.run")
+    def test_dump_seqs_to_file_line_width(self):
+        obs = _dump_seqs_to_file(self.products[:1], line_width=40)
+
+        with open(str(obs)) as fh:
+            lines = fh.read().splitlines()
+        self.assertListEqual(
+            lines,
+            [
+                ">ITS9mun_product_1_seq_NC_012867.1:filter(unmasked)_start_1864982_"
+                "length_2072",
+                self.products[0]["sequence"][:40],
+                self.products[0]["sequence"][40:],
+            ],
+        )
+
+    def test_write_products_drops_sequences(self):
+        fh = io.StringIO()
+
+        obs = list(_write_products(iter(self.products), fh))
+
+        self.assertNotIn("sequence", obs[0])
+        self.assertEqual(obs[1]["id"], self.products[1]["id"])
+        self.assertEqual(fh.getvalue().count(">"), 2)
+        self.assertIn("sequence", self.products[0])
+
+    def _product(self, experiment, template, n):
+        return {
+            "experiment": experiment,
+            "target": f"{template}:filter(unmasked) some description",
+            "id": f"{experiment}_product_{n} seq {template}:filter(unmasked) "
+            "start 1 length 10",
+        }
+
+    def test_template_id(self):
+        self.assertEqual(_template_id(self.products[0]["target"]), "NC_012867.1")
+        self.assertEqual(_template_id("chr1:5:filter(unmasked) desc"), "chr1:5")
+        self.assertEqual(_template_id("seq1"), "seq1")
+
+    def test_renumber_products(self):
+        products = [
+            self._product("A", "s1", 1),
+            self._product("B", "s1", 1),
+            self._product("A", "s2", 1),
+        ]
+        obs = [p["id"] for p in _renumber_products(products)]
+        self.assertListEqual(
+            obs,
+            [
+                "A_product_1 seq s1:filter(unmasked) start 1 length 10",
+                "B_product_1 seq s1:filter(unmasked) start 1 length 10",
+                "A_product_2 seq s2:filter(unmasked) start 1 length 10",
+            ],
+        )
+
+    def test_merge_shard_products(self):
+        ranks = {"s1": 0, "s2": 1, "s3": 2, "s4": 3}
+        shards = [
+            [self._product("A", "s1", 1), self._product("A", "s3", 2)],
+            [self._product("A", "s2", 1), self._product("A", "s4", 2)],
+        ]
+        obs = [
+            p["id"].split(" ")[0] + " " + p["target"].split(":")[0]
+            for p in _merge_shard_products(shards, ranks)
+        ]
+        self.assertListEqual(
+            obs,
+            ["A_product_1 s1", "A_product_2 s2", "A_product_3 s3", "A_product_4 s4"],
+        )
+
+    def _window_product(self, window, start):
+        return {
+            "experiment": "A",
+            "target": f"{window}:filter(unmasked) desc",
+            "match_orientation": "forward",
+            "length": 10,
+            "start_position": start,
+            "id": f"A_product_1 seq {window}:filter(unmasked) start {start} "
+            "length 10",
+        }
+
+    def test_unwindow_products(self):
+        windows = {"s1:window:0": ("s1", 0), "s1:window:50": ("s1", 50)}
+        products = [
+            self._window_product("s1:window:0", 5),
+            self._window_product("s1:window:0", 55),
+            # the same product as above, found in the overlapping window
+            self._window_product("s1:window:50", 5),
+            self._window_product("s1:window:50", 30),
+            self._window_product("s2", 30),
+        ]
+
+        obs = list(_unwindow_products(products, windows))
+
+        self.assertListEqual(
+            [(p["target"], p["start_position"]) for p in obs],
+            [
+                ("s1:filter(unmasked) desc", 5),
+                ("s1:filter(unmasked) desc", 55),
+                ("s1:filter(unmasked) desc", 80),
+                ("s2:filter(unmasked) desc", 30),
+            ],
+        )
+        self.assertEqual(
+            obs[2]["id"], "A_product_1 seq s1:filter(unmasked) start 80 length 10"
+        )
+
+    def test_unwindow_products_by_start(self):
+        windows = {"s1:window:0": ("s1", 0), "s1:window:50": ("s1", 50)}
+        late = self._window_product("s1:window:50", 5)
+        late["experiment"] = "B"
+        products = [
+            self._window_product("s1:window:0", 10),
+            self._window_product("s1:window:0", 55),
+            late,
+            # starts in the overlap, but is only found in the second window
+            self._window_product("s1:window:50", 2),
+        ]
+
+        obs = list(_unwindow_products(products, windows, ["B", "A"]))
+
+        self.assertListEqual(
+            [(p["experiment"], p["start_position"]) for p in obs],
+            [("B", 55), ("A", 10), ("A", 52), ("A", 55)],
+        )
+
+    def test_merge_shard_products_windows(self):
+        windows = {"s1:window:0": ("s1", 0), "s1:window:50": ("s1", 50)}
+        ranks = {"s1:window:0": 0, "s1:window:50": 0, "s1": 0, "s2": 1}
+        shards = [
+            [self._window_product("s1:window:50", 5)],
+            [
+                self._window_product("s1:window:0", 55),
+                self._window_product("s2", 1),
+            ],
+        ]
+
+        obs = [p["id"] for p in _merge_shard_products(shards, ranks, windows)]
+
+        self.assertListEqual(
+            obs,
+            [
+                "A_product_1 seq s1:filter(unmasked) start 55 length 10",
+                "A_product_2 seq s2:filter(unmasked) start 1 length 10",
+            ],
+        )
+
+    def _mock_ipcress(self, output):
+        return MagicMock(
+            stdout=io.BytesIO(output.encode()),
+            stderr=io.BytesIO(),
+            wait=MagicMock(return_value=0),
+        )
+
+    @patch("subprocess.Popen")
     def test_simulate_pcr(self, p1):
         template = DNAFASTAFormat()
         experiments = IPCRessExperimentFormat()
-        p1.return_value = MagicMock(stdout=str.encode(self.ipcress_out))
+        p1.return_value = self._mock_ipcress(self.ipcress_out)
 
-        obs_results, obs_meta = simulate_pcr(template, experiments, 12, 32, 1)
+        obs_results, obs_meta = simulate_pcr(
+            template, experiments, 12, 32, 1, pretty=True
+        )
 
         p1.assert_called_once_with(
             [
@@ -132,12 +424,451 @@ class TestIPCRess(TestPluginBase):
                 "-p",
                 "-P",
             ],
-            check=True,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stderr=ANY,
         )
         self.assertIsInstance(obs_results, DNAFASTAFormat)
         self.assertIsInstance(obs_meta, pd.DataFrame)
+        self.assertEqual(len(obs_meta), 2)
+
+    @patch("subprocess.Popen")
+    def test_simulate_pcr_compact(self, p1):
+        templates = DNAFASTAFormat(self.get_data_path("templates_described.fasta"), "r")
+        experiments = IPCRessExperimentFormat(
+            self.get_data_path("experiments.ipcress"), "r"
+        )
+        with open(self.get_data_path("ipcress_out_compact.txt")) as fh:
+            p1.return_value = self._mock_ipcress(fh.read())
+
+        _, obs_meta = simulate_pcr(templates, experiments, 12, 32, 1)
+
+        self.assertListEqual(p1.call_args.args[0][-4:], ["-p", "FALSE", "-P", "TRUE"])
+        self.assertListEqual(
+            obs_meta["target"].tolist(), [p["target"] for p in self.products]
+        )
+        self.assertListEqual(obs_meta["matches_fwd"].tolist(), ["17/17", "17/17"])
+
+    @patch("subprocess.Popen")
+    def test_simulate_pcr_stats_log(self, p1):
+        templates = DNAFASTAFormat(self.get_data_path("templates_described.fasta"), "r")
+        experiments = IPCRessExperimentFormat(
+            self.get_data_path("experiments.ipcress"), "r"
+        )
+        with open(self.get_data_path("ipcress_out_compact.txt")) as fh:
+            output = fh.read()
+        p1.return_value = self._mock_ipcress(output)
+        stats_log = os.path.join(self.temp_dir.name, "stats.jsonl")
+
+        simulate_pcr(templates, experiments, stats_log=stats_log)
+
+        with open(stats_log) as fh:
+            obs = json.loads(fh.read())
+        self.assertEqual(obs["products"], 2)
+        self.assertEqual(obs["ipcress_output_bytes"], len(output.encode()))
+        self.assertTrue(
+            {"ipcress", "parse", "write", "metadata"} <= obs["stages"].keys()
+        )
+
+    @patch("q2_exonerate.ipcress._run_ipcress")
+    def test_simulate_pcr_retries(self, p1):
+        # ipcress times out on anything but a single template
+        def fail(ids):
+            if len(ids) > 1:
+                raise subprocess.TimeoutExpired(["ipcress"], 1)
+
+        p1.side_effect = self._fake_ipcress([], fail)
+        templates = DNAFASTAFormat(self.get_data_path("templates.fasta"), "r")
+        experiments = self._experiments("ITS9mun")
+
+        with self.assertRaises(subprocess.TimeoutExpired):
+            simulate_pcr(templates, experiments, timeout=1, retries=1)
+
+        p1.reset_mock()
+        _, obs_meta = simulate_pcr(templates, experiments, timeout=1, retries=2)
+
+        # 4 templates, then 2 halves of 2 templates, then 4 single templates
+        self.assertEqual(p1.call_count, 7)
+        self.assertEqual(p1.call_args.kwargs["limits"]["timeout"], 1)
+        self.assertListEqual(
+            obs_meta.index.tolist(),
+            [f"ITS9mun_product_{i} seq seq{i}" for i in range(1, 5)],
+        )
+
+    @patch("q2_exonerate._scheduling.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("q2_exonerate.ipcress._ipcress_version", return_value="ipcress 2.2.0")
+    @patch("q2_exonerate.ipcress._run_ipcress")
+    def test_simulate_pcr_checkpoints(self, p1, p2):
+        searched = []
+
+        def fail(ids):
+            if interrupted:
+                # the run is interrupted once all shards are being searched
+                started.wait()
+                if "seq3" in ids:
+                    raise RuntimeError("preempted")
+
+        p1.side_effect = self._fake_ipcress(searched, fail)
+        templates = DNAFASTAFormat(self.get_data_path("templates.fasta"), "r")
+        experiments = self._experiments("ITS9mun")
+        checkpoint_dir = os.path.join(self.temp_dir.name, "checkpoints")
+
+        interrupted, started = True, threading.Barrier(3)
+        with self.assertRaises(RuntimeError):
+            simulate_pcr(
+                templates, experiments, n_jobs=3, checkpoint_dir=checkpoint_dir
+            )
+        self.assertEqual(p1.call_count, 3)
+
+        # only the shard which did not finish is searched again
+        interrupted = False
+        searched.clear()
+        _, obs_meta = simulate_pcr(
+            templates, experiments, n_jobs=3, checkpoint_dir=checkpoint_dir
+        )
+        self.assertEqual(p1.call_count, 4)
+        self.assertIn("seq3", searched[0][0])
+        self.assertLess(len(searched[0][0]), 4)
+        self.assertListEqual(
+            obs_meta.index.tolist(),
+            [f"ITS9mun_product_{i} seq seq{i}" for i in range(1, 5)],
+        )
+
+        # a finished run is read back entirely
+        _, obs_resumed = simulate_pcr(
+            templates, experiments, n_jobs=3, checkpoint_dir=checkpoint_dir
+        )
+        self.assertEqual(p1.call_count, 4)
+        pd.testing.assert_frame_equal(obs_resumed, obs_meta)
+
+        # with products spilled to disk
+        _, obs_spilled = simulate_pcr(
+            templates,
+            experiments,
+            n_jobs=3,
+            checkpoint_dir=checkpoint_dir,
+            max_product_memory=1,
+        )
+        self.assertEqual(p1.call_count, 4)
+        pd.testing.assert_frame_equal(obs_spilled, obs_meta)
+
+    @patch("q2_exonerate.ipcress.CHECKPOINT_SHARD_SIZE", 20)
+    @patch("q2_exonerate.ipcress._ipcress_version", return_value="ipcress 2.2.0")
+    @patch("q2_exonerate.ipcress._run_ipcress")
+    def test_simulate_pcr_checkpoints_serial(self, p1, p2):
+        searched = []
+        p1.side_effect = self._fake_ipcress(searched)
+        templates = DNAFASTAFormat(self.get_data_path("templates.fasta"), "r")
+        experiments = IPCRessExperimentFormat(
+            self.get_data_path("experiments.ipcress"), "r"
+        )
+        checkpoint_dir = os.path.join(self.temp_dir.name, "checkpoints")
+
+        _, obs_meta = simulate_pcr(
+            templates, experiments, checkpoint_dir=checkpoint_dir
+        )
+
+        # 58 bp of templates are searched in shards of at most 20 bp
+        self.assertEqual(p1.call_count, 3)
+        self.assertCountEqual(
+            [seq_id for ids, _ in searched for seq_id in ids],
+            ["seq1", "seq2", "seq3", "seq4"],
+        )
+        _, exp_meta = simulate_pcr(templates, experiments, n_jobs=3)
+        pd.testing.assert_frame_equal(obs_meta, exp_meta)
+
+    def test_split_unit(self):
+        templates_fp = os.path.join(self.temp_dir.name, "templates.fasta")
+        with open(templates_fp, "w") as fh:
+            fh.write(">a\nAC\nGT\n>b\nAA\n>c\nCC\n")
+        unit = dict(templates_fp=templates_fp, spill_dir=self.temp_dir.name, seed=12)
+
+        obs = _split_unit(unit)
+
+        self.assertEqual([half["seed"] for half in obs], [12, 12])
+        halves = []
+        for half in obs:
+            with open(half["templates_fp"]) as fh:
+                halves.append(fh.read())
+        self.assertListEqual(halves, [">a\nAC\nGT\n", ">b\nAA\n>c\nCC\n"])
+
+        with open(templates_fp, "w") as fh:
+            fh.write(">a\nACGT\n")
+        self.assertIsNone(_split_unit(unit))
+
+    @patch("q2_exonerate._scheduling.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("q2_exonerate.ipcress._run_ipcress")
+    def test_simulate_pcr_parallel(self, p1):
+        # every shard finds one product on each of its templates
+        p1.side_effect = self._fake_ipcress([])
+        templates = DNAFASTAFormat(self.get_data_path("templates.fasta"), "r")
+        experiments = self._experiments("ITS9mun")
+
+        obs_results, obs_meta = simulate_pcr(templates, experiments, n_jobs=3)
+
+        self.assertEqual(p1.call_count, 3)
+        self.assertListEqual(
+            obs_meta.index.tolist(),
+            [f"ITS9mun_product_{i} seq seq{i}" for i in range(1, 5)],
+        )
+
+        # products spilled to disk by the workers are merged the same way
+        with patch("q2_exonerate._store.PRODUCT_OVERHEAD", 2**20):
+            _, obs_spilled = simulate_pcr(
+                templates, experiments, n_jobs=3, max_product_memory=1
+            )
+        pd.testing.assert_frame_equal(obs_spilled, obs_meta)
+
+    @patch("q2_exonerate.ipcress._run_ipcress")
+    def test_simulate_pcr_experiment_batches(self, p1):
+        # each batch finds a product of its experiment on seq2 and seq1
+        def fake_ipcress(templates_fp, experiments_fp, *args, **kwargs):
+            with open(experiments_fp) as fh:
+                experiment = fh.read().split()[0]
+            for seq_id in ("seq1", "seq2"):
+                product = copy.deepcopy(self.products[0])
+                product["experiment"] = experiment
+                product["target"] = f"{seq_id}:filter(unmasked) desc"
+                product["id"] = f"{experiment}_product_1 seq {seq_id}:filter"
+                yield product
+
+        p1.side_effect = fake_ipcress
+        templates = DNAFASTAFormat(self.get_data_path("templates.fasta"), "r")
+        experiments = IPCRessExperimentFormat(
+            self.get_data_path("experiments.ipcress"), "r"
+        )
+
+        _, obs_meta = simulate_pcr(templates, experiments, experiment_batch_size=1)
+
+        self.assertEqual(p1.call_count, 2)
+        self.assertListEqual(
+            obs_meta.index.tolist(),
+            [
+                "ITS9mun_product_1 seq seq1",
+                "ITS1_product_1 seq seq1",
+                "ITS9mun_product_2 seq seq2",
+                "ITS1_product_2 seq seq2",
+            ],
+        )
+
+    @patch("q2_exonerate.ipcress._ipcress_version", return_value="2.4.0")
+    @patch("subprocess.Popen")
+    def test_simulate_pcr_cached(self, p1, p2):
+        templates = DNAFASTAFormat(self.get_data_path("templates_described.fasta"), "r")
+        experiments = IPCRessExperimentFormat(
+            self.get_data_path("experiments.ipcress"), "r"
+        )
+        with open(self.get_data_path("ipcress_out_compact.txt")) as fh:
+            output = fh.read()
+        p1.side_effect = lambda *args, **kwargs: self._mock_ipcress(output)
+        cache_dir = os.path.join(self.temp_dir.name, "cache")
+
+        exp_results, exp_meta = simulate_pcr(
+            templates, experiments, cache_dir=cache_dir
+        )
+        obs_results, obs_meta = simulate_pcr(
+            templates, experiments, cache_dir=cache_dir
+        )
+
+        p1.assert_called_once()
+        pd.testing.assert_frame_equal(obs_meta, exp_meta)
+        with open(str(obs_results)) as obs, open(str(exp_results)) as exp:
+            self.assertEqual(obs.read(), exp.read())
+
+        # a different parameter is a cache miss
+        simulate_pcr(templates, experiments, mismatch=1, cache_dir=cache_dir)
+        self.assertEqual(p1.call_count, 2)
+
+    def _experiments(self, *names):
+        # the experiments of the test data with the given names
+        with open(self.get_data_path("experiments.ipcress")) as fh:
+            rows = [line for line in fh if line.split()[0] in names]
+        experiments = IPCRessExperimentFormat()
+        with open(str(experiments), "w") as fh:
+            fh.writelines(rows)
+        return experiments
+
+    def _fake_ipcress(self, searched, fail=None):
+        # every experiment finds one product on every template, unless
+        # fail(template IDs) raises
+        def fake_ipcress(templates_fp, experiments_fp, *args, **kwargs):
+            with open(templates_fp) as fh:
+                headers = [line[1:].split() for line in fh if line.startswith(">")]
+            with open(experiments_fp) as fh:
+                experiments = [line.split()[0] for line in fh]
+            searched.append(([header[0] for header in headers], experiments))
+            if fail is not None:
+                fail([header[0] for header in headers])
+            for seq_id, *description in headers:
+                for experiment in experiments:
+                    product = copy.deepcopy(self.products[0])
+                    product["experiment"] = experiment
+                    product["target"] = " ".join(
+                        [f"{seq_id}:filter(unmasked)", *description]
+                    )
+                    product["id"] = (
+                        f"{experiment}_product_1 seq {seq_id}:filter(unmasked) "
+                        "start 1 length 10"
+                    )
+                    yield product
+
+        return fake_ipcress
+
+    @patch("q2_exonerate.ipcress._ipcress_version", return_value="2.4.0")
+    @patch("q2_exonerate.ipcress._run_ipcress")
+    def test_simulate_pcr_cached_experiments(self, p1, p2):
+        searched = []
+        p1.side_effect = self._fake_ipcress(searched)
+        templates = DNAFASTAFormat(self.get_data_path("templates.fasta"), "r")
+        experiments = IPCRessExperimentFormat(
+            self.get_data_path("experiments.ipcress"), "r"
+        )
+        first = IPCRessExperimentFormat()
+        with open(str(first), "w") as fh:
+            fh.write("ITS1 CCTNGTTGATYCTGCCAGT CCTCCSCTTANTDATATGC 100 2500\n")
+        cache_dir = os.path.join(self.temp_dir.name, "cache")
+
+        simulate_pcr(templates, first, cache_dir=cache_dir)
+        _, obs_meta = simulate_pcr(templates, experiments, cache_dir=cache_dir)
+
+        self.assertListEqual([exps for _, exps in searched], [["ITS1"], ["ITS9mun"]])
+        _, exp_meta = simulate_pcr(templates, experiments, experiment_batch_size=1)
+        pd.testing.assert_frame_equal(obs_meta, exp_meta)
+
+    @patch("q2_exonerate.ipcress._ipcress_version", return_value="2.4.0")
+    @patch("q2_exonerate.ipcress._run_ipcress")
+    def test_simulate_pcr_cached_templates(self, p1, p2):
+        searched = []
+        p1.side_effect = self._fake_ipcress(searched)
+        templates = DNAFASTAFormat(self.get_data_path("templates.fasta"), "r")
+        experiments = IPCRessExperimentFormat(
+            self.get_data_path("experiments.ipcress"), "r"
+        )
+        # the next release renames seq1, drops seq2 and adds seq5
+        release = DNAFASTAFormat()
+        with open(str(release), "w") as fh:
+            fh.write(
+                ">seq1b renamed template\nACGTACGTACGTACGT\n"
+                ">seq3 third template\nACGT\n"
+                ">seq4\nGGGGGGGGGGGGGGGGGGGGGG\n"
+                ">seq5 new template\nTTTTAAAA\n"
+            )
+        cache_dir = os.path.join(self.temp_dir.name, "cache")
+
+        simulate_pcr(templates, experiments, cache_dir=cache_dir)
+        _, obs_meta = simulate_pcr(release, experiments, cache_dir=cache_dir)
+
+        self.assertTupleEqual(searched[1], (["seq5"], ["ITS9mun", "ITS1"]))
+        _, exp_meta = simulate_pcr(release, experiments, experiment_batch_size=1)
+        pd.testing.assert_frame_equal(obs_meta, exp_meta)
+        self.assertListEqual(
+            obs_meta.index.tolist()[:2],
+            ["ITS9mun_product_1 seq seq1b", "ITS1_product_1 seq seq1b"],
+        )
+
+    @patch("q2_exonerate.ipcress._ipcress_version", return_value="2.4.0")
+    @patch("q2_exonerate.ipcress._run_ipcress")
+    def test_simulate_pcr_cached_templates_pruned(self, p1, p2):
+        searched = []
+        fake_ipcress = self._fake_ipcress(searched)
+        # nothing is found on seq3
+        p1.side_effect = lambda *args, **kwargs: (
+            product
+            for product in fake_ipcress(*args, **kwargs)
+            if not product["target"].startswith("seq3:")
+        )
+        templates = DNAFASTAFormat(self.get_data_path("templates.fasta"), "r")
+        experiments = IPCRessExperimentFormat(
+            self.get_data_path("experiments.ipcress"), "r"
+        )
+        release = DNAFASTAFormat()
+        with open(str(release), "w") as fh:
+            fh.write(">seq3 third template\nACGT\n>seq5 new template\nTTTTAAAA\n")
+        cache_dir = os.path.join(self.temp_dir.name, "cache")
+
+        simulate_pcr(templates, experiments, cache_dir=cache_dir)
+        simulate_pcr(release, experiments, cache_dir=cache_dir)
+        # templates without products are cached as well (the line width
+        # only misses the cached results of the whole run)
+        simulate_pcr(release, experiments, line_width=10, cache_dir=cache_dir)
+
+        self.assertEqual(len(searched), 2)
+        exp_hashes = {seq_hash for _, _, seq_hash in _hash_records(str(release))}
+        # the entries of the experiments, besides those of the whole runs
+        indices = [
+            os.path.join(cache_dir, name, CACHED_EXPERIMENT_INDEX)
+            for name in os.listdir(cache_dir)
+            if os.path.exists(os.path.join(cache_dir, name, CACHED_EXPERIMENT_INDEX))
+        ]
+        self.assertEqual(len(indices), 2)
+        for index_fp in indices:
+            with open(index_fp, "rb") as fh:
+                ranges = pickle.load(fh)
+            self.assertSetEqual(set(ranges), exp_hashes)
+            self.assertEqual(sum(map(len, ranges.values())), 1)
+
+    @patch("q2_exonerate.ipcress._run_ipcress")
+    def test_simulate_pcr_duplicate_templates(self, p1):
+        searched = []
+        p1.side_effect = self._fake_ipcress(searched)
+        templates = DNAFASTAFormat()
+        with open(str(templates), "w") as fh:
+            fh.write(
+                ">s1 first\nAAAA\n>s2\nCCCC\n>s3 third\nAA\nAA\n"
+                ">s4\nCCCC\n>s5\nGGGG\n"
+            )
+        experiments = IPCRessExperimentFormat(
+            self.get_data_path("experiments.ipcress"), "r"
+        )
+
+        obs_results, obs_meta = simulate_pcr(templates, experiments)
+
+        self.assertListEqual(searched[0][0], ["s1", "s2", "s5"])
+        self.assertListEqual(
+            obs_meta.index.tolist(),
+            [
+                f"{experiment}_product_{i} seq s{i}"
+                for i in range(1, 6)
+                for experiment in ("ITS9mun", "ITS1")
+            ],
+        )
+        self.assertListEqual(
+            obs_meta["target"].tolist()[::2],
+            [
+                "s1:filter(unmasked) first",
+                "s2:filter(unmasked)",
+                "s3:filter(unmasked) third",
+                "s4:filter(unmasked)",
+                "s5:filter(unmasked)",
+            ],
+        )
+        self.assertEqual(len(list(obs_results.view(DNAIterator))), 10)
+
+    @patch("q2_exonerate.ipcress._run_ipcress")
+    def test_simulate_pcr_prefilter(self, p1):
+        # none of the test templates contains any of the primers
+        templates = DNAFASTAFormat(self.get_data_path("templates.fasta"), "r")
+        experiments = IPCRessExperimentFormat(
+            self.get_data_path("experiments.ipcress"), "r"
+        )
+
+        with self.assertRaisesRegex(ValueError, "No hits were found"):
+            simulate_pcr(templates, experiments, prefilter=True)
+        p1.assert_not_called()
+
+    @patch("subprocess.Popen")
+    def test_simulate_pcr_no_hits(self, p1):
+        p1.return_value = self._mock_ipcress("-- completed ipcress analysis\n")
+        with self.assertRaisesRegex(ValueError, "No hits were found"):
+            simulate_pcr(DNAFASTAFormat(), IPCRessExperimentFormat())
+
+    @patch("subprocess.Popen")
+    def test_simulate_pcr_no_templates_memory_budget(self, p1):
+        experiments = IPCRessExperimentFormat(
+            self.get_data_path("experiments.ipcress"), "r"
+        )
+        with self.assertRaisesRegex(ValueError, "No hits were found"):
+            simulate_pcr(DNAFASTAFormat(), experiments, n_jobs=2, memory_budget=1000)
+        p1.assert_not_called()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import os
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+from q2_types.feature_data import DNAFASTAFormat, DNAIterator
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_exonerate._native import _count_mismatches, _encode, _revcomp, _run_native
+from q2_exonerate.ipcress import simulate_pcr
+from q2_exonerate.types._format import IPCRessExperimentFormat
+
+FWD = "GTACACACCGCCCGTCG"
+REV = "TGYTACTACCWCCAAGATC"
+# REV resolved to one of the sequences it stands for
+REV_SITE = "TGCTACTACCACCAAGATC"
+SPACER = "AT" * 30
+
+
+class TestNative(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def setUp(self):
+        super().setUp()
+        self.experiments_fp = os.path.join(self.temp_dir.name, "exp.ipcress")
+        with open(self.experiments_fp, "w") as fh:
+            fh.write(f"ITS9mun {FWD} {REV} 50 200\n")
+
+    def _run(self, templates, mismatch=0):
+        templates_fp = os.path.join(self.temp_dir.name, "templates.fasta")
+        with open(templates_fp, "w") as fh:
+            for header, seq in templates.items():
+                fh.write(f">{header}\n{seq}\n")
+        return list(_run_native(templates_fp, self.experiments_fp, mismatch))
+
+    def test_revcomp(self):
+        self.assertEqual(_revcomp("ACGTNRY"), "RYNACGT")
+
+    def test_count_mismatches(self):
+        obs = _count_mismatches(_encode(b"ACGTNACGT"), _encode(b"ACR"))
+        np.testing.assert_array_equal(obs, [0, 3, 2, 1, 2, 0, 3])
+
+    def test_count_mismatches_short_template(self):
+        self.assertEqual(len(_count_mismatches(_encode(b"AC"), _encode(b"ACG"))), 0)
+
+    def test_run_native_forward(self):
+        product = FWD + SPACER + _revcomp(REV_SITE)
+        obs = self._run({"t1 first template": "CCC" + product + "CCC"})
+
+        self.assertEqual(len(obs), 1)
+        self.assertDictEqual(
+            obs[0],
+            {
+                "experiment": "ITS9mun",
+                "target": "t1:filter(unmasked)",
+                "match_orientation": "forward",
+                "matches_fwd": "17/17",
+                "matches_rev": "19/19",
+                "length": len(product),
+                "range_min": 50,
+                "range_max": 200,
+                "start_position": 3,
+                "sequence": product,
+                "id": f"ITS9mun_product_1 seq t1:filter(unmasked) start 3 "
+                f"length {len(product)}",
+            },
+        )
+
+    def test_run_native_revcomp(self):
+        product = REV_SITE + SPACER + _revcomp(FWD)
+        obs = self._run({"t1": product})
+
+        self.assertEqual(len(obs), 1)
+        self.assertEqual(obs[0]["match_orientation"], "revcomp")
+        self.assertEqual(obs[0]["sequence"], _revcomp(product))
+        self.assertEqual(
+            (obs[0]["matches_fwd"], obs[0]["matches_rev"]), ("17/17", "19/19")
+        )
+
+    def test_run_native_mismatches(self):
+        # a single mismatch at the 3' end of the forward primer
+        product = FWD[:-1] + "A" + SPACER + _revcomp(REV_SITE)
+
+        self.assertListEqual(self._run({"t1": product}), [])
+        obs = self._run({"t1": product}, mismatch=1)
+        self.assertEqual(obs[0]["matches_fwd"], "16/17")
+
+    def test_run_native_lengths(self):
+        too_long = FWD + SPACER * 3 + _revcomp(REV_SITE)
+        too_short = FWD + _revcomp(REV_SITE)
+        self.assertListEqual(self._run({"t1": too_long, "t2": too_short}), [])
+
+    def test_run_native_single_primer(self):
+        product = FWD + SPACER + _revcomp(FWD)
+        obs = self._run({"t1": product})
+        self.assertListEqual([p["match_orientation"] for p in obs], ["single_A"])
+
+    def test_run_native_numbering(self):
+        product = FWD + SPACER + _revcomp(REV_SITE)
+        obs = self._run({"t1": product + "C" * 300 + product, "t2": product})
+        self.assertListEqual(
+            [(p["id"].split()[0], p["start_position"]) for p in obs],
+            [
+                ("ITS9mun_product_1", 0),
+                ("ITS9mun_product_2", len(product) + 300),
+                ("ITS9mun_product_3", 0),
+            ],
+        )
+
+    def test_run_native_shared_primers(self):
+        # the second experiment shares its forward primer with the first
+        with open(self.experiments_fp, "a") as fh:
+            fh.write(f"ITS9mun2 {FWD} {REV_SITE} 50 200\n")
+        product = FWD + SPACER + _revcomp(REV_SITE)
+
+        with patch(
+            "q2_exonerate._native._count_mismatches", wraps=_count_mismatches
+        ) as count:
+            obs = self._run({"t1": product})
+
+        # FWD, REV and REV_SITE on both strands
+        self.assertEqual(count.call_count, 6)
+        self.assertListEqual([p["experiment"] for p in obs], ["ITS9mun", "ITS9mun2"])
+
+    @patch("subprocess.Popen")
+    def test_simulate_pcr_native(self, p1):
+        templates = DNAFASTAFormat(self.get_data_path("templates.fasta"), "r")
+        with open(str(templates)) as fh:
+            fasta = fh.read().replace(
+                ">seq2\n", f">seq2\n{FWD}{SPACER}{_revcomp(REV_SITE)}"
+            )
+        templates = DNAFASTAFormat()
+        with open(str(templates), "w") as fh:
+            fh.write(fasta)
+        experiments = IPCRessExperimentFormat(self.experiments_fp, "r")
+
+        obs_results, obs_meta = simulate_pcr(templates, experiments, engine="native")
+
+        p1.assert_not_called()
+        self.assertListEqual(
+            obs_meta.columns.tolist(),
+            [
+                "experiment",
+                "target",
+                "match_orientation",
+                "matches_fwd",
+                "matches_rev",
+                "length",
+                "range_min",
+                "range_max",
+                "start_position",
+                "matches_fwd_frac",
+                "matches_rev_frac",
+            ],
+        )
+        self.assertListEqual(obs_meta.index.tolist(), ["ITS9mun_product_1 seq seq2"])
+        self.assertEqual(obs_meta["matches_rev_frac"].iloc[0], 1.0)
+        self.assertEqual(len(list(obs_results.view(DNAIterator))), 1)
+
+    def test_simulate_pcr_stats_log(self):
+        templates = DNAFASTAFormat()
+        with open(str(templates), "w") as fh:
+            fh.write(f">t1\n{FWD}{SPACER}{_revcomp(REV_SITE)}\n")
+        experiments = IPCRessExperimentFormat(self.experiments_fp, "r")
+        stats_log = os.path.join(self.temp_dir.name, "stats.jsonl")
+
+        simulate_pcr(templates, experiments, engine="native", stats_log=stats_log)
+
+        with open(stats_log) as fh:
+            obs = json.loads(fh.read())
+        self.assertEqual(obs["action"], "simulate_pcr")
+        self.assertEqual(obs["products"], 1)
+        self.assertTrue({"native", "write", "metadata"} <= obs["stages"].keys())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,238 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import random
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_exonerate._prefilter import (
+    _build_template_index,
+    _encode_kmer,
+    _prefilter_templates,
+    _primer_seeds,
+    _scan_template,
+    _seed_size,
+)
+from q2_exonerate._sharding import _iter_fasta_records
+
+FWD = "GTACACACCGCCCGTCG"
+REV = "TGYTACTACCWCCAAGATC"
+
+
+def _revcomp(seq):
+    return seq.translate(str.maketrans("ACGT", "TGCA"))[::-1]
+
+
+def _resolve(primer, rng):
+    # pick one of the bases every degenerate position stands for
+    options = {"Y": "CT", "W": "AT"}
+    return "".join(rng.choice(options.get(base, base)) for base in primer)
+
+
+def _mutate(seq, n, rng):
+    seq = list(seq)
+    for i in rng.sample(range(len(seq)), n):
+        seq[i] = rng.choice([b for b in "ACGT" if b != seq[i]])
+    return "".join(seq)
+
+
+class TestPrefilter(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def setUp(self):
+        super().setUp()
+        self.experiments_fp = os.path.join(self.temp_dir.name, "exp.ipcress")
+        with open(self.experiments_fp, "w") as fh:
+            fh.write(f"ITS9mun {FWD} {REV} 50 200\n")
+        self.rng = random.Random(42)
+
+    def _random(self, n):
+        return "".join(self.rng.choice("ACGT") for _ in range(n))
+
+    def _prefilter(self, templates, mismatch=0, template_index=None):
+        templates_fp = os.path.join(self.temp_dir.name, "templates.fasta")
+        out_fp = os.path.join(self.temp_dir.name, "candidates.fasta")
+        with open(templates_fp, "w") as fh:
+            for seq_id, seq in templates.items():
+                fh.write(f">{seq_id}\n{seq}\n")
+        kept = _prefilter_templates(
+            templates_fp, self.experiments_fp, mismatch, out_fp, template_index
+        )
+        if kept is None:
+            return None
+        ids = [header[1:].strip() for header, _ in _iter_fasta_records(out_fp)]
+        self.assertEqual(kept, len(ids))
+        return ids
+
+    def test_seed_size(self):
+        self.assertEqual(_seed_size([["A", FWD, REV, "1", "2"]], 0), 17)
+        self.assertEqual(_seed_size([["A", FWD, REV, "1", "2"]], 2), 5)
+
+    def test_primer_seeds(self):
+        up, down = _primer_seeds("ACGTANACGT", 1, 4)
+        self.assertSetEqual(
+            up, {_encode_kmer(k) for k in ("ACGT", "AACG", "CACG", "GACG", "TACG")}
+        )
+        self.assertIn(_encode_kmer("ACGT"), down)
+        self.assertIn(_encode_kmer("CGTT"), down)
+
+    @patch("q2_exonerate._prefilter.SCAN_BLOCK_SIZE", 4)
+    def test_scan_template_runs(self):
+        seq = ["ACGTNACGTACG\n", "TACGTACRYACG\n"]
+        seeds = {_encode_kmer("ACGT"): [(0, 0)]}
+
+        hits, runs = _scan_template(seq, 4, seeds, np.array(list(seeds)))
+
+        # runs are merged across the scanned blocks
+        self.assertListEqual(runs.tolist(), [[1, 5], [16, 21]])
+        self.assertListEqual(np.concatenate(hits[0, 0]).tolist(), [0, 5, 9, 13])
+
+    def test_prefilter_templates(self):
+        product = FWD + self._random(60) + _revcomp(_resolve(REV, self.rng))
+        templates = {
+            "forward": self._random(100) + product + self._random(100),
+            "revcomp": _revcomp(self._random(50) + product),
+            "no_site": self._random(500),
+            "one_site": self._random(100) + FWD + self._random(500),
+            "too_far": FWD + self._random(400) + _revcomp(_resolve(REV, self.rng)),
+            "short": "ACGT",
+        }
+
+        obs = self._prefilter(templates)
+
+        self.assertListEqual(obs, ["forward", "revcomp"])
+
+    def test_prefilter_templates_ambiguous(self):
+        # a run of ambiguous bases stands in for one side of a product only
+        templates = {
+            "one_n": self._random(100) + "N" + self._random(100),
+            "n_run": self._random(100) + "N" * 300 + self._random(100),
+            "n_far": FWD + self._random(600) + "N" + self._random(50),
+            "n_near": self._random(50)
+            + FWD
+            + self._random(60)
+            + "N"
+            + self._random(50),
+            "two_runs": self._random(50)
+            + "N"
+            + self._random(80)
+            + "R"
+            + self._random(50),
+        }
+
+        obs = self._prefilter(templates)
+
+        self.assertListEqual(obs, ["n_near", "two_runs"])
+
+    def test_prefilter_templates_mismatches(self):
+        # no template with primer sites within the mismatch limit is dropped
+        for _ in range(50):
+            mismatch = self.rng.randint(0, 2)
+            fwd = _mutate(FWD, self.rng.randint(0, mismatch), self.rng)
+            rev = _mutate(
+                _resolve(REV, self.rng), self.rng.randint(0, mismatch), self.rng
+            )
+            product = fwd + self._random(self.rng.randint(10, 150)) + _revcomp(rev)
+            templates = {"hit": self._random(30) + product + self._random(30)}
+
+            obs = self._prefilter(templates, mismatch)
+
+            self.assertIn(obs, (None, ["hit"]))
+
+    def test_prefilter_templates_indexed(self):
+        product = FWD + self._random(60) + _revcomp(_resolve(REV, self.rng))
+        templates = {
+            "hit": self._random(100) + product + self._random(100),
+            "no_site": self._random(500),
+            "ambiguous": FWD + self._random(60) + "N" * 10 + self._random(100),
+        }
+        self._prefilter(templates)
+        index_dir = os.path.join(self.temp_dir.name, "index")
+        os.mkdir(index_dir)
+        _build_template_index(
+            os.path.join(self.temp_dir.name, "templates.fasta"), 12, index_dir
+        )
+        # templates which are not indexed (or differ from the index) are scanned
+        templates["no_site"] = product
+        templates["new"] = product
+
+        with patch(
+            "q2_exonerate._prefilter._scan_template", wraps=_scan_template
+        ) as scan:
+            obs = self._prefilter(templates, template_index=index_dir)
+
+        self.assertListEqual(obs, ["hit", "no_site", "ambiguous", "new"])
+        self.assertEqual(scan.call_count, 2)
+
+    @patch("q2_exonerate._prefilter.SCAN_BLOCK_SIZE", 50)
+    @patch("q2_exonerate._prefilter.INDEX_BUCKET_SIZE", 64)
+    def test_build_template_index(self):
+        templates = {
+            "a": self._random(300),
+            "b": self._random(20) + "N" + self._random(100),
+            "c": self._random(5),
+        }
+        self._prefilter(templates)
+        index_dir = os.path.join(self.temp_dir.name, "index")
+        os.mkdir(index_dir)
+
+        _build_template_index(
+            os.path.join(self.temp_dir.name, "templates.fasta"), 6, index_dir
+        )
+
+        exp = sorted(
+            (_encode_kmer(seq[i : i + 6]), t, i)
+            for t, seq in enumerate(templates.values())
+            for i in range(len(seq) - 5)
+            if "N" not in seq[i : i + 6]
+        )
+        obs = zip(
+            *(
+                np.load(os.path.join(index_dir, name)).tolist()
+                for name in ("kmers.npy", "templates.npy", "positions.npy")
+            )
+        )
+        self.assertListEqual(list(obs), exp)
+        self.assertListEqual(
+            np.load(os.path.join(index_dir, "ambiguous.npy")).tolist(), [[1, 15, 21]]
+        )
+        self.assertCountEqual(
+            os.listdir(index_dir),
+            [
+                "index.json",
+                "templates.tsv",
+                "kmers.npy",
+                "templates.npy",
+                "positions.npy",
+                "ambiguous.npy",
+            ],
+        )
+
+    def test_prefilter_templates_index_too_long(self):
+        index_dir = os.path.join(self.temp_dir.name, "index")
+        os.mkdir(index_dir)
+        _build_template_index(self.get_data_path("templates.fasta"), 31, index_dir)
+
+        with patch(
+            "q2_exonerate._prefilter._lookup_template_index"
+        ) as lookup, self.assertLogs("q2_exonerate.prefilter", "WARNING") as logs:
+            self._prefilter({"a": self._random(100)}, template_index=index_dir)
+        lookup.assert_not_called()
+        self.assertIn("index with k <= 17 is needed", logs.output[0])
+
+    def test_prefilter_templates_short_primers(self):
+        with open(self.experiments_fp, "w") as fh:
+            fh.write("short ACGTACGT TTGGCCAA 50 200\n")
+        self.assertIsNone(self._prefilter({"a": self._random(100)}, mismatch=1))
+
+
+if __name__ == "__main__":
+    unittest.main()
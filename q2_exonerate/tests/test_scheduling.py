@@ -0,0 +1,190 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import signal
+import subprocess
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import MagicMock, patch
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_exonerate._scheduling import (
+    _estimate_fsm_memory,
+    _is_oom_kill,
+    _longest_template,
+    _plan_memory,
+    _run_scheduled,
+)
+
+
+def _killed():
+    return subprocess.CalledProcessError(-signal.SIGKILL, ["ipcress"])
+
+
+class TestScheduling(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def test_estimate_fsm_memory(self):
+        fp = self.get_data_path("experiments.ipcress")
+        small = _estimate_fsm_memory(fp, seed=12, mismatch=0)
+        large = _estimate_fsm_memory(fp, seed=12, mismatch=3)
+        self.assertEqual(small, 1)
+        self.assertGreater(large, small)
+
+    def test_longest_template(self):
+        obs = _longest_template(self.get_data_path("templates.fasta"))
+        self.assertEqual(obs, 22)
+
+    def test_plan_memory_all_workers_fit(self):
+        obs = _plan_memory(
+            budget=1000, n_jobs=4, memory=32, fsm_memory=100, overhead=20
+        )
+        self.assertEqual(obs, (4, 32))
+
+    def test_plan_memory_limited_by_budget(self):
+        obs = _plan_memory(budget=200, n_jobs=8, memory=32, fsm_memory=100, overhead=20)
+        self.assertEqual(obs, (3, 32))
+
+    def test_plan_memory_small_panel(self):
+        # the panel needs less than memory, so more workers fit
+        obs = _plan_memory(budget=200, n_jobs=8, memory=32, fsm_memory=5, overhead=20)
+        self.assertEqual(obs, (8, 5))
+
+    def test_plan_memory_single_worker_gets_the_rest(self):
+        obs = _plan_memory(budget=40, n_jobs=8, memory=32, fsm_memory=100, overhead=20)
+        self.assertEqual(obs, (1, 20))
+
+    def test_plan_memory_budget_too_small(self):
+        with self.assertRaisesRegex(ValueError, "too small"):
+            _plan_memory(budget=10, n_jobs=8, memory=32, fsm_memory=100, overhead=20)
+
+    def test_is_oom_kill(self):
+        self.assertTrue(_is_oom_kill(_killed()))
+        self.assertTrue(_is_oom_kill(subprocess.CalledProcessError(137, ["x"])))
+        self.assertTrue(_is_oom_kill(BrokenProcessPool()))
+        self.assertFalse(_is_oom_kill(subprocess.CalledProcessError(1, ["x"])))
+        self.assertFalse(_is_oom_kill(ValueError()))
+
+    def test_run_scheduled_serial(self):
+        fn = MagicMock(side_effect=lambda unit, memory: (unit, memory))
+        obs = _run_scheduled(fn, [{"unit": 1}, {"unit": 2}], n_jobs=1, memory=32)
+        self.assertListEqual(obs, [(1, 32), (2, 32)])
+
+    def test_run_scheduled_serial_backs_off(self):
+        fn = MagicMock(side_effect=[_killed(), _killed(), "done"])
+        obs = _run_scheduled(fn, [{"unit": 1}], n_jobs=1, memory=32, retries=2)
+        self.assertListEqual(obs, ["done"])
+        self.assertListEqual(
+            [c.kwargs["memory"] for c in fn.call_args_list], [32, 16, 8]
+        )
+
+    def test_run_scheduled_serial_kills_use_up_retries(self):
+        fn = MagicMock(side_effect=_killed())
+        with self.assertRaises(subprocess.CalledProcessError):
+            _run_scheduled(fn, [{"unit": 1}], n_jobs=1, memory=32)
+        fn.assert_called_once()
+
+        fn.reset_mock()
+        with self.assertRaises(subprocess.CalledProcessError):
+            _run_scheduled(fn, [{"unit": 1}], n_jobs=1, memory=32, retries=2)
+        self.assertEqual(fn.call_count, 3)
+
+    def test_run_scheduled_serial_other_error(self):
+        fn = MagicMock(side_effect=subprocess.CalledProcessError(1, ["ipcress"]))
+        with self.assertRaises(subprocess.CalledProcessError):
+            _run_scheduled(fn, [{"unit": 1}], n_jobs=1, memory=32)
+        fn.assert_called_once()
+
+    def test_run_scheduled_retries_with_less_memory(self):
+        fn = MagicMock(side_effect=[subprocess.CalledProcessError(1, ["x"]), "done"])
+        obs = _run_scheduled(fn, [{"unit": 1}], n_jobs=1, memory=32, retries=1)
+        self.assertListEqual(obs, ["done"])
+        self.assertListEqual([c.kwargs["memory"] for c in fn.call_args_list], [32, 16])
+
+    def test_run_scheduled_retries_split(self):
+        def fn(unit, memory):
+            if len(unit) > 1:
+                raise subprocess.TimeoutExpired(["x"], 1)
+            return unit
+
+        def split(kwargs):
+            unit = kwargs["unit"]
+            if len(unit) > 1:
+                return [
+                    {"unit": unit[: len(unit) // 2]},
+                    {"unit": unit[len(unit) // 2 :]},
+                ]
+
+        done = []
+        units = [{"unit": "a"}, {"unit": "bcd"}]
+        obs = _run_scheduled(
+            fn, units, 1, 32, lambda *d: done.append(d), retries=2, split=split
+        )
+        # the parts of a split unit take its place, in order
+        self.assertListEqual(obs, ["a", "b", "c", "d"])
+        self.assertListEqual(done, [(0, ["a"]), (1, ["b", "c", "d"])])
+
+        with self.assertRaises(subprocess.TimeoutExpired):
+            _run_scheduled(fn, units, 1, 32, retries=1, split=split)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            _run_scheduled(fn, units, 1, 32, retries=2)
+
+    @patch("q2_exonerate._scheduling.ProcessPoolExecutor", ThreadPoolExecutor)
+    def test_run_scheduled_parallel_retries(self):
+        calls = []
+
+        def fn(unit, memory):
+            calls.append((unit, memory))
+            if unit == 2 and memory == 32:
+                raise subprocess.CalledProcessError(-signal.SIGSEGV, ["x"])
+            return unit * 10
+
+        units = [{"unit": i} for i in range(4)]
+        obs = _run_scheduled(fn, units, n_jobs=2, memory=32, retries=1)
+        self.assertListEqual(obs, [0, 10, 20, 30])
+        # only the failed unit is run again
+        self.assertEqual(len(calls), 5)
+        self.assertIn((2, 16), calls)
+
+    @patch("q2_exonerate._scheduling.ProcessPoolExecutor", ThreadPoolExecutor)
+    def test_run_scheduled_parallel(self):
+        fn = MagicMock(side_effect=lambda unit, memory: unit * 10)
+        units = [{"unit": i} for i in range(5)]
+        done = []
+        obs = _run_scheduled(
+            fn, units, n_jobs=3, memory=32, on_done=lambda *d: done.append(d)
+        )
+        self.assertListEqual(obs, [0, 10, 20, 30, 40])
+        self.assertListEqual(sorted(done), [(i, [i * 10]) for i in range(5)])
+
+    @patch("q2_exonerate._scheduling.ProcessPoolExecutor")
+    def test_run_scheduled_parallel_backs_off(self, p1):
+        pools = []
+
+        def make_pool(max_workers):
+            pools.append(max_workers)
+            return ThreadPoolExecutor(max_workers=max_workers)
+
+        p1.side_effect = make_pool
+
+        def fn(unit, memory):
+            # units only fit into memory when run one at a time
+            if pools[-1] > 1:
+                raise _killed()
+            return unit, memory
+
+        units = [{"unit": i} for i in range(4)]
+        obs = _run_scheduled(fn, units, n_jobs=4, memory=32)
+
+        self.assertListEqual(obs, [(i, 32) for i in range(4)])
+        self.assertListEqual(pools, [4, 2, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import unittest
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_exonerate._sharding import (
+    _batch_experiments,
+    _iter_fasta_records,
+    _max_product_length,
+    _pack_shards,
+    _sequence_blocks,
+    _shard_templates,
+    _stream_fasta_records,
+    _template_ranks,
+    _window_starts,
+)
+
+
+class TestSharding(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def setUp(self):
+        super().setUp()
+        self.templates_fp = self.get_data_path("templates.fasta")
+
+    def _read_ids(self, fp):
+        return [header.split()[0][1:] for header, _ in _iter_fasta_records(fp)]
+
+    def test_iter_fasta_records(self):
+        obs = list(_iter_fasta_records(self.templates_fp))
+        self.assertEqual(len(obs), 4)
+        self.assertEqual(
+            obs[0], (">seq1 first template\n", ["ACGTACGTAC\n", "GTACGT\n"])
+        )
+        self.assertEqual(obs[3][1], ["GGGGGGGGGG\n", "GGGGGGGGGG\n", "GG\n"])
+
+    def test_stream_fasta_records(self):
+        obs = [
+            (header, list(seq))
+            for header, seq in _stream_fasta_records(self.templates_fp)
+        ]
+        self.assertListEqual(obs, list(_iter_fasta_records(self.templates_fp)))
+
+    def test_stream_fasta_records_unconsumed(self):
+        # lines which are not consumed are skipped
+        obs = [header for header, _ in _stream_fasta_records(self.templates_fp)]
+        self.assertListEqual(
+            obs, [h for h, _ in _iter_fasta_records(self.templates_fp)]
+        )
+
+    def test_sequence_blocks(self):
+        lines = ["ACGT\n", "ACG\n", "TAC\n"]
+        self.assertListEqual(
+            list(_sequence_blocks(lines, 4, 2)), [(0, b"ACGTAC"), (4, b"ACGTAC")]
+        )
+        self.assertListEqual(
+            list(_sequence_blocks(lines, 3, 2)),
+            [(0, b"ACGTA"), (3, b"TACGT"), (6, b"GTAC")],
+        )
+        self.assertListEqual(list(_sequence_blocks(["AC\n"], 4, 2)), [])
+
+    def test_max_product_length(self):
+        obs = _max_product_length(self.get_data_path("experiments.ipcress"))
+        self.assertEqual(obs, 5000)
+
+    def test_batch_experiments(self):
+        obs = _batch_experiments(
+            self.get_data_path("experiments.ipcress"), 1, self.temp_dir.name
+        )
+        self.assertEqual(len(obs), 2)
+        with open(obs[1]) as fh:
+            self.assertEqual(
+                fh.read(), "ITS1 CCTNGTTGATYCTGCCAGT CCTCCSCTTANTDATATGC 100 2500\n"
+            )
+
+    def test_batch_experiments_single_batch(self):
+        obs = _batch_experiments(
+            self.get_data_path("experiments.ipcress"), 5, self.temp_dir.name
+        )
+        self.assertEqual(len(obs), 1)
+
+    def test_template_ranks(self):
+        obs = _template_ranks(self.templates_fp)
+        self.assertDictEqual(obs, {"seq1": 0, "seq2": 1, "seq3": 2, "seq4": 3})
+
+    def test_pack_shards(self):
+        obs = _pack_shards([5, 100, 40, 30, 20, 10], 2)
+        # 100 + 5 | 40 + 30 + 20 + 10
+        self.assertListEqual(obs, [0, 0, 1, 1, 1, 1])
+
+    def test_pack_shards_ties(self):
+        obs = _pack_shards([10, 10, 10, 10], 2)
+        self.assertListEqual(obs, [0, 1, 0, 1])
+
+    def test_window_starts(self):
+        self.assertListEqual(_window_starts(100, 40, 10), [0, 30, 60])
+        self.assertListEqual(_window_starts(30, 40, 10), [0])
+
+    def test_shard_templates(self):
+        shards, ranks, windows = _shard_templates(
+            self.templates_fp, 2, self.temp_dir.name
+        )
+
+        self.assertEqual(len(shards), 2)
+        self.assertDictEqual(ranks, {"seq1": 0, "seq2": 1, "seq3": 2, "seq4": 3})
+        self.assertDictEqual(windows, {})
+        # seq4 (22 bp) and seq3 (4 bp) balance seq1 and seq2 (16 bp each)
+        self.assertListEqual(self._read_ids(shards[0]), ["seq3", "seq4"])
+        self.assertListEqual(self._read_ids(shards[1]), ["seq1", "seq2"])
+
+    def test_shard_templates_windows(self):
+        shards, ranks, windows = _shard_templates(
+            self.templates_fp, 4, self.temp_dir.name, overlap=3
+        )
+
+        # the ideal shard size is 15 bp, so all but seq3 are cut in two
+        self.assertDictEqual(
+            windows,
+            {
+                "seq1:window:0": ("seq1", 0),
+                "seq1:window:12": ("seq1", 12),
+                "seq2:window:0": ("seq2", 0),
+                "seq2:window:12": ("seq2", 12),
+                "seq4:window:0": ("seq4", 0),
+                "seq4:window:12": ("seq4", 12),
+            },
+        )
+        self.assertEqual(ranks["seq4:window:12"], 3)
+        records = {
+            header.split()[0][1:]: "".join(seq).replace("\n", "")
+            for fp in shards
+            for header, seq in _iter_fasta_records(fp)
+        }
+        self.assertEqual(records["seq1:window:0"], "ACGTACGTACGTACG")
+        self.assertEqual(records["seq1:window:12"], "ACGT")
+        self.assertEqual(records["seq3"], "ACGT")
+        self.assertEqual(records["seq4:window:12"], "G" * 10)
+
+    def test_shard_templates_max_shard_size(self):
+        shards, _, _ = _shard_templates(
+            self.templates_fp, 1, self.temp_dir.name, max_shard_size=20
+        )
+
+        # 58 bp do not fit into fewer than 3 shards of 20 bp
+        self.assertEqual(len(shards), 3)
+        self.assertCountEqual(
+            [seq_id for fp in shards for seq_id in self._read_ids(fp)],
+            ["seq1", "seq2", "seq3", "seq4"],
+        )
+
+    def test_shard_templates_more_shards_than_records(self):
+        shards, _, _ = _shard_templates(self.templates_fp, 8, self.temp_dir.name)
+
+        self.assertEqual(len(shards), 4)
+        for fp in shards:
+            self.assertTrue(os.path.getsize(fp) > 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import logging
+import os
+import time
+import unittest
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_exonerate._stats import NO_STATS, RunStats, _run_stats
+
+
+def _slow(items, seconds):
+    for item in items:
+        time.sleep(seconds)
+        yield item
+
+
+class TestRunStats(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def test_stage(self):
+        stats = RunStats()
+        with stats.stage("outer"):
+            time.sleep(0.02)
+            with stats.stage("inner"):
+                time.sleep(0.05)
+
+        self.assertGreaterEqual(stats.stages["inner"]["wall_s"], 0.05)
+        # time spent in a nested stage is not charged to the outer one
+        self.assertGreaterEqual(stats.stages["outer"]["wall_s"], 0.02)
+        self.assertLess(stats.stages["outer"]["wall_s"], 0.05)
+        # the peak RSS is only known for the run as a whole
+        self.assertSetEqual(set(stats.stages["inner"]), {"wall_s", "cpu_s"})
+
+    def test_iterate(self):
+        stats = RunStats()
+        upstream = stats.iterate("upstream", _slow(["ab", "cde"], 0.02), "bytes", len)
+        downstream = stats.iterate("downstream", _slow(upstream, 0.01), "items")
+
+        self.assertListEqual(list(downstream), ["ab", "cde"])
+        self.assertGreaterEqual(stats.stages["upstream"]["wall_s"], 0.04)
+        self.assertGreaterEqual(stats.stages["downstream"]["wall_s"], 0.02)
+        self.assertLess(stats.stages["downstream"]["wall_s"], 0.04)
+        self.assertDictEqual(dict(stats.counters), {"bytes": 5, "items": 2})
+
+    def test_summary(self):
+        stats = RunStats(action="test")
+        stats.count("products", 10)
+        with stats.stage("work"):
+            time.sleep(0.01)
+
+        obs = stats.summary()
+
+        self.assertEqual(obs["action"], "test")
+        self.assertEqual(obs["products"], 10)
+        self.assertGreater(obs["products_per_s"], 0)
+        self.assertSetEqual(set(obs["stages"]), {"other", "work"})
+        self.assertSetEqual(set(obs["children"]), {"cpu_s", "lifetime_peak_rss_mb"})
+
+    def test_log(self):
+        fp = os.path.join(self.temp_dir.name, "stats.jsonl")
+        for n in range(2):
+            stats = RunStats(run=n)
+            with self.assertLogs("q2_exonerate.stats", "INFO"):
+                stats.log(fp)
+
+        with open(fp) as fh:
+            self.assertListEqual([json.loads(line)["run"] for line in fh], [0, 1])
+
+    def test_progress(self):
+        stats = RunStats()
+        stats.count("products_found", 3)
+        with self.assertLogs("q2_exonerate.progress", "INFO") as cm:
+            with stats.progress(0.01), stats.stage("ipcress"):
+                with stats.watch("output_bytes", lambda: 42):
+                    time.sleep(0.05)
+
+        obs = json.loads(cm.records[0].getMessage())
+        self.assertEqual(obs["stage"], "ipcress")
+        self.assertEqual(obs["products_found"], 3)
+        self.assertEqual(obs["output_bytes"], 42)
+        self.assertGreater(obs["elapsed_s"], 0)
+        self.assertDictEqual(stats.gauges, {})
+
+    def test_progress_disabled(self):
+        stats = RunStats()
+        with self.assertNoLogs("q2_exonerate.progress", "INFO"):
+            with stats.progress(None):
+                time.sleep(0.01)
+
+    def test_run_stats_disabled(self):
+        stats = _run_stats(None)
+        self.assertIs(stats, NO_STATS)
+        items = iter([1, 2])
+        self.assertIs(stats.iterate("stage", items), items)
+        with stats.stage("stage"):
+            stats.count("products")
+        stats.log()
+
+    def test_run_stats_enabled(self):
+        fp = os.path.join(self.temp_dir.name, "stats.jsonl")
+        stats = _run_stats(fp, action="test")
+        self.assertIsInstance(stats, RunStats)
+        self.assertIsNot(stats, NO_STATS)
+
+    def test_run_stats_progress(self):
+        with self.assertLogs("q2_exonerate.progress", "INFO"):
+            stats = _run_stats(None, 60, action="test")
+            # assertLogs needs at least one record
+            logging.getLogger("q2_exonerate.progress").info("")
+        self.assertIsNot(stats, NO_STATS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import pickle
+import unittest
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_exonerate._store import PRODUCT_OVERHEAD, ProductStore
+
+
+def _products(n):
+    return [
+        {"id": f"EXP_product_{i}", "start_position": i, "sequence": "ACGT" * i}
+        for i in range(n)
+    ]
+
+
+class TestProductStore(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def test_in_memory(self):
+        store = ProductStore(self.temp_dir.name).extend(_products(5))
+
+        self.assertEqual(len(store), 5)
+        self.assertIsNone(store.spill_fp)
+        self.assertListEqual(list(store), _products(5))
+
+    def test_spill(self):
+        # about three products fit into memory
+        store = ProductStore(self.temp_dir.name, 3 * PRODUCT_OVERHEAD + 100)
+        store.extend(_products(10))
+
+        self.assertEqual(len(store), 10)
+        self.assertEqual(store.batches, 2)
+        self.assertTrue(os.path.isfile(store.spill_fp))
+        self.assertListEqual(list(store), _products(10))
+        # the store can be iterated over repeatedly
+        self.assertListEqual(list(store), _products(10))
+
+    def test_pickle(self):
+        store = ProductStore(self.temp_dir.name, PRODUCT_OVERHEAD)
+        store.extend(_products(4))
+
+        obs = pickle.loads(pickle.dumps(store))
+
+        self.assertEqual(obs.spill_fp, store.spill_fp)
+        self.assertListEqual(list(obs), _products(4))
+
+
+if __name__ == "__main__":
+    unittest.main()
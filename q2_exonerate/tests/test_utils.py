@@ -0,0 +1,153 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Bokulich Laboratories.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from qiime2.plugin.testing import TestPluginBase
+
+from q2_exonerate.utils import (
+    STDERR_TAIL_LINES,
+    run_command,
+    run_command_to_file,
+    stream_command,
+)
+
+
+class TestStreamCommand(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def _python(self, code):
+        return [sys.executable, "-c", code]
+
+    def test_stream_command(self):
+        cmd = self._python("print('a'); print('b')")
+        obs = b"".join(stream_command(cmd, verbose=False))
+        self.assertEqual(obs, b"a\nb\n")
+
+    def test_stream_command_error(self):
+        cmd = self._python(
+            "import sys; print('a'); sys.stderr.write('boom'); sys.exit(3)"
+        )
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            list(stream_command(cmd, verbose=False))
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(cm.exception.stderr, b"boom")
+
+    def test_stream_command_stopped_early(self):
+        cmd = self._python("while True: print('a' * 100)")
+        chunks = stream_command(cmd, verbose=False)
+        self.assertTrue(next(chunks).startswith(b"a"))
+        # closing the generator must terminate the process and not hang
+        chunks.close()
+
+    def test_stream_command_timeout(self):
+        cmd = self._python("import time; print('a', flush=True); time.sleep(60)")
+        chunks = stream_command(cmd, verbose=False, timeout=0.5)
+        self.assertTrue(next(chunks).startswith(b"a"))
+        with self.assertRaises(subprocess.TimeoutExpired):
+            list(chunks)
+
+
+class TestRunCommand(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def test_run_command_logs_stderr(self):
+        cmd = [
+            sys.executable,
+            "-c",
+            "import sys; print('a'); sys.stderr.write('x\\ny')",
+        ]
+        with self.assertLogs("q2_exonerate.command", "INFO") as cm:
+            obs = run_command(cmd, verbose=False)
+        self.assertEqual(obs, b"a\n")
+        self.assertListEqual(
+            [r.getMessage() for r in cm.records],
+            [f"{os.path.basename(sys.executable)}: {line}" for line in "xy"],
+        )
+
+    def test_run_command_error_keeps_stderr_tail(self):
+        cmd = [
+            sys.executable,
+            "-c",
+            "import sys\nfor i in range(1000): print(i, file=sys.stderr)\nexit(2)",
+        ]
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            run_command(cmd, verbose=False)
+        lines = cm.exception.stderr.splitlines()
+        self.assertEqual(len(lines), STDERR_TAIL_LINES)
+        self.assertEqual(lines[-1], b"999")
+
+    def test_run_command_timeout(self):
+        cmd = [sys.executable, "-c", "import time; print('a'); time.sleep(60)"]
+        start = time.perf_counter()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            run_command(cmd, verbose=False, timeout=0.5)
+        self.assertLess(time.perf_counter() - start, 30)
+
+    def test_run_command_max_cpu_time(self):
+        cmd = [sys.executable, "-c", "while True: pass"]
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            run_command(cmd, verbose=False, max_cpu_time=1, timeout=30)
+        self.assertIn(-cm.exception.returncode, (signal.SIGXCPU, signal.SIGKILL))
+
+    def test_run_command_max_memory(self):
+        cmd = [sys.executable, "-c", "b = bytearray(2**30)"]
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            run_command(cmd, verbose=False, max_memory=256)
+        self.assertIn(b"MemoryError", cm.exception.stderr)
+
+    def test_run_command_limits_without_prlimit(self):
+        # e.g. on macOS, the limits are set by a shell wrapping the command
+        no_prlimit = MagicMock(
+            spec=["RLIMIT_AS", "RLIMIT_CPU"],
+            RLIMIT_AS=resource.RLIMIT_AS,
+            RLIMIT_CPU=resource.RLIMIT_CPU,
+        )
+        cmd = [
+            sys.executable,
+            "-c",
+            "import resource; print(resource.getrlimit(resource.RLIMIT_CPU))",
+        ]
+        with patch("q2_exonerate.utils.resource", no_prlimit):
+            obs = run_command(cmd, verbose=False, max_cpu_time=5, max_memory=4096)
+        self.assertEqual(obs, b"(5, 5)\n")
+
+
+class TestRunCommandToFile(TestPluginBase):
+    package = "q2_exonerate.tests"
+
+    def setUp(self):
+        super().setUp()
+        self.out_fp = os.path.join(self.temp_dir.name, "out")
+
+    def test_run_command_to_file(self):
+        cmd = [sys.executable, "-c", "print('a'); print('b')"]
+        with open(self.out_fp, "wb") as out:
+            # the output is appended to anything written before
+            out.write(b"\n")
+            run_command_to_file(cmd, out, verbose=False)
+        with open(self.out_fp, "rb") as fh:
+            self.assertEqual(fh.read(), b"\na\nb\n")
+
+    def test_run_command_to_file_error(self):
+        cmd = [sys.executable, "-c", "import sys; sys.stderr.write('boom'); exit(3)"]
+        with open(self.out_fp, "wb") as out:
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                run_command_to_file(cmd, out, verbose=False)
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(cm.exception.stderr, b"boom")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,8 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import json
+
 import pandas as pd
 from qiime2.core.exceptions import ValidationError
 from qiime2.plugin import model
@@ -78,3 +80,42 @@ class PCRProductMetadataFormat(model.TextFileFormat):
 PCRProductMetadataDirFmt = model.SingleFileDirectoryFormat(
     "PCRProductMetadataDirFmt", "product-metadata.tsv", PCRProductMetadataFormat
 )
+
+
+class TemplateIndexManifestFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        try:
+            with open(str(self)) as fh:
+                manifest = json.load(fh)
+        except json.JSONDecodeError as e:
+            raise ValidationError(f"The index manifest is not valid JSON: {e}.")
+
+        if not isinstance(manifest.get("k"), int) or manifest["k"] < 1:
+            raise ValidationError("The index manifest lacks a valid k-mer size.")
+
+
+class TemplateIndexRecordsFormat(model.TextFileFormat):
+    def _validate_(self, level):
+        with open(str(self)) as fh:
+            for i, line in enumerate(fh, start=1):
+                if len(line.rstrip("\n").split("\t")) != 2:
+                    raise ValidationError(
+                        f"Line {i} of the indexed templates does not consist of "
+                        "a template ID and a sequence hash."
+                    )
+
+
+class NumPyArrayFormat(model.BinaryFileFormat):
+    def _validate_(self, level):
+        with open(str(self), "rb") as fh:
+            if fh.read(6) != b"\x93NUMPY":
+                raise ValidationError("The file is not a NumPy array file.")
+
+
+class IPCRessTemplateIndexDirFmt(model.DirectoryFormat):
+    manifest = model.File("index.json", format=TemplateIndexManifestFormat)
+    records = model.File("templates.tsv", format=TemplateIndexRecordsFormat)
+    kmers = model.File("kmers.npy", format=NumPyArrayFormat)
+    templates = model.File("templates.npy", format=NumPyArrayFormat)
+    positions = model.File("positions.npy", format=NumPyArrayFormat)
+    ambiguous = model.File("ambiguous.npy", format=NumPyArrayFormat)
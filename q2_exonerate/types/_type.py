@@ -10,3 +10,4 @@ from qiime2.core.type import SemanticType
 
 IPCRessExperiments = SemanticType("IPCRessExperiments")
 PCRProductMetadata = SemanticType("PCRProductMetadata")
+IPCRessTemplateIndex = SemanticType("IPCRessTemplateIndex")
@@ -16,10 +16,18 @@ from qiime2.plugin.testing import TestPluginBase
 from q2_exonerate.types._format import (
     IPCRessExperimentDirFmt,
     IPCRessExperimentFormat,
+    IPCRessTemplateIndexDirFmt,
+    NumPyArrayFormat,
     PCRProductMetadataDirFmt,
     PCRProductMetadataFormat,
+    TemplateIndexManifestFormat,
+    TemplateIndexRecordsFormat,
+)
+from q2_exonerate.types._type import (
+    IPCRessExperiments,
+    IPCRessTemplateIndex,
+    PCRProductMetadata,
 )
-from q2_exonerate.types._type import IPCRessExperiments, PCRProductMetadata
 
 
 class TestFormats(TestPluginBase):
@@ -67,6 +75,45 @@ class TestFormats(TestPluginBase):
         ):
             format.validate()
 
+    def test_index_manifest_fmt(self):
+        exp_path = self.get_data_path("index_manifest.json")
+        format = TemplateIndexManifestFormat(exp_path, mode="r")
+        format.validate()
+
+    def test_index_manifest_fmt_no_k(self):
+        exp_path = self.get_data_path("index_manifest_no_k.json")
+        format = TemplateIndexManifestFormat(exp_path, mode="r")
+        with self.assertRaisesRegexp(ValidationError, "lacks a valid k-mer size"):
+            format.validate()
+
+    def test_index_manifest_fmt_not_json(self):
+        exp_path = self.get_data_path("index_records.tsv")
+        format = TemplateIndexManifestFormat(exp_path, mode="r")
+        with self.assertRaisesRegexp(ValidationError, "not valid JSON"):
+            format.validate()
+
+    def test_index_records_fmt(self):
+        exp_path = self.get_data_path("index_records.tsv")
+        format = TemplateIndexRecordsFormat(exp_path, mode="r")
+        format.validate()
+
+    def test_index_records_fmt_wrong_cols(self):
+        exp_path = self.get_data_path("index_records_wrong_cols.tsv")
+        format = TemplateIndexRecordsFormat(exp_path, mode="r")
+        with self.assertRaisesRegexp(ValidationError, "Line 1 of the indexed"):
+            format.validate()
+
+    def test_numpy_array_fmt(self):
+        exp_path = self.get_data_path("index_kmers.npy")
+        format = NumPyArrayFormat(exp_path, mode="r")
+        format.validate()
+
+    def test_numpy_array_fmt_wrong_file(self):
+        exp_path = self.get_data_path("index_records.tsv")
+        format = NumPyArrayFormat(exp_path, mode="r")
+        with self.assertRaisesRegexp(ValidationError, "not a NumPy array file"):
+            format.validate()
+
 
 class TestTypes(TestPluginBase):
     package = "q2_exonerate.types.tests"
@@ -77,6 +124,14 @@ class TestTypes(TestPluginBase):
     def test_pcr_prod_meta_semantic_type_registration(self):
         self.assertRegisteredSemanticType(PCRProductMetadata)
 
+    def test_template_index_semantic_type_registration(self):
+        self.assertRegisteredSemanticType(IPCRessTemplateIndex)
+
+    def test_template_index_to_format_registration(self):
+        self.assertSemanticTypeRegisteredToFormat(
+            IPCRessTemplateIndex, IPCRessTemplateIndexDirFmt
+        )
+
     def test_ipcress_exp_to_format_registration(self):
         self.assertSemanticTypeRegisteredToFormat(
             IPCRessExperiments, IPCRessExperimentDirFmt
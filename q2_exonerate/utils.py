@@ -5,7 +5,16 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import logging
+import os
+import resource
+import signal
 import subprocess
+import threading
+from collections import deque
+from typing import BinaryIO, Dict, Iterator, List, Optional
+
+logger = logging.getLogger("q2_exonerate.command")
 
 EXTERNAL_CMD_WARNING = (
     "Running external command line application(s). "
@@ -15,13 +24,166 @@ EXTERNAL_CMD_WARNING = (
     "temporary files that no longer exist."
 )
 
+STREAM_CHUNK_SIZE = 2**20
+# stderr lines kept for error reporting, and the longest line read at once
+STDERR_TAIL_LINES = 100
+STDERR_LINE_LIMIT = 2**16
+
+
+class _StderrLog(threading.Thread):
+    """Log the stderr of a process line by line while it runs.
+
+    Only the last `STDERR_TAIL_LINES` lines are kept, to be attached to the
+    error raised if the process fails, so that a process which logs heavily
+    takes bounded memory and never blocks on a full pipe.
+    """
+
+    def __init__(self, proc: subprocess.Popen, program: str):
+        super().__init__(name=f"stderr-{proc.pid}", daemon=True)
+        self.stream, self.program = proc.stderr, program
+        self.lines = deque(maxlen=STDERR_TAIL_LINES)
+
+    def run(self):
+        enabled = logger.isEnabledFor(logging.INFO)
+        with self.stream:
+            for line in iter(lambda: self.stream.readline(STDERR_LINE_LIMIT), b""):
+                self.lines.append(line)
+                if enabled:
+                    logger.info(
+                        "%s: %s", self.program, line.decode(errors="replace").rstrip()
+                    )
+
+    def tail(self) -> bytes:
+        self.join()
+        return b"".join(self.lines)
+
+
+class _Command:
+    """A running external command whose stderr is logged (see `_StderrLog`).
+
+    The command is killed once it has run for `timeout` seconds; its
+    address space is limited to `max_memory` MB and its CPU time to
+    `max_cpu_time` seconds by resource limits, which make it fail (or, for
+    the CPU time, kill it) rather than the machine when it runs away. The
+    limits are set on the process as soon as it is started (see
+    `_set_limits`), as running code between fork and exec is not safe in a
+    process with threads.
+    """
+
+    def __init__(
+        self,
+        cmd: List[str],
+        stdout,
+        verbose: bool = True,
+        timeout: Optional[float] = None,
+        max_memory: Optional[int] = None,
+        max_cpu_time: Optional[int] = None,
+    ):
+        if verbose:
+            print(EXTERNAL_CMD_WARNING)
+            print("\nCommand:", end=" ")
+            print(" ".join(cmd), end="\n\n")
+        limits = {}
+        if max_memory is not None:
+            limits[resource.RLIMIT_AS] = max_memory * 2**20
+        if max_cpu_time is not None:
+            limits[resource.RLIMIT_CPU] = max_cpu_time
+        self.cmd, self.timeout = cmd, timeout
+        if limits and not hasattr(resource, "prlimit"):
+            cmd = _ulimit_command(cmd, limits)
+        self.proc = subprocess.Popen(cmd, stdout=stdout, stderr=subprocess.PIPE)
+        if limits and hasattr(resource, "prlimit"):
+            _set_limits(self.proc.pid, limits)
+        self.stderr = _StderrLog(self.proc, os.path.basename(self.cmd[0]))
+        self.stderr.start()
+        self.timer, self.timed_out = None, False
+        if timeout is not None:
+            self.timer = threading.Timer(timeout, self._kill_on_timeout)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _kill_on_timeout(self):
+        self.timed_out = True
+        self.proc.kill()
+
+    def check(self, output=None):
+        """Wait for the command and raise if it timed out or failed."""
+        returncode = self.proc.wait()
+        if self.timer is not None:
+            self.timer.cancel()
+        tail = self.stderr.tail()
+        if self.timed_out and returncode == -signal.SIGKILL:
+            raise subprocess.TimeoutExpired(self.cmd, self.timeout, output, tail)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.cmd, output, tail)
 
-def run_command(cmd, verbose=True):
-    if verbose:
-        print(EXTERNAL_CMD_WARNING)
-        print("\nCommand:", end=" ")
-        print(" ".join(cmd), end="\n\n")
-    out = subprocess.run(
-        cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+
+def _set_limits(pid: int, limits: Dict[int, int]):
+    """Set the resource limits of the running process `pid`.
+
+    The process only runs without them for as long as it takes to start
+    it and return here, before it gets to do any real work.
+    """
+    for limit, value in limits.items():
+        try:
+            resource.prlimit(pid, limit, (value, value))
+        except ProcessLookupError:
+            # the process has already finished
+            return
+
+
+def _ulimit_command(cmd: List[str], limits: Dict[int, int]) -> List[str]:
+    """Wrap `cmd` in a shell which sets its resource limits before it runs.
+
+    Used where `resource.prlimit` is not available, e.g. on macOS.
+    """
+    options = {resource.RLIMIT_AS: ("-v", 2**10), resource.RLIMIT_CPU: ("-t", 1)}
+    script = "".join(
+        f"ulimit {options[limit][0]} {value // options[limit][1]}; "
+        for limit, value in limits.items()
     )
-    return out.stdout
+    return ["/bin/sh", "-c", script + 'exec "$@"', "sh", *cmd]
+
+
+def run_command(cmd, verbose=True, **limits):
+    command = _Command(cmd, subprocess.PIPE, verbose, **limits)
+    with command.proc.stdout:
+        output = command.proc.stdout.read()
+    command.check(output)
+    return output
+
+
+def stream_command(cmd: List[str], verbose=True, **limits) -> Iterator[bytes]:
+    """Run a command and yield its stdout in chunks as it is produced.
+
+    Unlike `run_command`, the output is never collected in memory: chunks of
+    up to `STREAM_CHUNK_SIZE` bytes are read from the process' pipe on
+    demand. stderr is logged as it is written (see `_StderrLog`). A non-zero
+    exit status raises `subprocess.CalledProcessError` once the output has
+    been consumed; if the consumer stops early, the process is terminated.
+    Any `limits` are passed on to `_Command`.
+    """
+    command = _Command(cmd, subprocess.PIPE, verbose, **limits)
+    proc = command.proc
+    try:
+        yield from iter(lambda: proc.stdout.read1(STREAM_CHUNK_SIZE), b"")
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    command.check()
+
+
+def run_command_to_file(cmd: List[str], out: BinaryIO, verbose=True, **limits):
+    """Run a command with its stdout redirected to the file `out`.
+
+    The output goes straight from the process to the file, without
+    passing through a pipe or this process' memory. stderr is logged as
+    it is written and its tail attached to the
+    `subprocess.CalledProcessError` raised for a non-zero exit status.
+    Any `limits` are passed on to `_Command`.
+    """
+    out.flush()
+    _Command(cmd, out, verbose, **limits).check()